@@ -32,7 +32,8 @@ class BrainCTM(object):
 
         left, right = db.get_surf(subject, "fiducial")
         try:
-            fleft, fright = db.get_surf(subject, "flat", nudge=True, merge=False)
+            # the medial wall vertices are moved below
+            fleft, fright = db.get_surf(subject, "flat", nudge=True, merge=False, copy=True)
         except IOError:
             fleft = None
 
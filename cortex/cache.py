@@ -0,0 +1,433 @@
+"""Storage of the array caches in the subject cache directories (mappers,
+flatmap masks and pixel maps).
+
+Two on-disk formats are supported:
+
+- ``npz``: a single ``<name>.npz`` archive, read fully into memory on load
+- ``mmap``: a ``<name>.mmap`` directory with one raw ``.npy`` file per array,
+  which are memory-mapped read-only on load. Loading is nearly instant, and
+  all processes using the same cache share its pages through the OS page
+  cache instead of each holding a private copy.
+
+The format used for new caches is set by the `cache_format` option in the
+[basic] section of the config. Existing caches are read in either format.
+
+Caches that depend on files of the filestore (surfaces, transforms) are named
+after a digest of the contents of these files, see `Manifest`, so that they
+are rebuilt whenever their inputs change, and only then.
+
+Caches are written to a temporary file that is renamed once complete, so that
+a cache is never read half-written. Many processes (e.g. cluster jobs) may
+also need the same missing cache at once: `building` makes a single one of
+them build it, while the others wait on a lock file and then load the result.
+
+Loaded caches are also kept in `memory`, a process-wide LRU cache, so that
+rendering many flatmaps or mapping many volumes of the same subject does not
+reload the same matrices from disk every time. Surfaces loaded by
+`Database.get_surf` are kept there as well.
+"""
+import contextlib
+import glob
+import json
+import os
+import shutil
+import threading
+from collections import OrderedDict
+from hashlib import sha1
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:
+    # no inter-process locking on Windows
+    fcntl = None
+
+from .options import config
+
+FORMATS = dict(npz=".npz", mmap=".mmap")
+
+def get_format(fmt=None):
+    """Format used to write new caches, defaults to the configured one"""
+    if fmt is None:
+        fmt = config.get("basic", "cache_format") if config.has_option("basic", "cache_format") else "npz"
+    if fmt not in FORMATS:
+        raise ValueError("Unknown cache format %r, must be one of %s" % (fmt, ", ".join(FORMATS)))
+    return fmt
+
+def _basename(path):
+    for ext in FORMATS.values():
+        if path.endswith(ext):
+            return path[:-len(ext)]
+    return path
+
+def find(path, fmt=None):
+    """Path of the existing cache file for `path` (with or without extension),
+    preferring format `fmt`. Returns None if the cache does not exist."""
+    base = _basename(path)
+    fmt = get_format(fmt)
+    for ext in [FORMATS[fmt]] + [e for f, e in FORMATS.items() if f != fmt]:
+        if os.path.exists(base + ext):
+            return base + ext
+    return None
+
+def save(path, fmt=None, **arrays):
+    """Save `arrays` to the cache `path`, returning the path of the written
+    file. Caches of `path` in other formats are removed."""
+    fmt = get_format(fmt)
+    base = _basename(path)
+    fname = base + FORMATS[fmt]
+    for other in FORMATS.values():
+        if other != FORMATS[fmt]:
+            _remove(base + other)
+
+    if fmt == "npz":
+        with atomic(fname) as tmpname:
+            np.savez(tmpname, **arrays)
+        return fname
+
+    tmpname = _tempname(fname)
+    try:
+        os.makedirs(tmpname)
+        for name, array in arrays.items():
+            np.save(os.path.join(tmpname, name + ".npy"), np.asanyarray(array))
+        # directories cannot be replaced atomically, swap the old one out first
+        if os.path.exists(fname):
+            oldname = _tempname(fname)
+            os.rename(fname, oldname)
+            os.rename(tmpname, fname)
+            _remove(oldname)
+        else:
+            os.rename(tmpname, fname)
+    finally:
+        _remove(tmpname)
+    return fname
+
+def load(path, mmap=True):
+    """Load all arrays from the cache file `path` into a dictionary. Arrays of
+    caches in the ``mmap`` format are memory-mapped read-only unless `mmap` is
+    False."""
+    fname = find(path) if not os.path.exists(path) else path
+    if fname is None:
+        raise IOError("Cache file %s not found" % path)
+
+    if not os.path.isdir(fname):
+        with np.load(fname) as npz:
+            return dict((name, npz[name]) for name in npz.files)
+
+    arrays = dict()
+    for name in os.listdir(fname):
+        if name.endswith(".npy"):
+            arrays[name[:-4]] = _load_npy(os.path.join(fname, name), mmap)
+    return arrays
+
+def load_sparse(path, prefix="", mmap=True):
+    """Load a CSR matrix saved with `sparse_arrays` from the cache `path`"""
+    from scipy import sparse
+    arrays = load(path, mmap=mmap)
+    csr = (arrays[prefix+"data"], arrays[prefix+"indices"], arrays[prefix+"indptr"])
+    return sparse.csr_matrix(csr, shape=tuple(arrays[prefix+"shape"]))
+
+def sparse_arrays(matrix, prefix=""):
+    """Dictionary of the arrays needed to store a CSR `matrix`"""
+    return {prefix+"data": matrix.data, prefix+"indices": matrix.indices,
+            prefix+"indptr": matrix.indptr, prefix+"shape": matrix.shape}
+
+def _load_npy(fname, mmap):
+    if mmap:
+        try:
+            return np.load(fname, mmap_mode="r")
+        except ValueError:
+            # empty arrays cannot be memory-mapped on some platforms
+            pass
+    return np.load(fname)
+
+def _remove(fname):
+    if os.path.isdir(fname):
+        shutil.rmtree(fname)
+    elif os.path.exists(fname):
+        os.unlink(fname)
+
+def _tempname(fname):
+    # hidden, unique to this process and thread, and with the same extension
+    dirname, basename = os.path.split(fname)
+    return os.path.join(dirname, ".tmp%d.%d.%s" % (os.getpid(), threading.get_ident(), basename))
+
+@contextlib.contextmanager
+def atomic(fname):
+    """Context manager yielding a temporary file name to write `fname` to,
+    which is renamed to `fname` if the block completes without error. The
+    temporary name keeps the extension of `fname`."""
+    tmpname = _tempname(fname)
+    try:
+        yield tmpname
+        os.replace(tmpname, fname)
+    finally:
+        _remove(tmpname)
+
+def _lockname(path):
+    dirname, basename = os.path.split(_basename(path))
+    return os.path.join(dirname, "." + basename + ".lock")
+
+@contextlib.contextmanager
+def lock(path):
+    """Context manager holding an exclusive lock on the cache `path`, shared
+    by all processes on this machine (and on other machines, for network file
+    systems supporting locks). The lock is released by the OS if the process
+    dies, so it can never be left stale.
+
+    The lock file is removed when the lock is released. Processes that were
+    waiting on the removed file notice it and lock the new one instead.
+    """
+    if fcntl is None:
+        yield
+        return
+
+    lockname = _lockname(path)
+    while True:
+        fp = open(lockname, "a")
+        fcntl.flock(fp.fileno(), fcntl.LOCK_EX)
+        try:
+            if os.path.samestat(os.fstat(fp.fileno()), os.stat(lockname)):
+                break
+        except FileNotFoundError:
+            pass
+        # the holder removed the file while we were waiting for it
+        fp.close()
+
+    try:
+        yield
+    finally:
+        os.unlink(lockname)
+        fp.close()
+
+@contextlib.contextmanager
+def building(path, recache=False):
+    """Context manager guarding the generation of the cache (or any other
+    generated file) `path` against concurrent builders.
+
+    Yields True if the caller must build the cache, and False if it can load
+    it. Only one process (or thread) builds a missing cache, the others wait
+    until it is done and then get False. The lock is only taken when the
+    cache needs to be built, so loading an existing cache costs nothing.
+
+    With `recache`, the cache is rebuilt unless another process finished
+    rebuilding it while waiting for the lock.
+
+    Example::
+
+        with cache.building(cachefile, recache) as stale:
+            if stale:
+                cache.save(cachefile, mask=make_mask())
+        mask = cache.load(cachefile)['mask']
+    """
+    start = mtime(path)
+    if start is not None and not recache:
+        yield False
+        return
+
+    with lock(path):
+        current = mtime(path)
+        stale = current is None or (recache and current == start)
+        yield stale
+    if stale:
+        Manifest._built(path)
+
+
+class Manifest(object):
+    """Manifest of a subject cache directory, stored in its ``manifest.json``.
+
+    Cached artifacts (flatmap caches, mappers...) are named after a digest of
+    the contents of their input files, e.g. ``flatpixel_fullhead_1024_<digest>``
+    for a pixel map depending on the flat and fiducial surfaces and on the
+    transform. Caches are then reused as long as their inputs are unchanged,
+    whatever their modification times, and rebuilt as soon as an input
+    changes, without ever passing `recache`.
+
+    The manifest records:
+
+    - ``files``: the content hash of each input file, along with its size and
+      modification time, so that files are only hashed again once modified
+    - ``artifacts``: the current digest of each artifact. When the digest of
+      an artifact changes, the cache of its previous inputs is removed.
+
+    Looking up a path only reads the manifest. It is written once the cache
+    of an artifact has been built through `building`, which records the
+    hashes of its inputs and its new digest.
+    """
+    # artifacts waiting to be recorded once built, by path
+    _pending = dict()
+    # hashes of the files missing from the manifests, by name
+    _hashes = dict()
+    _pending_lock = threading.Lock()
+
+    def __init__(self, cachedir):
+        self.cachedir = cachedir
+        self.path = os.path.join(cachedir, "manifest.json")
+
+    def path_for(self, name, files, params=()):
+        """Path (without extension) of the cache of artifact `name` built from
+        the input `files` (files that do not exist are ignored) and `params`,
+        a tuple of other inputs with a stable repr."""
+        stats = [(f, os.stat(f)) for f in sorted(set(files)) if os.path.exists(f)]
+        manifest = self._read()
+        hashes, entries = [], dict()
+        for fname, st in stats:
+            filehash = self._lookup(manifest, fname, st)
+            if filehash is None:
+                entries[fname] = self._hash_file(fname, st)
+                filehash = entries[fname][2]
+            hashes.append(filehash)
+
+        digest = sha1(repr((hashes, params)).encode()).hexdigest()[:16]
+        path = os.path.join(self.cachedir, "%s_%s" % (name, digest))
+        if len(entries) > 0 or manifest['artifacts'].get(name) != digest:
+            with self._pending_lock:
+                self._pending[path] = self, name, digest, entries
+        return path
+
+    @classmethod
+    def _built(cls, path):
+        """Records the artifacts whose cache is `path` (with any extension) or
+        contains it, now that it is built"""
+        with cls._pending_lock:
+            done = [cls._pending.pop(base) for base in list(cls._pending)
+                    if path == base or path.startswith((base + ".", base + os.sep))]
+        for manifest, name, digest, entries in done:
+            def record(m):
+                m['files'].update(entries)
+                manifest._set_artifact(m, name, digest)
+            manifest._update(record)
+
+    def _read(self):
+        try:
+            with open(self.path) as fp:
+                return json.load(fp)
+        except (IOError, ValueError):
+            return dict(files=dict(), artifacts=dict())
+
+    def _update(self, func):
+        with lock(self.path):
+            manifest = self._read()
+            func(manifest)
+            with atomic(self.path) as tmpname:
+                with open(tmpname, "w") as fp:
+                    json.dump(manifest, fp, indent=1, sort_keys=True)
+        return manifest
+
+    @staticmethod
+    def _lookup(manifest, fname, st):
+        size, mtime_ns, digest = manifest['files'].get(fname, (None, None, None))
+        if (size, mtime_ns) == (st.st_size, st.st_mtime_ns):
+            return digest
+        return None
+
+    @classmethod
+    def _hash_file(cls, fname, st):
+        """(size, mtime, hash) of the file `fname` with stat `st`, hashed once
+        per process until recorded"""
+        entry = cls._hashes.get(fname)
+        if entry is None or tuple(entry[:2]) != (st.st_size, st.st_mtime_ns):
+            h = sha1()
+            with open(fname, "rb") as fp:
+                for block in iter(lambda: fp.read(2**20), b""):
+                    h.update(block)
+            entry = cls._hashes[fname] = st.st_size, st.st_mtime_ns, h.hexdigest()
+        return entry
+
+    def _set_artifact(self, manifest, name, digest):
+        previous = manifest['artifacts'].get(name)
+        if previous is not None and previous != digest:
+            # the cache in any format or with any extension
+            base = os.path.join(self.cachedir, "%s_%s" % (name, previous))
+            for fname in [base] + glob.glob(glob.escape(base) + ".*"):
+                _remove(fname)
+        manifest['artifacts'][name] = digest
+
+
+def nbytes(obj):
+    """Approximate memory used by the arrays of `obj`: arrays, sparse matrices,
+    mappers, and tuples or lists of these"""
+    if isinstance(obj, np.ndarray):
+        return obj.nbytes
+    if hasattr(obj, "indptr"):
+        return obj.data.nbytes + obj.indices.nbytes + obj.indptr.nbytes
+    if hasattr(obj, "masks"):
+        return nbytes(obj.masks)
+    if isinstance(obj, (tuple, list)):
+        return sum(nbytes(o) for o in obj)
+    return 0
+
+class MemoryCache(object):
+    """Least-recently-used cache of loaded objects, limited to a total of
+    `maxbytes` bytes as measured by `nbytes`.
+
+    Keys are tuples starting with the kind of object and the subject name, for
+    example ('flatmask', 'S1', 1024, mtime), so that `invalidate` can drop all
+    entries sharing a prefix. Cached objects are shared, and must not be
+    modified in place.
+    """
+    def __init__(self, maxbytes):
+        self.maxbytes = maxbytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key, default=None):
+        if key in self._entries:
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return self._entries[key][0]
+        self.misses += 1
+        return default
+
+    def put(self, key, value):
+        size = nbytes(value)
+        self._pop(key)
+        if size > self.maxbytes:
+            return value
+        self._entries[key] = value, size
+        self.nbytes += size
+        while self.nbytes > self.maxbytes:
+            self._pop(next(iter(self._entries)))
+        return value
+
+    def invalidate(self, *prefix):
+        """Remove all entries whose keys start with `prefix`, or all entries
+        if no prefix is given"""
+        n = len(prefix)
+        for key in [k for k in self._entries if k[:n] == prefix]:
+            self._pop(key)
+
+    def clear(self):
+        self.invalidate()
+        self.hits = self.misses = 0
+
+    @property
+    def stats(self):
+        return dict(hits=self.hits, misses=self.misses, entries=len(self._entries),
+                    nbytes=self.nbytes, maxbytes=self.maxbytes)
+
+    def _pop(self, key):
+        if key in self._entries:
+            self.nbytes -= self._entries.pop(key)[1]
+
+def _get_memory_budget():
+    if config.has_option("basic", "memory_cache"):
+        return int(config.getfloat("basic", "memory_cache") * 2**20)
+    return 1024 * 2**20
+
+memory = MemoryCache(_get_memory_budget())
+
+def mtime(path):
+    """Modification time of the cache `path` in any format (or of the file
+    `path`), or None if it does not exist"""
+    fname = path if os.path.exists(path) else find(path)
+    return None if fname is None else os.stat(fname).st_mtime
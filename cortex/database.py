@@ -4,6 +4,7 @@ Contains a singleton object `db` of type `Database` which allows easy access to
 import copy
 import functools
 import glob
+import inspect
 import json
 import os
 import re
@@ -21,18 +22,52 @@ default_filestore = options.config.get('basic', 'filestore')
 
 
 def _memo(fn):
+    """Memoize a Database method returning arrays, or tuples and lists of arrays.
+
+    Results are kept in `cache.memory`, the process-wide cache of loaded
+    arrays whose size is bounded by the `memory_cache` option, under keys
+    starting with the method name followed by all its arguments (with
+    defaults filled in), e.g. ('get_surf', 'S1', 'flat', 'both', True, True,
+    filestore).
+
+    Results are shared and handed out as read-only views, without copying.
+    Call the method with ``copy=True`` to get writeable copies instead.
+    """
+    signature = inspect.signature(fn)
+
     @functools.wraps(fn)
-    def memofn(self, *args, **kwargs):
-        if not hasattr(self, "_memocache"):
-            setattr(self, "_memocache", dict())
-        #h = sha1(str((id(fn), args, kwargs))).hexdigest()
-        h = str((id(fn), args, kwargs))
-        if h not in self._memocache:
-            self._memocache[h] = fn(self, *args, **kwargs)
-        return copy.deepcopy(self._memocache[h])
+    def memofn(self, *args, copy=False, **kwargs):
+        from . import cache
+        bound = signature.bind(self, *args, **kwargs)
+        bound.apply_defaults()
+        key = (fn.__name__,) + tuple(bound.arguments.values())[1:] + (self.filestore,)
+        value = cache.memory.get(key)
+        if value is None:
+            value = cache.memory.put(key, _readonly(fn(self, *args, **kwargs)))
+        if copy:
+            return _copy(value)
+        return _readonly(value)
 
     return memofn
 
+def _readonly(value):
+    """Read-only views of the arrays in `value`, and of nested tuples and lists"""
+    if isinstance(value, np.ndarray):
+        view = value.view()
+        view.flags.writeable = False
+        return view
+    if isinstance(value, (tuple, list)):
+        return type(value)(_readonly(v) for v in value)
+    return value
+
+def _copy(value):
+    """Writeable copies of the arrays in `value`, and of nested tuples and lists"""
+    if isinstance(value, np.ndarray):
+        return value.copy()
+    if isinstance(value, (tuple, list)):
+        return type(value)(_copy(v) for v in value)
+    return copy.deepcopy(value)
+
 class SubjectDB(object):
     def __init__(self, subj, filestore=default_filestore):
         self.subject = subj
@@ -154,6 +189,8 @@ class Database(object):
         self.filestore = filestore
         self._subjects = None
         self.auxfile = None
+        self._converting = dict()
+        self._xfm_digests = dict()
     
     def __repr__(self):
         subjs = "\n   ".join(sorted(self.subjects.keys()))
@@ -211,10 +248,13 @@ class Database(object):
         anatform = self.get_paths(subject)['anats']
         anatfile = anatform.format(type=type, opts=opts, ext="nii.gz")
 
-        if not os.path.exists(anatfile) or recache:
-            print("Generating %s anatomical..."%type)
-            from . import anat
-            getattr(anat, type)(anatfile, subject, **kwargs)
+        from . import cache
+        with cache.building(anatfile, recache) as stale:
+            if stale:
+                print("Generating %s anatomical..."%type)
+                from . import anat
+                with cache.atomic(anatfile) as tmpfile:
+                    getattr(anat, type)(tmpfile, subject, **kwargs)
 
         import nibabel
         anatnib = nibabel.load(anatfile)
@@ -264,10 +304,13 @@ class Database(object):
             if not os.path.exists(os.path.join(self.filestore, subject, "surface-info")):
                 os.makedirs(os.path.join(self.filestore, subject, "surface-info"))
 
-        if not os.path.exists(surfifile) or recache:
-            print ("Generating %s surface info..."%type)
-            from . import surfinfo
-            getattr(surfinfo, type)(surfifile, subject, **kwargs)
+        from . import cache
+        with cache.building(surfifile, recache) as stale:
+            if stale:
+                print ("Generating %s surface info..."%type)
+                from . import surfinfo
+                with cache.atomic(surfifile) as tmpfile:
+                    getattr(surfinfo, type)(tmpfile, subject, **kwargs)
 
         npz = np.load(surfifile)
         if "left" in npz and "right" in npz:
@@ -370,6 +413,7 @@ class Database(object):
 
         if overlay_file is None:
             overlay_file = paths['overlays']
+        kwargs.setdefault('cachedir', self.get_cache(subject))
         return svgoverlay.get_overlay(subject, overlay_file, pts, polys, **kwargs)
     
     def save_xfm(self, subject, name, xfm, xfmtype="magnet", reference=None):
@@ -480,6 +524,9 @@ class Database(object):
         nudge : bool
             Nudge the hemispheres apart from each other, for overlapping surfaces
             (inflated, etc)
+        copy : bool
+            Return writeable copies of the arrays. By default, the arrays are
+            read-only views of the surfaces cached in memory.
 
         Returns
         -------
@@ -498,8 +545,11 @@ class Database(object):
         if hemisphere.lower() == "both":
             left, right = [ self.get_surf(subject, type, hemisphere=h) for h in ["lh", "rh"]]
             if type != "fiducial" and nudge:
-                left[0][:,0] -= left[0].max(0)[0]
-                right[0][:,0] -= right[0].min(0)[0]
+                # the memoized surfaces are read-only, nudge copies of the points
+                lpts, rpts = left[0].copy(), right[0].copy()
+                lpts[:,0] -= lpts.max(0)[0]
+                rpts[:,0] -= rpts.min(0)[0]
+                left, right = (lpts,) + tuple(left[1:]), (rpts,) + tuple(right[1:])
             
             if merge:
                 pts   = np.vstack([left[0], right[0]])
@@ -519,6 +569,10 @@ class Database(object):
             ppts, _     = self.get_surf(subject, 'pia', hemi)
             return (wpts + ppts) / 2, polys
 
+        if options.config.has_option('basic', 'convert_surfaces') and \
+                options.config.getboolean('basic', 'convert_surfaces'):
+            self.convert_surfaces(subject, background=True)
+
         try:
             from . import formats
             fnm = str(os.path.splitext(files[type][hemi])[0])
@@ -526,6 +580,51 @@ class Database(object):
         except KeyError:
             raise IOError
 
+    def convert_surfaces(self, subject=None, background=False, force=False):
+        """Convert the surfaces of a subject to the binary surface format of
+        `cortex.formats`, which loads much faster than GIfTI by memory-mapping
+        the files. The original surface files are kept, and `get_surf` uses
+        the binary copies from then on, unless the original files are newer.
+
+        Set the `convert_surfaces` option in the [basic] section of the config
+        to convert the surfaces of every subject in the background the first
+        time they are loaded.
+
+        Parameters
+        ----------
+        subject : str, optional
+            Name of the subject. Converts the surfaces of all subjects if None.
+        background : bool
+            Convert in a background thread instead of blocking
+        force : bool
+            Convert surfaces that are already up to date as well
+
+        Returns
+        -------
+        thread : threading.Thread or None
+            The thread converting the surfaces if `background` is True
+        """
+        from . import formats
+        subjects = sorted(self.subjects) if subject is None else [subject]
+        if background:
+            import threading
+            thread = self._converting.get(subject)
+            if thread is None or force:
+                thread = threading.Thread(target=self.convert_surfaces,
+                                          kwargs=dict(subject=subject, force=force))
+                thread.daemon = True
+                self._converting[subject] = thread
+                thread.start()
+            return thread
+
+        for subj in subjects:
+            for surf in self.get_paths(subj)['surfs'].values():
+                for path in surf.values():
+                    try:
+                        formats.convert_bsf(os.path.splitext(path)[0], force=force)
+                    except (IOError, ValueError) as e:
+                        warnings.warn("Could not convert surface %s: %s" % (path, e))
+
     def save_mask(self, subject, xfmname, type, mask):
         fname = self.get_paths(subject)['masks'].format(xfmname=xfmname, type=type)
         if os.path.exists(fname):
@@ -537,7 +636,9 @@ class Database(object):
             raise ValueError("Invalid mask shape: must match shape of reference image")
         affine = xfm.reference.affine
         nib = nibabel.Nifti1Image(mask.astype(np.uint8).T, affine)
-        nib.to_filename(fname)
+        from . import cache
+        with cache.atomic(fname) as tmpfile:
+            nib.to_filename(tmpfile)
 
     def get_mask(self, subject, xfmname, type='thick'):
         if hasattr(type, 'decode'):
@@ -548,17 +649,19 @@ class Database(object):
         except (AttributeError, IOError):
             pass
 
+        from . import cache
         fname = self.get_paths(subject)['masks'].format(xfmname=xfmname, type=type)
-        try:
-            import nibabel
-            nib = nibabel.load(fname)
-            return nib.get_fdata().T != 0
-        except IOError:
-            print('Mask not found, generating...')
-            from .utils import get_cortical_mask
-            mask = get_cortical_mask(subject, xfmname, type)
-            self.save_mask(subject, xfmname, type, mask)
-            return mask
+        with cache.building(fname) as stale:
+            if stale:
+                print('Mask not found, generating...')
+                from .utils import get_cortical_mask
+                mask = get_cortical_mask(subject, xfmname, type)
+                self.save_mask(subject, xfmname, type, mask)
+                return mask
+
+        import nibabel
+        nib = nibabel.load(fname)
+        return nib.get_fdata().T != 0
 
     def get_shared_voxels(self, subject, xfmname, hemi="both", merge=True, use_astar=True, recache=False):
         """Get an array indicating which vertices are inappropriately mapped to the same voxel.
@@ -575,16 +678,22 @@ class Database(object):
         except (AttributeError, IOError):
             pass
         # Proceed w/ potential load
-        shared_voxel_file = os.path.join(self.get_cache(subject), 'shared_vertices_{xfmname}_{hemi}.npy'.format(xfmname=xfmname, hemi=hemi))
-        if not os.path.exists(shared_voxel_file) or recache:
-            print('Shared voxel array not found, generating...')
-            from .utils import get_shared_voxels as _get_shared_voxels
-            voxels = _get_shared_voxels(subject, xfmname, hemi=hemi, merge=merge, use_astar=use_astar)
-            np.save(shared_voxel_file, voxels)
-            return voxels
-        else:
-            voxels = np.load(shared_voxel_file)
-            return voxels
+        from . import cache
+        # named after the contents of the surfaces and transform, see get_cache_path
+        shared_voxel_file = self.get_cache_path(subject, 'shared_vertices_%s_%s' % (xfmname, hemi),
+                                                surfaces=['fiducial', 'wm', 'pia'],
+                                                xfmname=xfmname) + '.npy'
+        with cache.building(shared_voxel_file, recache) as stale:
+            if stale:
+                print('Shared voxel array not found, generating...')
+                from .utils import get_shared_voxels as _get_shared_voxels
+                voxels = _get_shared_voxels(subject, xfmname, hemi=hemi, merge=merge, use_astar=use_astar)
+                with cache.atomic(shared_voxel_file) as tmpfile:
+                    np.save(tmpfile, voxels)
+                return voxels
+            else:
+                voxels = np.load(shared_voxel_file)
+                return voxels
 
     def get_coords(self, subject, xfmname, hemisphere="both", magnet=None):
         """Calculate the coordinates of each vertex in the epi space by transforming the fiducial to the coordinate space
@@ -637,6 +746,72 @@ class Database(object):
             os.makedirs(cachedir)
         return cachedir
 
+    def get_cache_path(self, subject, name, surfaces=(), xfmname=None, files=()):
+        """Path (without extension) of a cache of the subject, named after a
+        digest of the contents of its inputs, see `cortex.cache.Manifest`.
+
+        Parameters
+        ----------
+        subject : str
+            Name of the subject
+        name : str
+            Name of the cache, including all its parameters, e.g.
+            "flatmask_1024"
+        surfaces : list of str
+            Types of the surfaces the cache is built from. "fiducial" stands
+            for the white matter and pial surfaces if there is no fiducial
+            surface file.
+        xfmname : str, optional
+            Name of the transform the cache is built from. Only the coord
+            matrix and the shape and affine of the reference are compared, so
+            saving the same transform again keeps the caches.
+        files : list of str
+            Other files the cache is built from
+
+        Returns
+        -------
+        path : str
+            Path of the cache, which changes whenever one of the inputs does
+        """
+        from . import cache
+        files = list(files)
+        params = ()
+        if subject not in self.subjects:
+            # packed subjects have no files in the filestore
+            return cache.Manifest(self.get_cache(subject)).path_for(name, files, params)
+
+        if len(surfaces) > 0:
+            surfs = self.get_paths(subject)['surfs']
+            for surf in surfaces:
+                if surf == "fiducial" and surf not in surfs:
+                    types = ["wm", "pia"]
+                else:
+                    types = [surf]
+                for hemis in [surfs.get(t, dict()) for t in types]:
+                    files.extend(hemis.values())
+        if xfmname == "identity":
+            files.append(self.get_paths(subject)['anats'].format(type="raw", opts="", ext="nii.gz"))
+        elif xfmname is not None:
+            params = (self._get_xfm_digest(subject, xfmname),)
+        return cache.Manifest(self.get_cache(subject)).path_for(name, files, params)
+
+    def _get_xfm_digest(self, subject, xfmname):
+        """Digest of the coord matrix of a transform, and of the shape and
+        affine of its reference"""
+        path = os.path.join(self.filestore, subject, "transforms", xfmname)
+        fname, reference = os.path.join(path, "matrices.xfm"), os.path.join(path, "reference.nii.gz")
+        key = (path, os.stat(fname).st_mtime_ns, os.stat(reference).st_mtime_ns)
+        if key not in self._xfm_digests:
+            import nibabel
+            with open(fname) as fp:
+                coord = np.array(json.load(fp)['coord'], dtype=float)
+            nib = nibabel.load(reference)
+            h = sha1(coord.tobytes())
+            h.update(repr(nib.shape[:3]).encode())
+            h.update(np.asarray(nib.affine, dtype=float).tobytes())
+            self._xfm_digests[key] = h.hexdigest()[:16]
+        return self._xfm_digests[key]
+
     def clear_cache(self, subject, clear_all_caches=True):
         """Clears config-specified and default file caches for a subject.
         
@@ -667,14 +842,18 @@ class Database(object):
             warnings.warn(self.subjects[subject]._warning)
 
         surfs = dict()
-        for surf in os.listdir(surfpath):
+        for surf in sorted(os.listdir(surfpath)):
+            if surf.startswith('.'):
+                continue
             ssurf = os.path.splitext(surf)[0].split('_')
             name = '_'.join(ssurf[:-1])
             hemi = ssurf[-1]
 
             if name not in surfs:
                 surfs[name] = dict()
-            surfs[name][hemi] = os.path.abspath(os.path.join(surfpath,surf))
+            # binary surfaces are converted copies, point to the original file
+            if hemi not in surfs[name] or surfs[name][hemi].endswith('.bsf'):
+                surfs[name][hemi] = os.path.abspath(os.path.join(surfpath,surf))
 
         viewsdir = os.path.join(self.filestore, subject, "views")
         if not os.path.exists(viewsdir):
@@ -60,6 +60,180 @@ def HSV2RGB(color):
     return (int(r * 255), int(g * 255), int(b * 255))
 
 
+def rgb_to_hsv(rgb, out=None):
+    """
+    Vectorized version of `colorsys.rgb_to_hsv`
+
+    Parameters
+    ----------
+    rgb : ndarray
+        Array of RGB values on [0, 1], with the channels on the last axis
+    out : ndarray, optional
+        Array of the same shape as `rgb` to write the result into. Can be `rgb`
+        itself.
+
+    Returns
+    -------
+    ndarray
+        HSV values on [0, 1], with the channels on the last axis
+    """
+    r, g, b = rgb[..., 0], rgb[..., 1], rgb[..., 2]
+    maxc = np.maximum(np.maximum(r, g), b)
+    minc = np.minimum(np.minimum(r, g), b)
+    delta = maxc - minc
+    gray = delta == 0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        saturation = np.where(gray, 0, delta / np.where(maxc == 0, 1, maxc))
+        delta = np.where(gray, 1, delta)
+        rc, gc, bc = (maxc - r) / delta, (maxc - g) / delta, (maxc - b) / delta
+    hue = np.where(r == maxc, bc - gc, np.where(g == maxc, 2.0 + rc - bc, 4.0 + gc - rc))
+    hue = np.where(gray, 0, (hue / 6.0) % 1.0)
+
+    if out is None:
+        out = np.empty(rgb.shape, dtype=np.result_type(rgb.dtype, np.float32))
+    out[..., 0] = hue
+    out[..., 1] = saturation
+    out[..., 2] = maxc
+    return out
+
+
+def hsv_to_rgb(hsv, out=None):
+    """
+    Vectorized version of `colorsys.hsv_to_rgb`
+
+    Parameters
+    ----------
+    hsv : ndarray
+        Array of HSV values on [0, 1], with the channels on the last axis
+    out : ndarray, optional
+        Array of the same shape as `hsv` to write the result into. Can be `hsv`
+        itself.
+
+    Returns
+    -------
+    ndarray
+        RGB values on [0, 1], with the channels on the last axis
+    """
+    h, s, v = hsv[..., 0], hsv[..., 1], hsv[..., 2]
+    i = (h * 6.0).astype(int)
+    f = h * 6.0 - i
+    p = v * (1.0 - s)
+    q = v * (1.0 - s * f)
+    t = v * (1.0 - s * (1.0 - f))
+    i %= 6
+    choices = [(v, t, p), (q, v, p), (p, v, t), (p, q, v), (t, p, v), (v, p, q)]
+    conditions = [i == k for k in range(6)]
+    r, g, b = [np.select(conditions, [c[k] for c in choices]) for k in range(3)]
+
+    if out is None:
+        out = np.empty(hsv.shape, dtype=np.result_type(hsv.dtype, np.float32))
+    out[..., 0] = r
+    out[..., 1] = g
+    out[..., 2] = b
+    return out
+
+
+def mix_colors(channels, colors, value_max=1.0, saturation_max=1.0, out=None,
+               dtype=np.float64, blocksize=2**18):
+    """
+    Mixes data channels into 8-bit RGB colors
+
+    Each of the data channels, scaled to [0, 1], weights one of the `colors`,
+    and the weighted colors are averaged. If `value_max` or `saturation_max`
+    are not 1, the HSV value and saturation of the averaged colors are then
+    divided by these and clipped to 1, brightening and saturating the colors.
+    This is done in blocks of `blocksize` elements at a time, for data of any
+    shape.
+
+    Parameters
+    ----------
+    channels : sequence of ndarray
+        Data channels on [0, 1], all of the same shape
+    colors : sequence of tuple<uint8, uint8, uint8>
+        RGB color for each data channel
+    value_max : float, optional
+        Maximum HSV value for the colors
+    saturation_max : float, optional
+        Maximum HSV saturation for the colors
+    out : ndarray, optional
+        uint8 array of shape channels[0].shape + (3,) or (4,) for RGB or RGBA
+        colors. The colors are written into the first three channels.
+    dtype : dtype, optional
+        Floating point type used for the computations. float32 is faster and
+        uses half the memory, but may differ by one from the float64 result.
+    blocksize : int, optional
+        Number of elements processed at once
+
+    Returns
+    -------
+    out : ndarray
+        uint8 array of RGB or RGBA colors, with the channels on the last axis
+    """
+    channels = [np.asarray(c) for c in channels]
+    shape = channels[0].shape
+    if out is None:
+        out = np.empty(shape + (3,), dtype=np.uint8)
+    colors = np.array(colors, dtype=dtype)
+    adjust = (value_max != 1.0) or (saturation_max != 1.0)
+
+    # blocks along the first axis, so that slices of `out` are always views
+    rows = max(1, blocksize // max(1, int(np.prod(shape[1:]))))
+    for start in range(0, shape[0], rows):
+        block = np.stack([c[start:start+rows] for c in channels], axis=-1).astype(dtype)
+        color = block.dot(colors)
+        color /= 3.0
+        if adjust:
+            color /= 255.0
+            hsv = rgb_to_hsv(color, out=color)
+            # hue is truncated to integer degrees, as done by RGB2HSV
+            hsv[..., 0] = np.floor(hsv[..., 0] * 360) / 360.0
+            hsv[..., 1] /= saturation_max
+            hsv[..., 2] /= value_max
+            np.minimum(hsv[..., 1:], 1.0, out=hsv[..., 1:])
+            color = hsv_to_rgb(hsv, out=hsv)
+            color *= 255
+        np.copyto(out[start:start+rows, ..., :3], color, casting='unsafe')
+    return out
+
+
+def _to_uint8(data, vmin, vmax, out, buf=None):
+    """Scales data to [0, 255] as described in VolumeRGB.volume and writes it
+    into the uint8 array `out`, using the float32 array `buf` as scratch space"""
+    if data.dtype == np.uint8:
+        out[...] = data
+        return out
+
+    if buf is None:
+        buf = np.empty(data.shape, dtype=np.float32)
+    np.copyto(buf, data, casting='unsafe')
+    if vmin is None:
+        if buf.min() < 0:
+            buf -= buf.min()
+    else:
+        buf -= vmin
+
+    if vmax is None:
+        if buf.max() > 1:
+            buf /= buf.max()
+    else:
+        buf /= vmax - vmin
+
+    np.clip(buf, 0, 1, out=buf)
+    buf *= 255
+    np.copyto(out, buf, casting='unsafe')
+    return out
+
+
+def _stack_uint8(dataviews, shape, attr):
+    """uint8 array of shape + (len(dataviews),) with the scaled data of each
+    dataview in one channel"""
+    out = np.empty(tuple(shape) + (len(dataviews),), dtype=np.uint8)
+    buf = np.empty(shape, dtype=np.float32)
+    for i, dv in enumerate(dataviews):
+        _to_uint8(getattr(dv, attr), dv.vmin, dv.vmax, out[..., i], buf)
+    return out
+
+
 class DataviewRGB(Dataview):
     """Abstract base class for RGB data views.
     """
@@ -293,28 +467,8 @@ class VolumeRGB(DataviewRGB):
         """5-dimensional volume (t, z, y, x, rgba) with data that has been mapped
         into 8-bit unsigned integers that correspond to colors.
         """
-        volume = []
-        for dv in (self.red, self.green, self.blue, self.alpha):
-            if dv.volume.dtype != np.uint8:
-                vol = dv.volume.astype("float32", copy=True)
-                if dv.vmin is None:
-                    if vol.min() < 0:
-                        vol -= vol.min()
-                else:
-                    vol -= dv.vmin
-
-                if dv.vmax is None:
-                    if vol.max() > 1:
-                        vol /= vol.max()
-                else:
-                    vol /= dv.vmax - dv.vmin
-
-                vol = (np.clip(vol, 0, 1) * 255).astype(np.uint8)
-            else:
-                vol = dv.volume.copy()
-            volume.append(vol)
-
-        return np.array(volume).transpose([1, 2, 3, 4, 0])
+        channels = (self.red, self.green, self.blue, self.alpha)
+        return _stack_uint8(channels, self.red.volume.shape, 'volume')
 
     def __repr__(self):
         return "<RGB volumetric data for (%s, %s)>"%(self.red.subject, self.red.xfmname)
@@ -442,28 +596,17 @@ class VolumeRGB(DataviewRGB):
             _, _, value = RGB2HSV(averageColor)
             value_max = value
 
-        red = np.zeros_like(data1, np.uint8)
-        green = np.zeros_like(data1, np.uint8)
-        blue = np.zeros_like(data1, np.uint8)
-        for i in range(data1.size):
-            this_color = data1.flat[i] * channel1color + data2.flat[i] * channel2color + data3.flat[i] * channel3Color
-            this_color /= 3.0
-            if (value_max != 1.0) or (saturation_max != 1.0):
-                hue, saturation, value = RGB2HSV(this_color)
-                saturation /= saturation_max
-                value /= value_max
-                if saturation > 1:
-                    saturation = 1.0
-                if value > 1:
-                    value = 1.0
-                this_color = HSV2RGB([hue, saturation, value])
-            red.flat[i] = this_color[0]
-            green.flat[i] = this_color[1]
-            blue.flat[i] = this_color[2]
+        # write all channels into one buffer, each channel is contiguous
+        rgba = np.empty((4,) + data1.shape, dtype=np.uint8)
+        mix_colors([data1, data2, data3], [channel1color, channel2color, channel3Color],
+                   value_max=value_max, saturation_max=saturation_max,
+                   out=np.moveaxis(rgba, 0, -1))
+        red, green, blue = rgba[0], rgba[1], rgba[2]
 
         # Now make an alpha volume
         if alpha is None:
-            alpha = np.ones_like(red, np.uint8) * 255
+            alpha = rgba[3]
+            alpha[:] = 255
         alpha[mask] = 0
 
         return red, green, blue, alpha
@@ -563,27 +706,8 @@ class VertexRGB(DataviewRGB):
         """3-dimensional volume (t, v, rgba) with data that has been mapped
         into 8-bit unsigned integers that correspond to colors.
         """
-        verts = []
-        for dv in (self.red, self.green, self.blue, self.alpha):
-            if dv.vertices.dtype != np.uint8:
-                vert = dv.vertices.astype("float32", copy=True)
-                if dv.vmin is None:
-                    if vert.min() < 0:
-                        vert -= vert.min()
-                else:
-                    vert -= dv.vmin
-
-                if dv.vmax is None:
-                    if vert.max() > 1:
-                        vert /= vert.max()
-                else:
-                    vert /= dv.vmax - dv.vmin
-
-                vert = (np.clip(vert, 0, 1) * 255).astype(np.uint8)
-            else:
-                vert = dv.vertices.copy()
-            verts.append(vert)
-        return np.array(verts).transpose([1, 2, 0])
+        channels = (self.red, self.green, self.blue, self.alpha)
+        return _stack_uint8(channels, self.red.vertices.shape, 'vertices')
 
     def to_json(self, simple=False):
         sdict = super(VertexRGB, self).to_json(simple=simple)
@@ -16,15 +16,119 @@ np.import_array()
 PY3 = sys.version_info[0] > 3
 
 
-def read(globname):
-    readers = OrderedDict([('gii', read_gii), ('npz', read_npz), ('vtk', read_vtk), ('off', read_off), ('stl', read_stl)])
-    for ext, func in readers.items():
+# Native binary surface format (.bsf): a 32 byte header followed by the raw
+# little-endian points and polygons, which are memory-mapped when loaded
+BSF_MAGIC = b'PYCXSURF'
+BSF_VERSION = 1
+_bsf_header = struct.Struct('<8sI2s2sQQ')
+_bsf_dtypes = dict(f4=np.float32, f8=np.float64, i4=np.int32, u4=np.uint32, i8=np.int64)
+
+def _get_readers():
+    return OrderedDict([('gii', read_gii), ('npz', read_npz), ('vtk', read_vtk), ('off', read_off), ('stl', read_stl)])
+
+def _newest_source(globname):
+    """mtime of the most recent file of the surface `globname` in a format other than bsf"""
+    mtimes = [os.stat(globname+"."+ext).st_mtime for ext in _get_readers()
+              if os.path.exists(globname+"."+ext)]
+    return max(mtimes) if len(mtimes) > 0 else None
+
+def read(globname, bsf=True):
+    """Read the surface `globname` (without extension) in the first format found.
+
+    The binary surface format is tried first, unless `bsf` is False or the
+    .bsf file is older than the surface in another format, e.g. after it was
+    re-imported.
+    """
+    if bsf and os.path.exists(globname+".bsf"):
+        source = _newest_source(globname)
+        if source is None or os.stat(globname+".bsf").st_mtime > source:
+            return read_bsf(globname+".bsf")
+
+    for ext, func in _get_readers().items():
         try:
             return func(globname+"."+ext)
         except IOError:
             pass
     raise IOError('No such surface file')
 
+def read_bsf(filename):
+    """Read a surface in the binary surface format. The points and polygons are
+    read-only arrays memory-mapped from the file."""
+    with open(filename, 'rb') as fp:
+        header = fp.read(_bsf_header.size)
+    if len(header) < _bsf_header.size:
+        raise ValueError('Not a binary surface file')
+    magic, version, ptype, ftype, npts, npolys = _bsf_header.unpack(header)
+    if magic != BSF_MAGIC:
+        raise ValueError('Not a binary surface file')
+    if version != BSF_VERSION:
+        raise ValueError('Unsupported binary surface file version %d' % version)
+
+    ptype = np.dtype(_bsf_dtypes[ptype.decode()]).newbyteorder('<')
+    ftype = np.dtype(_bsf_dtypes[ftype.decode()]).newbyteorder('<')
+    offset = _bsf_header.size
+    pts = _memmap(filename, ptype, offset, (npts, 3))
+    offset += _bsf_padded(npts * 3 * ptype.itemsize)
+    polys = _memmap(filename, ftype, offset, (npolys, 3))
+    return pts, polys
+
+def _bsf_padded(nbytes):
+    # align the polygons on 16 bytes
+    return -(-nbytes // 16) * 16
+
+def _memmap(filename, dtype, offset, shape):
+    if shape[0] == 0:
+        return np.zeros(shape, dtype=dtype)
+    return np.memmap(filename, dtype=dtype, mode='r', offset=offset, shape=shape).view(np.ndarray)
+
+def write_bsf(filename, object pts, object polys):
+    """Write a surface in the binary surface format. The file is written to a
+    temporary file first and then renamed, so that readers never see a partial
+    file."""
+    import threading
+    pts, polys = np.asarray(pts), np.asarray(polys)
+    if pts.dtype not in (np.float32, np.float64):
+        pts = pts.astype(np.float64)
+    if polys.dtype not in (np.int32, np.uint32, np.int64):
+        polys = polys.astype(np.int64)
+    pts = np.ascontiguousarray(pts, dtype=pts.dtype.newbyteorder('<')).reshape(-1, 3)
+    polys = np.ascontiguousarray(polys, dtype=polys.dtype.newbyteorder('<')).reshape(-1, 3)
+
+    header = _bsf_header.pack(BSF_MAGIC, BSF_VERSION, pts.dtype.str[1:].encode(),
+                              polys.dtype.str[1:].encode(), len(pts), len(polys))
+    dirname, basename = os.path.split(os.path.abspath(filename))
+    tmpname = os.path.join(dirname, ".%s.%d.%d.tmp" % (basename, os.getpid(), threading.get_ident()))
+    try:
+        with open(tmpname, 'wb') as fp:
+            fp.write(header)
+            fp.write(pts.tobytes())
+            fp.write(b'\0' * (_bsf_padded(pts.nbytes) - pts.nbytes))
+            fp.write(polys.tobytes())
+        os.replace(tmpname, filename)
+    except BaseException:
+        if os.path.exists(tmpname):
+            os.unlink(tmpname)
+        raise
+
+def convert_bsf(globname, force=False):
+    """Convert the surface `globname` (without extension) to the binary surface
+    format, unless an up-to-date .bsf file already exists or `force` is True.
+
+    Returns
+    -------
+    filename : str or None
+        Path of the written .bsf file, or None if nothing was converted
+    """
+    source = _newest_source(globname)
+    if source is None:
+        raise IOError('No such surface file')
+    if not force and os.path.exists(globname+".bsf") and \
+            os.stat(globname+".bsf").st_mtime > source:
+        return None
+    pts, polys = read(globname, bsf=False)
+    write_bsf(globname+".bsf", pts, polys)
+    return globname+".bsf"
+
 def read_off(filename):
     pts, polys = [], []
     with open(filename) as fp:
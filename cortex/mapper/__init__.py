@@ -1,5 +1,3 @@
-import os
-
 import numpy as np
 
 from .. import dataset
@@ -20,6 +18,7 @@ def get_mapper(subject, xfmname, type='nearest', recache=False, **kwargs):
         const_patch_lanczos=patch.ConstPatchLanczos,
         line_nearest=line.LineNN,
         line_trilinear=line.LineTrilin,
+        line_gaussian=line.LineGauss,
         line_lanczos=line.LineLanczos)
     Map = mapcls[type]
     ptype = Map.__name__.lower()
@@ -27,14 +26,26 @@ def get_mapper(subject, xfmname, type='nearest', recache=False, **kwargs):
     if len(kwds) > 0:
         ptype += '_'+kwds
 
-    fname = "{xfmname}_{projection}.npz".format(xfmname=xfmname, projection=ptype)
-
-    xfmfile = db.get_paths(subject)['xfmdir'].format(xfmname=xfmname)
-    cachefile = os.path.join(db.get_cache(subject), fname)
-
-    try:
-        if not recache and (xfmname == "identity" or os.stat(cachefile).st_mtime > os.stat(xfmfile).st_mtime):
-            return Map.from_cache(cachefile, subject, xfmname)
-        raise Exception
-    except Exception:
-        return Map._cache(cachefile, subject, xfmname, **kwargs)
+    from .. import cache
+    fname = "{xfmname}_{projection}".format(xfmname=xfmname, projection=ptype)
+
+    # named after the contents of the surfaces and transform, so that the
+    # mapper is rebuilt whenever they change
+    cachefile = db.get_cache_path(subject, fname, surfaces=["fiducial", "wm", "pia", "flat"],
+                                  xfmname=xfmname)
+    cachefile = cache.find(cachefile) or cachefile
+
+    # loaded mappers are kept in memory, keyed by the time the cache was written
+    key = ('mapper', subject, xfmname, ptype)
+    with cache.building(cachefile, recache) as stale:
+        if stale:
+            cache.memory.invalidate(*key)
+            mapper = Map._cache(cachefile, subject, xfmname, **kwargs)
+            return cache.memory.put(key + (cache.mtime(cachefile),), mapper)
+
+    mapper = cache.memory.get(key + (cache.mtime(cachefile),))
+    if mapper is None:
+        cachefile = cache.find(cachefile)
+        mapper = Map.from_cache(cachefile, subject, xfmname)
+        cache.memory.put(key + (cache.mtime(cachefile),), mapper)
+    return mapper
@@ -18,12 +18,13 @@ class Mapper(object):
 
     @classmethod
     def from_cache(cls, cachefile, subject, xfmname):
-        npz = np.load(cachefile)
-        left = (npz['left_data'], npz['left_indices'], npz['left_indptr'])
-        right = (npz['right_data'], npz['right_indices'], npz['right_indptr'])
-        lsparse = sparse.csr_matrix(left, shape=npz['left_shape'])
-        rsparse = sparse.csr_matrix(right, shape=npz['right_shape'])
-        return cls(lsparse, rsparse, npz['shape'], subject, xfmname)
+        from .. import cache
+        arrays = cache.load(cachefile)
+        left = (arrays['left_data'], arrays['left_indices'], arrays['left_indptr'])
+        right = (arrays['right_data'], arrays['right_indices'], arrays['right_indptr'])
+        lsparse = sparse.csr_matrix(left, shape=tuple(arrays['left_shape']))
+        rsparse = sparse.csr_matrix(right, shape=tuple(arrays['right_shape']))
+        return cls(lsparse, rsparse, np.array(arrays['shape']), subject, xfmname)
 
     @property
     def mask(self):
@@ -59,6 +60,12 @@ class Mapper(object):
 
         volume = np.ascontiguousarray(data.volume)
         volume.shape = len(volume), -1
+
+        return dataset.Vertex(self._project(volume).squeeze(), data.subject)
+
+    def _project(self, volume):
+        """Project a (t, voxels) array onto both hemispheres, returning a
+        (t, vertices) array"""
         volume = volume.T
 
         mapped = []
@@ -69,7 +76,80 @@ class Mapper(object):
             mapped[0] = mapped[0][:, self.idxmap[0]]
             mapped[1] = mapped[1][:, self.idxmap[1]]
 
-        return dataset.Vertex(np.hstack(mapped).squeeze(), data.subject)
+        return np.hstack(mapped)
+
+    @property
+    def nverts_out(self):
+        """Number of vertices in the projected data, after applying idxmap"""
+        if self.idxmap is not None:
+            return len(self.idxmap[0]) + len(self.idxmap[1])
+        return self.nverts
+
+    def iter_chunks(self, data, chunksize=64):
+        """Project a 4D volume onto the surface a few timepoints at a time.
+
+        Only `chunksize` timepoints of voxel data are ever held in memory, so
+        this can be used on runs that do not fit in RAM when fully loaded.
+
+        Parameters
+        ----------
+        data : Volume, ndarray, str, or iterable
+            The data to project. Can be a Volume object, a (t, z, y, x) or
+            (t, voxels) array (including np.memmap and h5py datasets), the
+            path to a 4D NIfTI file (which will be memory-mapped), or an
+            iterable yielding (t, z, y, x) or (z, y, x) chunks.
+        chunksize : int, optional
+            Number of timepoints to project at once. Defaults to 64.
+
+        Yields
+        ------
+        start : int
+            Index of the first timepoint in this chunk
+        mapped : (t, vertices) ndarray
+            Vertex time series for this chunk
+        """
+        start = 0
+        for chunk in _iter_volume_chunks(data, chunksize):
+            chunk = np.asarray(chunk).reshape(len(chunk), -1)
+            yield start, self._project(chunk)
+            start += len(chunk)
+
+    def map_chunked(self, data, out=None, chunksize=64):
+        """Project a 4D volume onto the surface chunk by chunk, writing the
+        vertex time series into a preallocated output.
+
+        Peak memory is bounded by `chunksize` timepoints of voxel data plus
+        the output array. Pass an np.memmap as `out` to also keep the output
+        on disk.
+
+        Parameters
+        ----------
+        data : Volume, ndarray, str, or iterable
+            The data to project, see `iter_chunks`.
+        out : (t, vertices) ndarray, optional
+            Output array. If None, a float64 array is allocated; this requires
+            that the number of timepoints in `data` can be determined.
+        chunksize : int, optional
+            Number of timepoints to project at once. Defaults to 64.
+
+        Returns
+        -------
+        out : (t, vertices) ndarray
+            Vertex time series for all timepoints
+        """
+        if out is None:
+            ntimes = _get_ntimes(data)
+            if ntimes is None:
+                raise ValueError("Cannot determine the number of timepoints, "
+                                 "please provide a preallocated output")
+            out = np.empty((ntimes, self.nverts_out))
+        elif out.shape[-1] != self.nverts_out:
+            raise ValueError("Output has %d vertices, mapper has %d" % (out.shape[-1], self.nverts_out))
+
+        for start, mapped in self.iter_chunks(data, chunksize=chunksize):
+            out[start:start+len(mapped)] = mapped
+
+        return out
 
     def backwards(self, vertexdata):
         '''Projects vertex data back into volume space.
@@ -130,8 +210,59 @@ class Mapper(object):
         _savecache(filename, masks[0], masks[1], xfm.shape)
         return cls(masks[0], masks[1], xfm.shape, subject, xfmname)
 
+def _get_ntimes(data):
+    """Number of timepoints in `data`, or None if it cannot be determined
+    without consuming an iterator"""
+    if isinstance(data, str):
+        import nibabel
+        shape = nibabel.load(data).shape
+        return shape[3] if len(shape) > 3 else 1
+    if isinstance(data, dataset.Volume):
+        return data.data.shape[0] if data.movie else 1
+    if hasattr(data, 'shape'):
+        return data.shape[0] if len(data.shape) in (2, 4) else 1
+    return None
+
+def _iter_volume_chunks(data, chunksize):
+    """Yields (t, z, y, x) or (t, voxels) chunks of at most `chunksize`
+    timepoints from the many data types accepted by Mapper.iter_chunks"""
+    if isinstance(data, str):
+        import nibabel
+        nib = nibabel.load(data, mmap=True)
+        if len(nib.shape) < 4:
+            yield np.asanyarray(nib.dataobj).T[np.newaxis]
+            return
+        for start in range(0, nib.shape[3], chunksize):
+            yield np.asanyarray(nib.dataobj[..., start:start+chunksize]).T
+        return
+
+    if isinstance(data, dataset.Volume):
+        mask = data.mask.ravel() if data.linear else None
+        data = data._data if data.movie else data.data[np.newaxis]
+    elif hasattr(data, 'shape'):
+        mask = None
+        if len(data.shape) in (1, 3):
+            data = data[np.newaxis]
+    else:
+        # an iterable of chunks, which may be of any length
+        for chunk in data:
+            chunk = np.asarray(chunk)
+            if chunk.ndim == 3:
+                chunk = chunk[np.newaxis]
+            yield chunk
+        return
+
+    for start in range(0, data.shape[0], chunksize):
+        chunk = data[start:start+chunksize]
+        if mask is not None:
+            unmasked = np.zeros((len(chunk), len(mask)), dtype=chunk.dtype)
+            unmasked[:, mask] = chunk
+            chunk = unmasked
+        yield chunk
+
 def _savecache(filename, left, right, shape):
-    np.savez(filename,
+    from .. import cache
+    return cache.save(filename,
              left_data=left.data,
              left_indices=left.indices,
              left_indptr=left.indptr,
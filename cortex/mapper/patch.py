@@ -22,7 +22,7 @@ class PatchMapper(Mapper):
 
                 allj, alldata = [], []
                 for tri, area in zip(randpts.swapaxes(0,1), areas):
-                    i, j, data = cls.sampler(tri, shape, renorm=False, mp=False, **kwargs)
+                    i, j, data = cls.sampler(tri, shape, renorm=False, **kwargs)
                     alldata.append(data / data.sum() * area)
                     allj.append(j)
 
@@ -32,12 +32,8 @@ class PatchMapper(Mapper):
 
         surf = polyutils.Surface(pts, polys)
         patches = surf.patches(n=cls.patchsize)
-        if mp:
-            from .. import mp
-            samples = mp.map(func, enumerate(patches))
-        else:
-            #samples = map(func, enumerate(patches))
-            samples = [func(x) for x in enumerate(patches)]
+        from .. import mp as _mp
+        samples = _mp.map(func, enumerate(patches), procs=None if mp else 1)
 
         ij, alldata = [], []
         for i, (j, data) in enumerate(samples):
@@ -49,51 +49,64 @@ def trilinear(coords, shape, **kwargs):
     data = np.vstack([v000, v100, v010, v001, v101, v011, v110, v111]).ravel()
     return i, np.ravel_multi_index(j, shape, mode='clip'), data
 
-def distance_func(func, coords, shape, renorm=True, mp=True):
-    """Generates masks for separable distance functions"""
+def distance_func(func, coords, shape, window=3, renorm=True, blocksize=4096, mp=False):
+    """Generates masks for separable distance functions
+
+    Kernel weights are evaluated for blocks of `blocksize` vertices at once,
+    over the (2*ceil(window)+1)**3 voxels surrounding each vertex. `func` is
+    applied elementwise to the axis offsets and must be zero for
+    abs(offset) >= window. The `mp` argument is accepted for backwards
+    compatibility and ignored.
+    """
     nZ, nY, nX = shape
-    dx = coords[:,0] - np.atleast_2d(np.arange(nX)).T
-    dy = coords[:,1] - np.atleast_2d(np.arange(nY)).T
-    dz = coords[:,2] - np.atleast_2d(np.arange(nZ)).T
-
-    Lx, Ly, Lz = func(dx), func(dy), func(dz)
-    ix, jx = np.nonzero(Lx)
-    iy, jy = np.nonzero(Ly)
-    iz, jz = np.nonzero(Lz)
-    ba = np.broadcast_arrays
-    def func(v):
-        mx, my, mz = ix[jx == v], iy[jy == v], iz[jz == v]
-        idx, idy, idz = [i.ravel() for i in ba(*np.ix_(mx, my, mz))]
-        vx, vy, vz = [i.ravel() for i in ba(*np.ix_(Lx[mx, v], Ly[my, v], Lz[mz, v]))]
-
-        i = v * np.ones((len(idx,)))
-        j = np.ravel_multi_index((idz, idy, idx), shape, mode='clip')
-        data = vx*vy*vz
+    radius = int(np.ceil(window))
+    offsets = np.arange(-radius, radius+1)
+
+    allij, alldata = [], []
+    for start in range(0, len(coords), blocksize):
+        block = coords[start:start+blocksize]
+        valid = ~np.isnan(block).any(1)
+        block = block[valid]
+        vidx = np.nonzero(valid)[0] + start
+
+        # candidate voxel positions and kernel weights for each axis, (B, 2*radius+1)
+        axes = []
+        for c, n in zip(block.T, (nX, nY, nZ)):
+            pos = np.floor(c).astype(int)[:, np.newaxis] + offsets
+            weight = func(c[:, np.newaxis] - pos)
+            weight[(pos < 0) | (pos >= n)] = 0
+            axes.append((np.clip(pos, 0, n-1), weight))
+        (px, wx), (py, wy), (pz, wz) = axes
+
+        # separable product over the candidate cube, (B, (2*radius+1)**3)
+        data = (wz[:, :, None, None] * wy[:, None, :, None] * wx[:, None, None, :]).reshape(len(block), -1)
+        j = ((pz[:, :, None, None] * nY + py[:, None, :, None]) * nX + px[:, None, None, :]).reshape(len(block), -1)
         if renorm:
-            data /= data.sum()
-        return i, j, data
+            total = data.sum(1, keepdims=True)
+            total[total == 0] = 1
+            data /= total
 
-    if mp:
-        from .. import mp
-        ijdata = mp.map(func, range(len(coords)))
-    else:
-        #ijdata = map(func, range(len(coords)))
-        ijdata = [func(x) for x in range(len(coords))]
+        nz = data != 0
+        allij.append(np.vstack([np.repeat(vidx, nz.sum(1)), j[nz]]))
+        alldata.append(data[nz])
 
-    return np.hstack(ijdata)
+    if len(allij) == 0:
+        return np.zeros((0,), dtype=int), np.zeros((0,), dtype=int), np.zeros((0,))
+    i, j = np.hstack(allij)
+    return i, j, np.hstack(alldata)
 
 def gaussian(coords, shape, sigma=1, window=3, **kwargs):
-    raise NotImplementedError
     def gaussian(x):
-        pass
-    return distance_func(gaussian, coords, shape, **kwargs)
+        out = np.exp(-x**2 / (2 * sigma**2))
+        out[np.abs(x) >= window] = 0
+        return out
+
+    return distance_func(gaussian, coords, shape, window=window, **kwargs)
 
 def lanczos(coords, shape, window=3, **kwargs):
     def lanczos(x):
-        out = np.zeros_like(x)
-        sel = np.abs(x)<window
-        selx = x[sel]
-        out[sel] = np.sin(np.pi * selx) * np.sin(np.pi * selx / window) * (window / (np.pi**2 * selx**2))
+        out = np.sinc(x) * np.sinc(x / window)
+        out[np.abs(x) >= window] = 0
         return out
 
-    return distance_func(lanczos, coords, shape, **kwargs)
+    return distance_func(lanczos, coords, shape, window=window, **kwargs)
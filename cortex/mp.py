@@ -1,59 +1,171 @@
-import sys
-import marshal
+"""Simple process-parallel map used by the mappers and voxelizers.
+
+Work is split into batches of consecutive items. The function and the inputs
+are inherited by forked workers, so only (start, stop) index pairs are sent
+to the workers and neither closures nor large arrays need to be pickled.
+`map_array` additionally writes results straight into a shared-memory output
+array, so nothing is sent back either. Whenever forking is not possible (or
+only one process is configured) the same code runs serially.
+"""
+import itertools
 import multiprocessing as mp
-try:
-    import progressbar as pb
-except ImportError:
-    pass
-
-def map(func, iterable, procs = mp.cpu_count()):
-    input, output = mp.Queue(), mp.Queue()
-    length = mp.Value('i',0)
-    
-    def _fill(iterable, procs, input, output):
-        for data in enumerate(iterable):
-            input.put(data)
-            length.value += 1
-        for _ in range(procs*2):
-            input.put((-1,-1))
-        
-    def _func(proc, input, output):
-        idx, data = input.get()
-        while idx != -1:
-            output.put((idx, func(data)))
-            idx, data = input.get()
-    
-    filler = mp.Process(target = _fill, args=(iterable, procs, input, output))
-    filler.daemon = True
-    filler.start()
-    for i in range(procs):
-        proc = mp.Process(target=_func, args=(i, input, output))
-        proc.daemon = True
-        proc.start()
-    
+
+import numpy as np
+
+from .options import config
+
+# (func, items, out) for the current call, inherited by the forked workers
+_task = None
+
+def get_procs(procs=None):
+    """Number of worker processes to use. Defaults to the `procs` option in the
+    [mp] section of the config, where 0 means one per core."""
+    if procs is None:
+        procs = config.getint("mp", "procs") if config.has_option("mp", "procs") else 0
+    if procs <= 0:
+        procs = mp.cpu_count()
+    return procs
+
+def _can_fork():
+    return "fork" in mp.get_all_start_methods() and not mp.current_process().daemon
+
+def _batches(n, procs, batchsize=None):
+    if batchsize is None:
+        # a few batches per process to balance uneven workloads
+        batchsize = max(1, int(np.ceil(n / (procs * 4.))))
+    return [(start, min(n, start+batchsize)) for start in range(0, n, batchsize)]
+
+def _run_batch(bounds):
+    func, items, _ = _task
+    return [func(items[i]) for i in range(*bounds)]
+
+def _fill_batch(bounds):
+    func, items, out = _task
+    for i in range(*bounds):
+        out[i] = func(items[i])
+
+def _parallel(target, func, items, out, procs, batchsize):
+    global _task
+    batches = _batches(len(items), procs, batchsize)
+    _task = func, items, out
     try:
-        iterlen = len(iterable)
-    except:
-        filler.join()
-        iterlen = length.value
+        with mp.get_context("fork").Pool(min(procs, len(batches))) as pool:
+            return pool.map(target, batches, chunksize=1)
+    finally:
+        _task = None
+
+def shared_array(shape, dtype=float):
+    """Allocate a zeroed numpy array backed by shared memory, so that writes
+    from forked workers are visible to the parent process"""
+    dtype = np.dtype(dtype)
+    size = int(np.prod(shape)) * dtype.itemsize
+    buf = mp.RawArray('b', max(size, 1))
+    return np.frombuffer(buf, dtype=dtype, count=int(np.prod(shape))).reshape(shape)
+
+def map(func, iterable, procs=None, batchsize=None):
+    """Apply `func` to every item of `iterable` in parallel.
 
-    data = [[]]*iterlen
+    Parameters
+    ----------
+    func : callable
+        Function to apply. Can be a closure or lambda, it is never pickled.
+    iterable : iterable
+        Items to process. Consumed fully before processing starts.
+    procs : int, optional
+        Number of worker processes. Defaults to the configured value, see
+        `get_procs`. With 1 process, everything runs serially in this process.
+    batchsize : int, optional
+        Number of items handled per task. Defaults to a few tasks per process.
+
+    Returns
+    -------
+    results : list
+        func(item) for every item, in input order
+    """
+    items = iterable if isinstance(iterable, (list, tuple, range)) else list(iterable)
+    procs = get_procs(procs)
+    if procs < 2 or len(items) < 2 or not _can_fork():
+        return [func(item) for item in items]
+
+    results = _parallel(_run_batch, func, items, None, procs, batchsize)
+    return list(itertools.chain.from_iterable(results))
+
+def imap(func, iterable, procs=None, batchsize=None):
+    """Like `map`, but yields the results in order as soon as they are ready,
+    so that they can be consumed while the remaining items are processed.
+
+    Parameters
+    ----------
+    func : callable
+        Function to apply. Can be a closure or lambda, it is never pickled.
+    iterable : iterable
+        Items to process. Consumed fully before processing starts.
+    procs : int, optional
+        Number of worker processes, see `map`.
+    batchsize : int, optional
+        Number of items handled per task, see `map`.
+
+    Yields
+    ------
+    result
+        func(item) for every item, in input order
+    """
+    global _task
+    items = iterable if isinstance(iterable, (list, tuple, range)) else list(iterable)
+    procs = get_procs(procs)
+    if procs < 2 or len(items) < 2 or not _can_fork():
+        for item in items:
+            yield func(item)
+        return
+
+    batches = _batches(len(items), procs, batchsize)
+    _task = func, items, None
     try:
-        progress = pb.ProgressBar(widgets=[pb.Percentage(), pb.Bar()], maxval=iterlen)
-        progress.start()
-        for i in range(iterlen):
-            idx, result = output.get()
-            data[idx] = result
-            progress.update(i+1)
-        progress.finish()
-    except NameError:
-        for _ in range(iterlen):
-            idx, result = output.get()
-            data[idx] = result
-        
-    return data
-
-if __name__ == "__main__":
-    #pool = Pool()
-    #data = pool.map(
-    map(lambda x: max(x), zip(*(iter(range(65536)),)*3))
+        with mp.get_context("fork").Pool(min(procs, len(batches))) as pool:
+            # the workers have forked, other calls may now replace the task
+            _task = None
+            for results in pool.imap(_run_batch, batches, chunksize=1):
+                for result in results:
+                    yield result
+    finally:
+        _task = None
+
+def map_array(func, iterable, shape, dtype=float, procs=None, batchsize=None):
+    """Apply `func` to every item of `iterable` in parallel, stacking the
+    results into an array.
+
+    Every result must be an array of the given `shape`. Workers write their
+    results directly into shared memory, so results are never pickled.
+
+    Parameters
+    ----------
+    func : callable
+        Function to apply, returning an array of `shape`
+    iterable : iterable
+        Items to process
+    shape : tuple
+        Shape of each result
+    dtype : dtype, optional
+        Data type of the output. Defaults to float.
+    procs : int, optional
+        Number of worker processes, see `map`.
+    batchsize : int, optional
+        Number of items handled per task, see `map`.
+
+    Returns
+    -------
+    out : (n,) + shape ndarray
+        Stacked results, in input order
+    """
+    items = iterable if isinstance(iterable, (list, tuple, range)) else list(iterable)
+    procs = get_procs(procs)
+    shape = (len(items),) + tuple(shape)
+    if procs < 2 or len(items) < 2 or not _can_fork():
+        out = np.zeros(shape, dtype=dtype)
+        for i, item in enumerate(items):
+            out[i] = func(item)
+        return out
+
+    out = shared_array(shape, dtype=dtype)
+    _parallel(_fill_batch, func, items, out, procs, batchsize)
+    return np.array(out)
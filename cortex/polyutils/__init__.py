@@ -7,6 +7,7 @@ from .misc import (
     sort_polys,
     face_area,
     face_volume,
+    point_triangle_distance,
     decimate,
     inside_convex_poly,
     make_cube,
@@ -43,6 +43,44 @@ def face_area(pts):
     '''
     return 0.5 * np.sqrt((np.cross(pts[:,1]-pts[:,0], pts[:,2]-pts[:,0])**2).sum(1))
 
+def _segment_distance(p, a, b):
+    ab = b - a
+    denom = (ab * ab).sum(-1)
+    t = ((p - a) * ab).sum(-1) / np.where(denom > 0, denom, 1)
+    closest = a + np.clip(t, 0, 1)[..., np.newaxis] * ab
+    return np.sqrt(((p - closest)**2).sum(-1))
+
+def point_triangle_distance(p, a, b, c):
+    '''Euclidean distance from points to triangles
+
+    All arguments are broadcast against each other.
+
+    Parameters
+    ----------
+    p : array_like
+        (..., 3) array of points
+    a, b, c : array_like
+        (..., 3) arrays with the corners of the triangles
+    '''
+    p, a, b, c = [np.asarray(x, dtype=float) for x in (p, a, b, c)]
+    ab, ac, ap = b - a, c - a, p - a
+    # barycentric coordinates of the projection of p onto the triangle plane
+    d00, d01, d11 = (ab * ab).sum(-1), (ab * ac).sum(-1), (ac * ac).sum(-1)
+    d20, d21 = (ap * ab).sum(-1), (ap * ac).sum(-1)
+    denom = d00 * d11 - d01 * d01
+    valid = denom > 1e-12 * d00 * d11
+    denom = np.where(valid, denom, 1)
+    v = (d11 * d20 - d01 * d21) / denom
+    w = (d00 * d21 - d01 * d20) / denom
+    inside = valid & (v >= 0) & (w >= 0) & (v + w <= 1)
+
+    normal = np.cross(ab, ac)
+    nlen = np.sqrt((normal * normal).sum(-1))
+    plane = np.abs((ap * normal).sum(-1)) / np.where(nlen > 0, nlen, 1)
+    edges = np.minimum(np.minimum(_segment_distance(p, a, b), _segment_distance(p, b, c)),
+                       _segment_distance(p, c, a))
+    return np.where(inside, plane, edges)
+
 def face_volume(pts1, pts2, polys):
     '''Volume of each face in a polyhedron sheet'''
     vols = np.zeros((len(polys),))
@@ -182,14 +220,11 @@ def voxelize(pts, polys, shape=(256, 256, 256), center=(128, 128, 128), mp=True)
                 vox += rasterize(epts[poly][:,:2]+[.5, .5], shape=shape[:2][::-1])
         return vox % 2
 
-    if mp:
-        from . import mp
-        layers = mp.map(func, range(shape[2]))
-    else:
-        #layers = map(func, range(shape[2]))
-        layers = [func(x) for x in range(shape[2])] # python3 compatible
+    from .. import mp as _mp
+    layers = _mp.map_array(func, range(shape[2]), shape[:2][::-1], dtype=np.uint8,
+                           procs=None if mp else 1)
 
-    return np.array(layers).T
+    return layers.T
 
 def measure_volume(pts, polys):
     from tvtk.api import tvtk
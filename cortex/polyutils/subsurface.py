@@ -255,7 +255,8 @@ class SubsurfaceMixin(object):
             'geodesic_distance': geodesic_distance[vertex_mask],
         }
 
-    def get_geodesic_patches(self, radius, seeds=None, n_random_seeds=None, output='dense'):
+    def get_geodesic_patches(self, radius, seeds=None, n_random_seeds=None, output='dense',
+                             method='subsurface', refine=False, chunksize=64, procs=None):
         """create patches of cortex centered around each vertex seed
 
         - must specify seeds or n_random_seeds
@@ -270,7 +271,21 @@ class SubsurfaceMixin(object):
             number of vertex seeds to generate
         - output : 'dense' or 'sparse'
             'dense': output as dense binary array (faster, less memory efficient)
-            'sparse': output as sparse binary array (slower, more memory efficient)
+            'sparse': output as sparse binary csr matrix (more memory efficient)
+        - method : 'subsurface' or 'graph'
+            'subsurface': heat method geodesic distance on a subsurface around each
+            seed (see get_geodesic_patch)
+            'graph': radius-bounded Dijkstra over the mesh edges, for many seeds at
+            once (much faster, slightly underestimates patches since paths along
+            edges are longer than geodesics)
+        - refine : boolean (default=False)
+            only for method='graph', recompute distances with the heat method on
+            the subsurface within 1.2 * radius of graph distance of each seed
+        - chunksize : int
+            only for method='graph', number of seeds processed at once
+        - procs : int (default=None)
+            only for method='graph', number of processes, by default the [mp] procs
+            option (see cortex.mp.get_procs)
         """
 
         # gather seeds
@@ -278,25 +293,133 @@ class SubsurfaceMixin(object):
             seeds = np.random.choice(self.pts.shape[0], n_random_seeds, replace=False)
         if seeds is None:
             raise Exception('must specify seeds or n_random_seeds')
+        if output not in ('dense', 'sparse'):
+            raise Exception('output: ' + str(output))
 
-        # initialize output
+        # compute patches, as csr rows
         output_dims = (len(seeds), self.pts.shape[0])
-        if output == 'dense':
-            patches = np.zeros(output_dims, dtype=bool)
-        elif output == 'sparse':
-            patches = scipy.sparse.dok_matrix(output_dims, dtype=bool)
+        if method == 'subsurface':
+            rows, cols = [], []
+            for vs, vertex_seed in enumerate(seeds):
+                patch = self.get_geodesic_patch(radius=radius, vertex=vertex_seed)
+                cols.append(np.nonzero(patch['vertex_mask'])[0])
+                rows.append(np.full(len(cols[-1]), vs))
+            rows, cols = np.hstack(rows), np.hstack(cols)
+        elif method == 'graph':
+            dists = self.get_graph_patches(radius, seeds, refine=refine,
+                                           chunksize=chunksize, procs=procs)
+            dists = dists.tocoo()
+            rows, cols = dists.row, dists.col
         else:
-            raise Exception('output: ' + str(output))
+            raise Exception('method: ' + str(method))
 
-        # compute patches
-        for vs, vertex_seed in enumerate(seeds):
-            patch = self.get_geodesic_patch(radius=radius, vertex=vertex_seed)
-            patches[vs, :] = patch['vertex_mask']
+        patches = scipy.sparse.csr_matrix(
+            (np.ones(len(rows), dtype=bool), (rows, cols)), shape=output_dims)
+        if output == 'dense':
+            patches = patches.toarray()
 
         return {
             'vertex_masks': patches,
         }
 
+    @property
+    @_memo
+    def edge_graph(self):
+        """sparse matrix of the lengths of the edges between adjacent vertices"""
+        adj = self.adj.tocoo()
+        lengths = np.sqrt(((self.pts[adj.row] - self.pts[adj.col]) ** 2).sum(1))
+        return scipy.sparse.csr_matrix((lengths, (adj.row, adj.col)), shape=adj.shape)
+
+    def get_graph_patches(self, radius, seeds, refine=False, chunksize=64, procs=None):
+        """return distances to all vertices within some distance of each seed,
+        along the edges of the mesh
+
+        - seeds are grouped into spatially compact chunks, and each chunk is
+          processed with radius-bounded Dijkstra searches restricted to the
+          vertices within euclidean distance of its seeds (which contain every
+          path short enough to matter)
+        - distances of zero (the seeds themselves) are stored explicitly
+
+        Parameters
+        ----------
+        - radius : number
+            distance threshold
+        - seeds : list of ints
+            centers of each patch
+        - refine : boolean (default=False)
+            True = recompute distances using the heat method on the subsurface
+            within 1.2 * radius graph distance of each seed, so that patches
+            approximate geodesic patches more closely (slower)
+        - chunksize : int
+            number of seeds processed at once, bounds memory use
+        - procs : int (default=None)
+            number of processes to use, by default the [mp] procs option (see
+            cortex.mp.get_procs)
+
+        Output
+        ------
+        - csr_matrix of shape (len(seeds), n_vertices) of distances
+        """
+        from scipy.sparse.csgraph import dijkstra
+        from scipy.spatial import cKDTree
+        from .. import mp
+
+        seeds = np.asarray(seeds, dtype=int)
+        graph = self.edge_graph
+        limit = radius * 1.2 if refine else radius
+        tree = cKDTree(self.pts)
+
+        # order seeds along a coarse spatial grid so that chunks are compact
+        cells = np.floor(self.pts[seeds] / (4 * limit)).astype(int)
+        order = np.lexsort(cells.T[::-1])
+
+        def func(start):
+            idx = order[start:start + chunksize]
+            chunk = seeds[idx]
+            nearby = tree.query_ball_point(self.pts[chunk], limit + 1e-6)
+            local = np.unique(np.hstack([np.asarray(n, dtype=int) for n in nearby] + [chunk]))
+            subgraph = graph[local][:, local]
+            dists = dijkstra(subgraph, directed=False, limit=limit,
+                             indices=np.searchsorted(local, chunk))
+            rows, cols = np.nonzero(np.isfinite(dists))
+            values, cols = dists[rows, cols], local[cols]
+            if refine:
+                rows, cols, values = self._refine_graph_patches(
+                    chunk, rows, cols, values, radius)
+            return idx[rows], cols, values
+
+        results = mp.map(func, range(0, len(seeds), chunksize), procs=procs)
+        rows, cols, values = [np.hstack(r) for r in zip(*results)]
+        return scipy.sparse.csr_matrix(
+            (values, (rows, cols)), shape=(len(seeds), self.pts.shape[0]))
+
+    def _refine_graph_patches(self, chunk, rows, cols, values, radius):
+        """replace graph distances by heat method distances on each seed's patch"""
+        out_rows, out_cols, out_values = [], [], []
+        for k, seed in enumerate(chunk):
+            sel = rows == k
+            vertex_mask = np.zeros(self.pts.shape[0], dtype=bool)
+            vertex_mask[cols[sel]] = True
+            try:
+                subsurface = self.create_subsurface(vertex_mask=vertex_mask)
+                vertex_map = subsurface.subsurface_vertex_map
+                distance = subsurface.lift_subsurface_data(
+                    subsurface.geodesic_distance([vertex_map[seed]]))
+                close_enough = subsurface.lift_subsurface_data(
+                    np.ones(subsurface.pts.shape[0], dtype=bool))
+                close_enough &= distance <= radius
+                close_enough = self.get_connected_vertices(int(seed), close_enough)
+                verts = np.nonzero(close_enough)[0]
+                dists = distance[verts]
+            except (RuntimeError, IndexError):
+                # singular or degenerate subsurface, keep the graph distances
+                keep = values[sel] <= radius
+                verts, dists = cols[sel][keep], values[sel][keep]
+            out_rows.append(np.full(len(verts), k))
+            out_cols.append(verts)
+            out_values.append(dists)
+        return np.hstack(out_rows), np.hstack(out_cols), np.hstack(out_values)
+
     def lift_subsurface_data(self, data, vertex_mask=None):
         """expand vertex dimension of data to original surface's size
 
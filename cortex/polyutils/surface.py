@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 
+import os
 from collections import OrderedDict
+from hashlib import sha1
 
 import numpy as np
 import numexpr as ne
@@ -12,6 +14,12 @@ from . import exact_geodesic
 from . import subsurface
 from .misc import _memo
 
+# Sparse factorizations shared by all Surfaces with a cachedir, keyed by
+# (mesh hash, solver, parameters). SuperLU objects cannot be saved to disk, so
+# this avoids refactorizing when the same subject surface is constructed again.
+_shared_factorizations = OrderedDict()
+_max_shared_factorizations = 8
+
 
 class Surface(exact_geodesic.ExactGeodesicMixin, subsurface.SubsurfaceMixin):
     """Represents a single cortical hemisphere surface. Can be the white matter surface,
@@ -26,14 +34,53 @@ class Surface(exact_geodesic.ExactGeodesicMixin, subsurface.SubsurfaceMixin):
         Location of each vertex in space (mm). Order is x, y, z.
     polys : 2D ndarray, shape (total_polys, 3)
         Indices of the vertices in each triangle in the surface.
+    cachedir : str, optional
+        Directory (usually the subject cache, `db.get_cache(subject)`) where the
+        Laplace-Beltrami operator is saved, keyed by a hash of the mesh. If
+        given, sparse factorizations are also shared with every other Surface
+        built from the same mesh in this process. Default None, which only
+        caches on this object.
     """
-    def __init__(self, pts, polys):
+    def __init__(self, pts, polys, cachedir=None):
         self.pts = pts.astype(np.double)
         self.polys = polys
+        self.cachedir = cachedir
 
         self._cache = dict()
-        self._rlfac_solvers = dict()
-        self._nLC_solvers = dict()
+        self._factorizations = dict()
+
+    @property
+    @_memo
+    def mesh_hash(self):
+        """Hash of the vertex positions and triangles, used as cache key.
+        """
+        h = sha1(np.ascontiguousarray(self.pts).tobytes())
+        h.update(np.ascontiguousarray(self.polys, dtype=np.int64).tobytes())
+        return h.hexdigest()[:16]
+
+    def _get_factorization(self, key, build):
+        """Return the cached solver for `key`, calling `build` to create it if
+        necessary. Solvers are shared across Surfaces of the same mesh if this
+        surface has a cachedir.
+        """
+        if key in self._factorizations:
+            return self._factorizations[key]
+
+        if self.cachedir is None:
+            solver = build()
+        else:
+            skey = (self.mesh_hash,) + key
+            if skey in _shared_factorizations:
+                _shared_factorizations.move_to_end(skey)
+                solver = _shared_factorizations[skey]
+            else:
+                solver = build()
+                _shared_factorizations[skey] = solver
+                while len(_shared_factorizations) > _max_shared_factorizations:
+                    _shared_factorizations.popitem(last=False)
+
+        self._factorizations[key] = solver
+        return solver
 
     @property
     @_memo
@@ -140,7 +187,22 @@ class Surface(exact_geodesic.ExactGeodesicMixin, subsurface.SubsurfaceMixin):
         
         See 'Discrete Laplace-Beltrami operators for shape analysis and segmentation'
         by Reuter et al., 2009 for details.
+
+        If this surface has a cachedir, the operator is loaded from there when
+        it has been computed before for the same mesh.
         """
+        if self.cachedir is not None:
+            from .. import cache
+            cachefile = os.path.join(self.cachedir, "laplace_%s" % self.mesh_hash)
+            with cache.building(cachefile) as stale:
+                if stale:
+                    operator = self._compute_laplace_operator()
+                    _save_laplace_operator(cachefile, *operator)
+                    return operator
+            return _load_laplace_operator(cachefile)
+        return self._compute_laplace_operator()
+
+    def _compute_laplace_operator(self):
         ## Lumped mass matrix
         D = self.connected.dot(self.face_areas) / 3.0
 
@@ -215,9 +277,11 @@ class Surface(exact_geodesic.ExactGeodesicMixin, subsurface.SubsurfaceMixin):
         
         B,D,W,V = self.laplace_operator
         npt = len(D)
-        lfac = sparse.dia_matrix((D,[0]), (npt,npt)) - factor * (W-V)
-        goodrows = np.nonzero(~np.array(lfac.sum(0) == 0).ravel())[0]
-        lfac_solver = sparse.linalg.dsolve.factorized(lfac[goodrows][:,goodrows])
+        def build():
+            lfac = sparse.dia_matrix((D,[0]), (npt,npt)) - factor * (W-V)
+            goodrows = np.nonzero(~np.array(lfac.sum(0) == 0).ravel())[0]
+            return goodrows, sparse.linalg.factorized(lfac[goodrows][:,goodrows])
+        goodrows, lfac_solver = self._get_factorization(("smooth", factor), build)
         to_smooth = scalars.copy()
         for _ in range(iterations):
             from_smooth = lfac_solver((D * to_smooth)[goodrows])
@@ -309,11 +373,17 @@ class Surface(exact_geodesic.ExactGeodesicMixin, subsurface.SubsurfaceMixin):
         notboundary : ndarray, int
             Indices of non-boundary vertices
         """
+        boundary_verts = np.unique(boundary_verts).astype(int)
+        key = ("biharmonic", sha1(boundary_verts.tobytes()).hexdigest(), clip_D)
+        return self._get_factorization(
+            key, lambda: self._create_biharmonic_solver(boundary_verts, clip_D))
+
+    def _create_biharmonic_solver(self, boundary_verts, clip_D):
         try:
             from scikits.sparse.cholmod import cholesky
             factorize = lambda x: cholesky(x).solve_A
         except ImportError:
-            factorize = sparse.linalg.dsolve.factorized
+            factorize = sparse.linalg.factorized
             
         B, D, W, V = self.laplace_operator
         npt = len(D)
@@ -447,24 +517,14 @@ class Surface(exact_geodesic.ExactGeodesicMixin, subsurface.SubsurfaceMixin):
         npt = len(self.pts)
         t = m * self.avg_edge_length ** 2 # time of heat evolution
 
-        if m not in self._rlfac_solvers:
-            B, D, W, V = self.laplace_operator
-            nLC = W - V # negative laplace matrix
-            spD = sparse.dia_matrix((D,[0]), (npt,npt)).tocsr() # lumped mass matrix
-            
-            lfac = spD - t * nLC # backward Euler matrix
-
-            # Exclude rows with zero weight (these break the sparse LU)
-            goodrows = np.nonzero(~np.array(lfac.sum(0) == 0).ravel())[0]
-            self._goodrows = goodrows
-            self._rlfac_solvers[m] = sparse.linalg.dsolve.factorized(lfac[goodrows][:,goodrows])
+        goodrows, rlfac_solver = self._get_heat_solver(m, fem=False)
 
         # Solve system to get u, the heat values
         u0 = np.zeros((npt,)) # initial heat values
         u0[verts] = 1.0
-        goodu = self._rlfac_solvers[m](u0[self._goodrows])
+        goodu = rlfac_solver(u0[goodrows])
         u = np.zeros((npt,))
-        u[self._goodrows] = goodu
+        u[goodrows] = goodu
 
         return -4 * t * np.log(u)
 
@@ -504,22 +564,8 @@ class Surface(exact_geodesic.ExactGeodesicMixin, subsurface.SubsurfaceMixin):
             vertex in `verts`.
         """
         npt = len(self.pts)
-        if m not in self._rlfac_solvers or m not in self._nLC_solvers:
-            B, D, W, V = self.laplace_operator
-            nLC = W - V # negative laplace matrix
-            if not fem:
-                spD = sparse.dia_matrix((D,[0]), (npt,npt)).tocsr() # lumped mass matrix
-            else:
-                spD = B
-            
-            t = m * self.avg_edge_length ** 2 # time of heat evolution
-            lfac = spD - t * nLC # backward Euler matrix
-
-            # Exclude rows with zero weight (these break the sparse LU)
-            goodrows = np.nonzero(~np.array(lfac.sum(0) == 0).ravel())[0]
-            self._goodrows = goodrows
-            self._rlfac_solvers[m] = sparse.linalg.dsolve.factorized(lfac[goodrows][:,goodrows])
-            self._nLC_solvers[m] = sparse.linalg.dsolve.factorized(nLC[goodrows][:,goodrows])
+        goodrows, rlfac_solver = self._get_heat_solver(m, fem)
+        nLC_solver = self._get_poisson_solver(m, fem)
 
         # I. "Integrate the heat flow ̇u = ∆u for some fixed time t"
         # ---------------------------------------------------------
@@ -527,9 +573,9 @@ class Surface(exact_geodesic.ExactGeodesicMixin, subsurface.SubsurfaceMixin):
         # Solve system to get u, the heat values
         u0 = np.zeros((npt,)) # initial heat values
         u0[verts] = 1.0
-        goodu = self._rlfac_solvers[m](u0[self._goodrows])
+        goodu = rlfac_solver(u0[goodrows])
         u = np.zeros((npt,))
-        u[self._goodrows] = goodu
+        u[goodrows] = goodu
 
         # II. "Evaluate the vector field X = − ∇u / |∇u|"
         # -----------------------------------------------
@@ -557,15 +603,161 @@ class Surface(exact_geodesic.ExactGeodesicMixin, subsurface.SubsurfaceMixin):
         divx = conn1.dot(x1) + conn2.dot(x2) + conn3.dot(x3)
 
         # Compute phi (distance)
-        goodphi = self._nLC_solvers[m](divx[self._goodrows])
+        goodphi = nLC_solver(divx[goodrows])
         phi = np.zeros((npt,))
-        phi[self._goodrows] = goodphi - goodphi.min()
+        phi[goodrows] = goodphi - goodphi.min()
 
         # Ensure that distance is zero for selected verts
         phi[verts] = 0.0
 
         return phi
 
+    def geodesic_distances(self, seeds, m=1.0, fem=False, max_dist=None, chunksize=None,
+                           max_memory=256 * 2**20):
+        """Geodesic distance (in mm) from each vertex in the surface to each of
+        the vertices in `seeds`, individually.
+
+        This gives the same result as calling `geodesic_distance([seed])` for
+        every seed, but the heat and Poisson steps are solved for a block of
+        `chunksize` seeds at once using the same factorizations. The peak
+        memory of the temporaries is at most 3 * n_faces * 3 * 8 bytes per seed
+        in a chunk (22 MB per seed for a hemisphere with 300k faces), in
+        addition to the output.
+
+        Parameters
+        ----------
+        seeds : 1D array-like of ints, length K
+            Vertices to compute distance from.
+        m : float, optional
+            Reverse Euler step length, see `geodesic_distance`. Default 1.0.
+        fem : bool, optional
+            Whether to use Finite Element Method mass matrix, see
+            `geodesic_distance`. Default False.
+        max_dist : float, optional
+            If given, only distances up to `max_dist` are kept and a sparse
+            matrix is returned. Distances of zero (the seeds themselves) are
+            stored explicitly. Default None, which returns a dense array.
+        chunksize : int, optional
+            Number of seeds solved for at once. Default None, which picks the
+            largest chunk whose temporaries fit in `max_memory`.
+        max_memory : int, optional
+            Memory budget in bytes for the temporaries when `chunksize` is None.
+            Default 256 MB, at least one seed is always solved at once.
+
+        Returns
+        -------
+        dists : 2D ndarray or scipy.sparse.csr_matrix, shape (K, total_verts)
+            Geodesic distance (in mm) from each seed to every vertex.
+        """
+        seeds = np.atleast_1d(np.asarray(seeds, dtype=int))
+        npt = len(self.pts)
+        goodrows, rlfac_solver = self._get_heat_solver(m, fem)
+        nLC_solver = self._get_poisson_solver(m, fem)
+
+        fe12, fe23, fe31 = self._facenorm_cross_edge
+        fa2 = 2 * self.face_areas[:, np.newaxis]
+        c32, c13, c21 = self._cot_edge
+        conn1, conn2, conn3 = self._polyconn
+        p1, p2, p3 = self.polys.T
+        if chunksize is None:
+            # two (faces, 3, chunksize) float arrays are alive at the peak, plus
+            # smaller (faces, chunksize) and (verts, chunksize) ones
+            chunksize = max(1, max_memory // (3 * len(self.polys) * 3 * 8))
+
+        if max_dist is None:
+            dists = np.zeros((len(seeds), npt))
+        else:
+            rows, cols, data = [], [], []
+
+        for start in range(0, len(seeds), chunksize):
+            chunk = seeds[start:start+chunksize]
+            nk = len(chunk)
+            cidx = np.arange(nk)
+
+            # I. Integrate the heat flow from each seed
+            u0 = np.zeros((npt, nk))
+            u0[chunk, cidx] = 1.0
+            u = np.zeros((npt, nk))
+            u[goodrows] = rlfac_solver(u0[goodrows])
+            del u0
+
+            # II. Normalized negative gradient of u on each face, (faces, 3, K)
+            # computed in place, so that at most two such arrays exist at once
+            X = fe12[:, :, np.newaxis] * u[p3][:, np.newaxis]
+            X += fe23[:, :, np.newaxis] * u[p1][:, np.newaxis]
+            X += fe31[:, :, np.newaxis] * u[p2][:, np.newaxis]
+            X /= fa2[:, :, np.newaxis]
+            norm = np.sqrt((X**2).sum(1))[:, np.newaxis]
+            with np.errstate(divide='ignore', invalid='ignore'):
+                X /= -norm
+            np.nan_to_num(X, copy=False)
+            del norm
+
+            # III. Solve the Poisson equation for the integrated divergence
+            x1 = 0.5 * np.einsum('fd,fdk->fk', c32, X)
+            x2 = 0.5 * np.einsum('fd,fdk->fk', c13, X)
+            x3 = 0.5 * np.einsum('fd,fdk->fk', c21, X)
+            del X
+            divx = conn1.dot(x1) + conn2.dot(x2) + conn3.dot(x3)
+            del x1, x2, x3
+
+            goodphi = nLC_solver(divx[goodrows])
+            phi = np.zeros((npt, nk))
+            phi[goodrows] = goodphi - goodphi.min(0)
+            del u, divx, goodphi
+            phi[chunk, cidx] = 0.0
+
+            if max_dist is None:
+                dists[start:start+nk] = phi.T
+            else:
+                vert, k = np.nonzero(phi <= max_dist)
+                rows.append(k + start)
+                cols.append(vert)
+                data.append(phi[vert, k])
+
+        if max_dist is None:
+            return dists
+
+        if len(rows) == 0:
+            return sparse.csr_matrix((len(seeds), npt))
+        return sparse.csr_matrix((np.hstack(data), (np.hstack(rows), np.hstack(cols))),
+                                 shape=(len(seeds), npt))
+
+    def _get_heat_solver(self, m, fem=False):
+        """Factorized backward Euler matrix used to integrate the heat flow for
+        `geodesic_distance`. Returns the rows with non-zero weight (which are the
+        only ones included in the factorization) and the solver.
+        """
+        def build():
+            npt = len(self.pts)
+            B, D, W, V = self.laplace_operator
+            nLC = W - V # negative laplace matrix
+            if not fem:
+                spD = sparse.dia_matrix((D,[0]), (npt,npt)).tocsr() # lumped mass matrix
+            else:
+                spD = B
+
+            t = m * self.avg_edge_length ** 2 # time of heat evolution
+            lfac = spD - t * nLC # backward Euler matrix
+
+            # Exclude rows with zero weight (these break the sparse LU)
+            goodrows = np.nonzero(~np.array(lfac.sum(0) == 0).ravel())[0]
+            return goodrows, sparse.linalg.factorized(lfac[goodrows][:,goodrows])
+
+        return self._get_factorization(("heat", m, fem), build)
+
+    def _get_poisson_solver(self, m, fem=False):
+        """Factorized negative Laplace matrix used to solve the Poisson equation
+        for `geodesic_distance`, restricted to the same rows as the heat solver.
+        """
+        def build():
+            goodrows, _ = self._get_heat_solver(m, fem)
+            B, D, W, V = self.laplace_operator
+            nLC = (W - V).tocsr() # negative laplace matrix
+            return sparse.linalg.factorized(nLC[goodrows][:,goodrows])
+
+        return self._get_factorization(("poisson", m, fem), build)
+
     def geodesic_path(self, a, b, max_len=1000, d=None, **kwargs):
         """Finds the shortest path between two points `a` and `b`.
 
@@ -880,6 +1072,23 @@ class Surface(exact_geodesic.ExactGeodesicMixin, subsurface.SubsurfaceMixin):
         face2 = self.connected[p2]
 
 
+def _save_laplace_operator(filename, B, D, W, V):
+    from .. import cache
+    B, W = B.tocsr(), W.tocsr()
+    cache.save(filename,
+               B_data=B.data, B_indices=B.indices, B_indptr=B.indptr,
+               W_data=W.data, W_indices=W.indices, W_indptr=W.indptr,
+               D=D, V=V.diagonal())
+
+def _load_laplace_operator(filename):
+    from .. import cache
+    npz = cache.load(filename)
+    npt = len(npz['D'])
+    B = sparse.csr_matrix((npz['B_data'], npz['B_indices'], npz['B_indptr']), (npt, npt))
+    W = sparse.csr_matrix((npz['W_data'], npz['W_indices'], npz['W_indptr']), (npt, npt))
+    V = sparse.dia_matrix((npz['V'], [0]), (npt, npt))
+    return B, npz['D'], W, V
+
 class _ptset(object):
     def __init__(self):
         self.idx = OrderedDict()
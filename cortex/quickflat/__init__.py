@@ -1,3 +1,4 @@
-from .view import make_figure, make_png, make_svg, make_movie, make_gif
-from .utils import make_flatmap_image
-from . import composite
\ No newline at end of file
+from .view import make_figure, make_png, make_rgba, make_svg, make_movie, make_gif
+from .utils import make_flatmap_image, make_flatmap_images
+from . import composite
+from . import tiles
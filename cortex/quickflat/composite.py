@@ -4,7 +4,7 @@ from .. import dataset
 from ..database import db
 from ..options import config
 from .utils import _get_height, _get_extents, _convert_svg_kwargs, _get_images, _parse_defaults
-from .utils import make_flatmap_image, _make_hatch_image, _get_fig_and_ax, get_flatmask, get_flatcache
+from .utils import make_flatmap_image, _make_hatch_image, get_curvature_image, _get_fig_and_ax, get_flatmask, get_flatcache
 
 
 """ --- Individual compositing functions --- """
@@ -58,55 +58,12 @@ def add_curvature(fig, dataview, extents=None, height=None, threshold=True, cont
         matplotlib axes image object for plotted data
 
     """
-    from matplotlib.colors import Normalize
     if height is None:
         height = _get_height(fig)
-    # Get curvature map as image
-    default_smoothing = config.get('curvature', 'smooth')
-    if default_smoothing.lower()=='none':
-        default_smoothing = None
-    else:
-        default_smoothing = np.float_(default_smoothing)
-    if smooth is None:
-        # (Might still be None!)
-        smooth = default_smoothing
-    if smooth is None:
-        # If no value for 'smooth' is given in kwargs, db.get_surfinfo returns
-        # the default curvature value, whatever that may be. This is the behavior
-        # that we want a None in the code to invoke. This is silly and complicated
-        # due to backward compatibility issues with some old subjects.
-        curv_vertices = db.get_surfinfo(dataview.subject)
-    else:
-        curv_vertices = db.get_surfinfo(dataview.subject, smooth=smooth)
-    curv, _ = make_flatmap_image(curv_vertices, recache=recache, height=height)
-    # First, limit to sensible range for flatmap curvature
-    norm = Normalize(vmin=-0.5, vmax=0.5)
-    curv_im = norm(curv)
-    # Option to use thresholded curvature
-    default_threshold = config.get('curvature','threshold').lower() in ('true', 't', '1', 'y', 'yes')
-    use_threshold_curvature = default_threshold if threshold is None else threshold
-    if legacy_mode and use_threshold_curvature:
-        curvT = (curv>0).astype(np.float32)
-        curvT[np.isnan(curv)] = np.nan
-        curv = curvT
-    if isinstance(curvature_lims, (list, tuple)):
-        vmin, vmax = curvature_lims
-    else:
-        vmin, vmax = -curvature_lims, curvature_lims
-    norm = Normalize(vmin=vmin, vmax=vmax)
-    curv_im = norm(curv)
-    if not legacy_mode:
-        if use_threshold_curvature:
-            # Assumes symmetrical curvature_lims
-            curv_im = (np.nan_to_num(curv_im) > 0.5).astype(float)
-            curv_im[np.isnan(curv)] = np.nan
-        # Get defaults for brightness, contrast
-        if brightness is None:
-            brightness = float(config.get('curvature', 'brightness'))
-        if contrast is None:
-            contrast = float(config.get('curvature', 'contrast'))
-        # Scale and shift curvature image
-        curv_im = (curv_im - 0.5) * contrast + brightness
+    curv_im = get_curvature_image(dataview.subject, height, threshold=threshold,
+                                  contrast=contrast, brightness=brightness, smooth=smooth,
+                                  recache=recache, curvature_lims=curvature_lims,
+                                  legacy_mode=legacy_mode)
     if extents is None:
         extents = _get_extents(fig)
     _, ax = _get_fig_and_ax(fig)
@@ -0,0 +1,240 @@
+"""Tiled, zoomable flatmaps.
+
+`make_flatmap_image` renders the whole flatmap at once, so the size of its
+pixel map and image grows with the square of the height, and flatmaps taller
+than a few thousand pixels do not fit in memory. Here, flatmaps are instead
+rendered as a pyramid of square tiles, in the XYZ scheme used by web map
+viewers (e.g. Leaflet or OpenLayers):
+
+- zoom level `level` is a flatmap of height ``tilesize * 2**level``
+- tile (`x`, `y`) of a level covers the pixels of columns ``x*tilesize`` to
+  ``(x+1)*tilesize`` and rows ``y*tilesize`` to ``(y+1)*tilesize`` of its
+  image, counting rows from the top. Tiles along the right and bottom edges
+  are padded with transparent pixels.
+
+Each tile only needs the mask and pixel map of its own window of the flatmap
+grid, which are built on demand and cached on disk and in memory like the
+flatmap caches of `get_flatcache`. Tiles can be served over http by the
+tornado server of `cortex.webgl.serve`, see `serve`.
+"""
+import io
+import os
+
+import numpy as np
+
+from .. import dataset
+from ..database import db
+from . import utils
+
+
+def get_level_shape(subject, level, tilesize=256):
+    """Shape (width, height) in pixels of the flatmap of a zoom level"""
+    return utils._get_flatmask_shape(subject, tilesize * 2**level)
+
+def get_tile_info(subject, levels, tilesize=256):
+    """Description of the tile pyramid of a subject, for tile viewers.
+
+    Parameters
+    ----------
+    subject : str
+        Name of subject in pycortex store
+    levels : int
+        Number of zoom levels
+    tilesize : int
+        Width and height of the tiles, in pixels
+
+    Returns
+    -------
+    info : dict
+        The tilesize, the extents of the flatmap, and for each level the width
+        and height of its flatmap and its number of columns and rows of tiles
+    """
+    _, _, fmin, fmax = utils._get_flat_boundary(subject)
+    extents = np.hstack([fmin, fmax])[[0,3,1,4]]
+    info = dict(tilesize=tilesize, extents=[float(e) for e in extents], levels=[])
+    for level in range(levels):
+        width, height = get_level_shape(subject, level, tilesize)
+        info['levels'].append(dict(width=width, height=height,
+                                   columns=-(-width // tilesize), rows=-(-height // tilesize)))
+    return info
+
+def _get_tile_window(subject, level, x, y, tilesize=256):
+    """Origin and shape, both as (x, y), of the window of the flatmap grid of
+    a tile. Rows of the image are flipped with respect to the grid."""
+    width, height = get_level_shape(subject, level, tilesize)
+    if not (0 <= x and x * tilesize < width and 0 <= y and y * tilesize < height):
+        raise ValueError("Tile (%d, %d) is outside of zoom level %d" % (x, y, level))
+    x0, x1 = x * tilesize, min((x + 1) * tilesize, width)
+    y0, y1 = max(height - (y + 1) * tilesize, 0), height - y * tilesize
+    return (x0, y0), (x1 - x0, y1 - y0)
+
+def get_tile_cache(subject, xfmname, level, x, y, tilesize=256, pixelwise=True, thick=32,
+                   sampler='nearest', depth=0.5, recache=False):
+    """Mask and pixel map of a tile.
+
+    Parameters
+    ----------
+    subject : str
+        Name of subject in pycortex store
+    xfmname : str
+        Name of transform for the pixel map. If None, the pixel map maps
+        vertices to pixels.
+    level, x, y : int
+        Zoom level and position of the tile, see the module documentation
+    tilesize : int
+        Width and height of the tiles, in pixels
+    pixelwise, thick, sampler, depth
+        See `get_flatcache`
+    recache : bool
+        Rebuild the cache of the tile
+
+    Returns
+    -------
+    mask : bool array
+        Mask of the window of the flatmap grid covered by the tile, with the
+        same orientation as the masks of `get_flatmask`
+    pixmap : sparse matrix
+        (pixels x voxels) or (pixels x vertices) matrix for the pixels of `mask`
+    """
+    from .. import cache
+    height = tilesize * 2**level
+    origin, shape = _get_tile_window(subject, level, x, y, tilesize)
+
+    name = "flattile_{tilesize}_{level}_{x}_{y}".format(tilesize=tilesize, level=level, x=x, y=y)
+    key = ('flattile', subject, tilesize, level, x, y)
+    # the tiles of the same inputs share a directory, removed once they change
+    if pixelwise and xfmname is not None:
+        extra = "l%d"%thick if thick > 1 else "d%g"%depth
+        name += "_{xfmname}_{sampler}_{extra}".format(xfmname=xfmname, sampler=sampler, extra=extra)
+        key += (xfmname, sampler, thick, depth)
+        cachedir = db.get_cache_path(subject, "tiles_%s" % xfmname,
+                                     surfaces=["flat", "fiducial", "wm", "pia"], xfmname=xfmname)
+    else:
+        cachedir = db.get_cache_path(subject, "tiles", surfaces=["flat"])
+    os.makedirs(cachedir, exist_ok=True)
+    cachefile = os.path.join(cachedir, name)
+
+    with cache.building(cachefile, recache) as stale:
+        if stale:
+            cache.memory.invalidate(*key)
+            mask = utils._draw_flatmask(subject, height, shape, origin)
+            if pixelwise and xfmname is not None:
+                _, polys = db.get_surf(subject, "flat", merge=True, nudge=True)
+                triangles, weights = utils._locate_pixels(subject, height, mask, origin)
+                sample = utils._get_pixel_sampler(subject, xfmname, thick=thick, depth=depth,
+                                                  sampler=sampler)
+                pixmap = sample(polys[triangles], weights)
+            else:
+                pixmap = utils._nearest_vertices(subject, height, mask, origin)
+            cache.save(cachefile, mask=mask, **cache.sparse_arrays(pixmap))
+            cache.memory.put(key + (cache.mtime(cachefile),), (mask, pixmap))
+        else:
+            mask, pixmap = cache.memory.get(key + (cache.mtime(cachefile),), (None, None))
+            if mask is None:
+                mask = cache.load(cachefile)['mask']
+                pixmap = cache.load_sparse(cachefile)
+                cache.memory.put(key + (cache.mtime(cachefile),), (mask, pixmap))
+
+    if not pixelwise and xfmname is not None:
+        from scipy import sparse
+        from .. import utils as cortex_utils
+        mapper = cortex_utils.get_mapper(subject, xfmname, sampler)
+        pixmap = pixmap * sparse.vstack(mapper.masks)
+
+    return mask, pixmap
+
+def make_tile_image(braindata, level, x, y, tilesize=256, recache=False, nanmean=False, **kwargs):
+    """Image of a tile of the flatmap of `braindata`.
+
+    Parameters
+    ----------
+    braindata : one of: {cortex.Volume, cortex.Vertex, cortex.Dataview}
+        Data to be plotted
+    level, x, y : int
+        Zoom level and position of the tile, see the module documentation
+    tilesize : int
+        Width and height of the tiles, in pixels
+    recache : bool
+        Rebuild the cache of the tile
+    nanmean : bool, optional (default = False)
+        If True, NaNs in the data will be ignored when averaging across layers.
+    **kwargs
+        Passed to `get_tile_cache`, e.g. sampler, thick, depth
+
+    Returns
+    -------
+    image : array
+        (tilesize, tilesize) float image like those of `make_flatmap_image`,
+        or (tilesize, tilesize, 4) uint8 image for RGB data. Pixels outside of
+        the flatmap are NaN (or transparent).
+    """
+    mask, pixmap = get_tile_cache(braindata.subject, getattr(braindata, 'xfmname', None), level,
+                                  x, y, tilesize=tilesize, recache=recache, **kwargs)
+    _, data = utils._get_map_data(braindata)
+    window = utils._make_pixmap_image(data, mask, pixmap, nanmean=nanmean)
+
+    if window.dtype == np.uint8:
+        image = np.zeros((tilesize, tilesize, 4), dtype=np.uint8)
+    else:
+        image = np.full((tilesize, tilesize), np.nan, dtype=window.dtype)
+    image[:window.shape[0], :window.shape[1]] = window
+    return image
+
+def make_tile(braindata, level, x, y, tilesize=256, recache=False, nanmean=False, **kwargs):
+    """PNG image of a tile of the flatmap of `braindata`, with the colormap
+    and limits of the dataview. See `make_tile_image` for the parameters.
+
+    Returns
+    -------
+    png : bytes
+        Contents of the PNG file of the tile
+    """
+    from PIL import Image
+    dataview = dataset.normalize(braindata)
+    if not isinstance(dataview, dataset.Dataview):
+        raise TypeError('Please provide a Dataview (e.g. an instance of cortex.Volume, cortex.Vertex, etc), not a Dataset')
+
+    image = make_tile_image(dataview, level, x, y, tilesize=tilesize, recache=recache,
+                            nanmean=nanmean, **kwargs)
+    if image.dtype != np.uint8:
+        image = utils._apply_colormap(image, dataview.cmap, dataview.vmin, dataview.vmax)
+    png = io.BytesIO()
+    Image.fromarray(image).save(png, format='png')
+    return png.getvalue()
+
+def serve(views, levels=6, tilesize=256, port=None, **kwargs):
+    """Serve the tiles of flatmaps over http.
+
+    Tiles are rendered on demand, and served at
+    ``http://<host>:<port>/tiles/<name>/<level>/<x>/<y>.png``, with the
+    description of the pyramid (see `get_tile_info`) at
+    ``http://<host>:<port>/tiles/<name>/info.json``.
+
+    Parameters
+    ----------
+    views : dict
+        Dataviews (e.g. cortex.Volume or cortex.Vertex) to serve, by name
+    levels : int
+        Number of zoom levels
+    tilesize : int
+        Width and height of the tiles, in pixels
+    port : int, optional
+        Port of the server, random if not given
+    **kwargs
+        Passed to `make_tile`, e.g. sampler, thick, depth
+
+    Returns
+    -------
+    server : cortex.webgl.serve.WebApp
+        The running server
+    """
+    import random
+    from ..webgl import serve as webserve
+    if port is None:
+        port = random.randint(1024, 65536)
+    server = webserve.WebApp([(r"/tiles/(.*)", webserve.TileHandler,
+                               dict(views=views, levels=levels, tilesize=tilesize, kwargs=kwargs))],
+                             port)
+    server.start()
+    print("Serving tiles on http://%s:%d/tiles/" % (webserve.hostname, port))
+    return server
@@ -1,9 +1,9 @@
 """Makes flattened views of volumetric data on the cortical surface.
 """
+import itertools
 import os
 import string
 import warnings
-from functools import reduce
 
 import numpy as np
 
@@ -40,29 +40,28 @@ def make_flatmap_image(braindata, height=1024, recache=False, nanmean=False, **k
 
     """
     mask, extents = get_flatmask(braindata.subject, height=height, recache=recache)
-    
+    xfmname, data = _get_map_data(braindata)
+    pixmap = get_flatcache(braindata.subject,
+                           xfmname,
+                           height=height,
+                           recache=recache,
+                           **kwargs)
+    return _make_pixmap_image(data, mask, pixmap, nanmean=nanmean), extents
+
+def _get_map_data(braindata):
+    """Transform name (None for vertex data) and data array of a Volume or Vertex"""
     if not hasattr(braindata, "xfmname"):
-        pixmap = get_flatcache(braindata.subject,
-                               None,
-                               height=height,
-                               recache=recache,
-                               **kwargs)
-        
         if isinstance(braindata, dataset.Vertex2D):
-            data = braindata.raw.vertices
-        else:
-            data = braindata.vertices
-    else:
-        pixmap = get_flatcache(braindata.subject,
-                               braindata.xfmname,
-                               height=height,
-                               recache=recache,
-                               **kwargs)
-        if isinstance(braindata, dataset.Volume2D):
-            data = braindata.raw.volume
-        else:
-            data = braindata.volume
+            return None, braindata.raw.vertices
+        return None, braindata.vertices
+    if isinstance(braindata, dataset.Volume2D):
+        return braindata.xfmname, braindata.raw.volume
+    return braindata.xfmname, braindata.volume
 
+def _make_pixmap_image(data, mask, pixmap, nanmean=False):
+    """Image of `data` mapped through the pixel map `pixmap` of the flatmap
+    pixels in `mask`, transposed and flipped for display. Pixels outside of
+    the mask are NaN, or transparent for RGBA data."""
     if data.shape[0] > 1:
         raise ValueError("Input data was not the correct dimensionality - please provide 3D Volume or 2D Vertex data")
 
@@ -76,7 +75,7 @@ def make_flatmap_image(braindata, height=1024, recache=False, nanmean=False, **k
         # Make img a c-contiguous array or pil will complain when saving it
         if not img.flags["C_CONTIGUOUS"]:
             img = img.copy(order="C")
-        return img, extents
+        return img
     else:
         badmask = np.array(pixmap.sum(1) > 0).ravel()
         img = (np.nan*np.ones(mask.shape)).astype(data.dtype)
@@ -115,7 +114,149 @@ def make_flatmap_image(braindata, height=1024, recache=False, nanmean=False, **k
         if not img.flags["C_CONTIGUOUS"]:
             img = img.copy(order="C")
 
-        return img, extents
+        return img
+
+def make_flatmap_images(braindata, height=1024, recache=False, nanmean=False, out=None,
+                        blocksize=64, dtype=float, **kwargs):
+    """Generate flatmap images for a stack of volumetric or vertex maps at once
+
+    Maps are rendered in blocks of `blocksize` maps, each with a single sparse
+    matrix product, so this is much faster than calling `make_flatmap_image`
+    for each map separately. The images are identical to those returned by
+    `make_flatmap_image`.
+
+    Parameters
+    ----------
+    braindata : one of: {cortex.Volume, cortex.Vertex, iterable}
+        A 4D Volume or 2D Vertex movie, or an iterable of Volume or Vertex
+        objects with the same subject (and transform, for volumes).
+    height : int
+        Height of the images, in pixels
+    recache : bool
+        Whether or not to recache intermediate files.
+    nanmean : bool, optional (default = False)
+        If True, NaNs in the data will be ignored when averaging across layers.
+    out : array_like, optional
+        (N, height, width) array to write the images into, for example an
+        np.memmap for stacks that do not fit in memory.
+    blocksize : int, optional
+        Number of maps rendered at once
+    dtype : dtype, optional
+        Data type of the images if `out` is not given. Defaults to float.
+    **kwargs
+        Passed to `get_flatcache`, e.g. sampler, thick, depth
+
+    Returns
+    -------
+    images : array_like
+        (N, height, width) stack of images, or `out` if given
+    extents : array
+        Extents of the images, as returned by `make_flatmap_image`
+    """
+    if isinstance(braindata, (dataset.Volume, dataset.Vertex)):
+        braindata = [braindata]
+    total = None
+    if isinstance(braindata, (list, tuple)):
+        total = sum(view.data.shape[0] if view.movie else 1 for view in braindata)
+
+    blocks, start, extents = [], 0, None
+    for images, extents in _iter_flatmap_images(braindata, height=height, recache=recache,
+                                                nanmean=nanmean, blocksize=blocksize,
+                                                dtype=dtype, **kwargs):
+        if out is None and total is not None:
+            out = np.empty((total,) + images.shape[1:], dtype=dtype)
+        if out is not None:
+            out[start:start+len(images)] = images
+        else:
+            blocks.append(images)
+        start += len(images)
+
+    if out is None:
+        out = np.concatenate(blocks)
+    return out, extents
+
+def _iter_flatmap_images(braindata, height=1024, recache=False, nanmean=False, blocksize=64,
+                         dtype=float, **kwargs):
+    """Yields (images, extents) for consecutive blocks of at most `blocksize`
+    flatmap images of `braindata`, see `make_flatmap_images`. Only one block
+    of images is held in memory at a time."""
+    if isinstance(braindata, (dataset.Volume, dataset.Vertex)):
+        braindata = [braindata]
+    views = iter(braindata)
+    first = next(views)
+    subject, xfmname, cols = _map_info(first)
+
+    mask, extents = get_flatmask(subject, height=height, recache=recache)
+    pixmap = get_flatcache(subject, xfmname, height=height, recache=recache, **kwargs)
+    if cols is not None:
+        # linear volumes only need the columns of the masked voxels
+        pixmap = pixmap[:, cols]
+    badmask = np.array(pixmap.sum(1) > 0).ravel()
+    pixmap = pixmap[badmask]
+
+    # position of every rendered pixel in the transposed and flipped images
+    xs, ys = np.nonzero(mask)
+    xs, ys = xs[badmask], mask.shape[1] - 1 - ys[badmask]
+    shape = mask.shape[::-1]
+
+    for data in _iter_map_blocks(itertools.chain([first], views), (subject, xfmname, cols), blocksize):
+        ignored = None
+        if not nanmean:  # NaN are not ignored
+            averaged = pixmap.dot(np.asarray(data, dtype=float).T)
+            if isinstance(data, np.ma.MaskedArray) or cols is not None:
+                # voxels outside the mask of linear volumes are ignored
+                ignored = np.ma.getmaskarray(data)
+        else:  # NaN are ignored
+            averaged = pixmap.dot(np.nan_to_num(np.asarray(data, dtype=float)).T)
+            ignored = np.isnan(np.asarray(data, dtype=float))
+            if isinstance(data, np.ma.MaskedArray):
+                ignored |= np.ma.getmaskarray(data)
+
+        if ignored is not None:
+            # normalize by the weights of the non-ignored values, see make_flatmap_image
+            weights_not_ignored = pixmap.dot((~ignored).T.astype(float))
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore", RuntimeWarning)
+                averaged = averaged / weights_not_ignored
+
+        images = np.full((len(data),) + shape, np.nan, dtype=dtype)
+        images[:, ys, xs] = averaged.T
+        yield images, extents
+
+def _map_info(view):
+    """Subject, transform name and masked voxel indices of a Volume or Vertex"""
+    if isinstance(view, dataset.Volume):
+        cols = np.nonzero(view.mask.ravel())[0] if view.linear else None
+        return view.subject, view.xfmname, cols
+    elif isinstance(view, dataset.Vertex):
+        return view.subject, None, None
+    raise TypeError("Can only render Volume or Vertex data, not %r" % (view,))
+
+def _iter_map_blocks(views, info, blocksize):
+    """Yields (n, ncols) blocks of at most `blocksize` maps from the Volume or
+    Vertex objects in `views`, which must all match `info` (see `_map_info`)"""
+    def concatenate(arrays):
+        if any(isinstance(a, np.ma.MaskedArray) for a in arrays):
+            return np.ma.concatenate(arrays)
+        return np.concatenate(arrays)
+
+    pending, npending = [], 0
+    for view in views:
+        subject, xfmname, cols = _map_info(view)
+        if subject != info[0] or xfmname != info[1] or \
+                (cols is None) != (info[2] is None) or (cols is not None and not np.array_equal(cols, info[2])):
+            raise ValueError("All maps must have the same subject, transform and mask")
+        data = view.data if view.movie else view.data[np.newaxis]
+        data = data.reshape(len(data), -1)
+        for start in range(0, len(data), blocksize):
+            pending.append(data[start:start+blocksize])
+            npending += len(pending[-1])
+            if npending >= blocksize:
+                block = concatenate(pending)
+                yield block[:blocksize]
+                pending, npending = [block[blocksize:]], len(block) - blocksize
+    if npending > 0:
+        yield concatenate(pending)
 
 def get_flatmask(subject, height=1024, recache=False):
     """
@@ -127,17 +268,38 @@ def get_flatmask(subject, height=1024, recache=False):
         Height in pixels to generate the image
     recache : bool
         Recache the intermediate files? Can resolve some issues but is slower.
+
+    Notes
+    -----
+    If a master height is configured (`flatmap_master_height` in the [basic]
+    section of the config) and `height` is lower, the mask is downsampled from
+    the mask of the master height, see `get_flatcache`.
     """
-    cachedir = db.get_cache(subject)
-    cachefile = os.path.join(cachedir, "flatmask_{h}.npz".format(h=height))
+    from .. import cache
+    name = "flatmask_{h}".format(h=height)
+    key = ('flatmask', subject, height)
+    master = _get_master_height(height)
+    if master is not None:
+        name += "_from{m}".format(m=master)
+        key += (master,)
+    cachefile = db.get_cache_path(subject, name, surfaces=["flat"])
 
-    if not os.path.exists(cachefile) or recache:
-        mask, extents = _make_flatmask(subject, height=height)
-        np.savez(cachefile, mask=mask, extents=extents)
-    else:
-        npz = np.load(cachefile)
-        mask, extents = npz['mask'], npz['extents']
-        npz.close()
+    with cache.building(cachefile, recache) as stale:
+        if stale:
+            cache.memory.invalidate(*key)
+            if master is not None:
+                master_mask, extents = get_flatmask(subject, height=master)
+                mask, _ = _make_pooling(master_mask, _get_flatmask_shape(subject, height))
+            else:
+                mask, extents = _make_flatmask(subject, height=height)
+            cache.save(cachefile, mask=mask, extents=extents)
+            cache.memory.put(key + (cache.mtime(cachefile),), (mask, extents))
+        else:
+            mask, extents = cache.memory.get(key + (cache.mtime(cachefile),), (None, None))
+            if mask is None:
+                arrays = cache.load(cachefile)
+                mask, extents = arrays['mask'], arrays['extents']
+                cache.memory.put(key + (cache.mtime(cachefile),), (mask, extents))
 
     return mask, extents
 
@@ -165,26 +327,56 @@ def get_flatcache(subject, xfmname, pixelwise=True, thick=32, sampler='nearest',
     
     Returns
     -------
+
+    Notes
+    -----
+    Flatmaps of several heights can share a single master cache: if the
+    `flatmap_master_height` option of the [basic] section of the config is
+    set, caches for lower heights are not built from scratch, but derived
+    from the cache at the master height by averaging the rows of the master
+    pixels within each lower resolution pixel (see `_make_pooling`). Building
+    all the heights then costs little more than building the master one.
     """
-    cachedir = db.get_cache(subject)
-    cachefile = os.path.join(cachedir, "flatverts_{height}.npz").format(height=height)
+    from .. import cache
+    name = "flatverts_{height}".format(height=height)
+    # loaded pixel maps are kept in memory, keyed by the time the cache was written
+    key = ('flatverts', subject, height)
+    inputs = dict(surfaces=["flat"])
     if pixelwise and xfmname is not None:
-        cachefile = os.path.join(cachedir, "flatpixel_{xfmname}_{height}_{sampler}_{extra}.npz")
         extra = "l%d"%thick if thick > 1 else "d%g"%depth
-        cachefile = cachefile.format(height=height, xfmname=xfmname, sampler=sampler, extra=extra)
+        name = "flatpixel_{xfmname}_{height}_{sampler}_{extra}".format(
+            height=height, xfmname=xfmname, sampler=sampler, extra=extra)
+        key = ('flatpixel', subject, xfmname, height, sampler, thick, depth)
+        inputs = dict(surfaces=["flat", "fiducial", "wm", "pia"], xfmname=xfmname)
+    master = _get_master_height(height)
+    if master is not None:
+        name += "_from{m}".format(m=master)
+        key += (master,)
+    cachefile = db.get_cache_path(subject, name, **inputs)
 
-    if not os.path.exists(cachefile) or recache:
-        print("Generating a flatmap cache")
-        if pixelwise and xfmname is not None:
-            pixmap = _make_pixel_cache(subject, xfmname, height=height, sampler=sampler, thick=thick, depth=depth)
+    with cache.building(cachefile, recache) as stale:
+        if stale:
+            print("Generating a flatmap cache")
+            cache.memory.invalidate(*key)
+            if master is not None:
+                master_pixmap = get_flatcache(subject, xfmname if pixelwise else None, pixelwise=pixelwise,
+                                              thick=thick, sampler=sampler, height=master, depth=depth)
+                master_mask, _ = get_flatmask(subject, height=master)
+                _, pooling = _make_pooling(master_mask, _get_flatmask_shape(subject, height),
+                                           master_pixmap)
+                pixmap = (pooling * master_pixmap).tocsr()
+            elif pixelwise and xfmname is not None:
+                pixmap = _make_pixel_cache(subject, xfmname, height=height, sampler=sampler, thick=thick,
+                                           depth=depth, recache=recache)
+            else:
+                pixmap = _make_vertex_cache(subject, height=height)
+            cache.save(cachefile, **cache.sparse_arrays(pixmap))
+            cache.memory.put(key + (cache.mtime(cachefile),), pixmap)
         else:
-            pixmap = _make_vertex_cache(subject, height=height)
-        np.savez(cachefile, data=pixmap.data, indices=pixmap.indices, indptr=pixmap.indptr, shape=pixmap.shape)
-    else:
-        from scipy import sparse
-        npz = np.load(cachefile)
-        pixmap = sparse.csr_matrix((npz['data'], npz['indices'], npz['indptr']), shape=npz['shape'])
-        npz.close()
+            pixmap = cache.memory.get(key + (cache.mtime(cachefile),))
+            if pixmap is None:
+                pixmap = cache.load_sparse(cachefile)
+                cache.memory.put(key + (cache.mtime(cachefile),), pixmap)
 
     if not pixelwise and xfmname is not None:
         from scipy import sparse
@@ -193,6 +385,49 @@ def get_flatcache(subject, xfmname, pixelwise=True, thick=32, sampler='nearest',
 
     return pixmap
 
+def get_flatbary(subject, height=1024, recache=False):
+    """Triangle of the flat surface containing each pixel of the flatmap, and
+    the barycentric coordinates of the pixel in that triangle.
+
+    This only depends on the subject and the height, and is shared by the
+    flatmap caches of all transforms, samplers and depths.
+
+    Parameters
+    ----------
+    subject : str
+        Name of subject in pycortex store
+    height : int
+        Height in pixels of the flatmap
+    recache : bool
+        Recache the intermediate files? Can resolve some issues but is slower.
+
+    Returns
+    -------
+    triangles : (n,) array
+        Index in the polys of the merged flat surface of the triangle
+        containing each of the n pixels of the flatmask. Pixels outside of the
+        mesh are assigned to a triangle of their nearest vertex.
+    weights : (n, 3) array
+        Barycentric coordinates of each pixel in its triangle
+    """
+    from .. import cache
+    cachefile = db.get_cache_path(subject, "flatbary_{h}".format(h=height), surfaces=["flat"])
+    key = ('flatbary', subject, height)
+    with cache.building(cachefile, recache) as stale:
+        if stale:
+            cache.memory.invalidate(*key)
+            triangles, weights = _make_flatbary(subject, height=height)
+            cache.save(cachefile, triangles=triangles, weights=weights)
+            cache.memory.put(key + (cache.mtime(cachefile),), (triangles, weights))
+        else:
+            triangles, weights = cache.memory.get(key + (cache.mtime(cachefile),), (None, None))
+            if triangles is None:
+                arrays = cache.load(cachefile)
+                triangles, weights = arrays['triangles'], arrays['weights']
+                cache.memory.put(key + (cache.mtime(cachefile),), (triangles, weights))
+
+    return triangles, weights
+
 def _return_pixel_pairs(vert_pair_list, x_dict, y_dict):
     """Janky and probably unnecessary"""
     pix_list = []
@@ -353,119 +588,477 @@ def _make_hatch_image(hatch_data, height, sampler='nearest', hatch_space=4, reca
 
     return hatchim
 
+def get_curvature_image(subject, height=1024, threshold=True, contrast=None, brightness=None,
+                        smooth=None, recache=False, curvature_lims=0.5, legacy_mode=False):
+    """Curvature background image of the flatmap, with values on [0, 1] to be
+    shown with a gray colormap. See `composite.add_curvature` for the parameters.
+
+    Images are cached on disk and in memory for each set of parameters, so
+    the curvature costs nothing after the first flatmap of a subject. The
+    returned image is shared with the cache and read-only.
+    """
+    import hashlib
+    from .. import cache
+
+    # resolve the defaults, so that equivalent parameters share a cache
+    smooth = _get_curvature_smoothing(smooth)
+    if threshold is None:
+        threshold = config.get('curvature', 'threshold').lower() in ('true', 't', '1', 'y', 'yes')
+    if brightness is None:
+        brightness = float(config.get('curvature', 'brightness'))
+    if contrast is None:
+        contrast = float(config.get('curvature', 'contrast'))
+    if not isinstance(curvature_lims, (list, tuple)):
+        curvature_lims = -curvature_lims, curvature_lims
+    params = dict(threshold=bool(threshold), contrast=float(contrast), brightness=float(brightness),
+                  smooth=None if smooth is None else float(smooth),
+                  curvature_lims=tuple(float(lim) for lim in curvature_lims),
+                  legacy_mode=bool(legacy_mode))
+    params = tuple(sorted(params.items()))
+    # images derived from master flatmap caches have a slightly different mask
+    master = _get_master_height(height)
+    ident = params if master is None else params + (('master', master),)
+
+    digest = hashlib.sha1(repr(ident).encode()).hexdigest()[:16]
+    curvfile = db.get_paths(subject)['surfinfo'].format(type="curvature", opts="")
+    cachefile = db.get_cache_path(subject, "curvature_{h}_{d}".format(h=height, d=digest),
+                                  surfaces=["flat", "fiducial"], files=[curvfile])
+    key = ('curvature', subject, height, ident)
+    with cache.building(cachefile, recache) as stale:
+        if stale:
+            cache.memory.invalidate(*key)
+            curv_im = _make_curvature_image(subject, height, recache=recache, **dict(params))
+            curv_im.flags.writeable = False
+            cache.save(cachefile, curvature=curv_im)
+            cache.memory.put(key + (cache.mtime(cachefile),), curv_im)
+        else:
+            curv_im = cache.memory.get(key + (cache.mtime(cachefile),))
+            if curv_im is None:
+                curv_im = cache.load(cachefile)['curvature']
+                curv_im.flags.writeable = False
+                cache.memory.put(key + (cache.mtime(cachefile),), curv_im)
+    return curv_im
+
+def _get_curvature_smoothing(smooth=None):
+    """Smoothing of the curvature, defaulting to the configured one (which
+    might still be None)"""
+    if smooth is None:
+        default_smoothing = config.get('curvature', 'smooth')
+        if default_smoothing.lower() != 'none':
+            smooth = np.float_(default_smoothing)
+    return smooth
+
+def _make_curvature_image(subject, height, threshold=True, contrast=None, brightness=None,
+                          smooth=None, recache=False, curvature_lims=0.5, legacy_mode=False):
+    """Make the curvature background image, see `get_curvature_image`"""
+    # Get curvature map as image
+    smooth = _get_curvature_smoothing(smooth)
+    if smooth is None:
+        # If no value for 'smooth' is given in kwargs, db.get_surfinfo returns
+        # the default curvature value, whatever that may be. This is the behavior
+        # that we want a None in the code to invoke. This is silly and complicated
+        # due to backward compatibility issues with some old subjects.
+        curv_vertices = db.get_surfinfo(subject)
+    else:
+        curv_vertices = db.get_surfinfo(subject, smooth=smooth)
+    curv, _ = make_flatmap_image(curv_vertices, recache=recache, height=height)
+    # Option to use thresholded curvature
+    default_threshold = config.get('curvature','threshold').lower() in ('true', 't', '1', 'y', 'yes')
+    use_threshold_curvature = default_threshold if threshold is None else threshold
+    if legacy_mode and use_threshold_curvature:
+        curvT = (curv>0).astype(np.float32)
+        curvT[np.isnan(curv)] = np.nan
+        curv = curvT
+    if isinstance(curvature_lims, (list, tuple)):
+        vmin, vmax = curvature_lims
+    else:
+        vmin, vmax = -curvature_lims, curvature_lims
+    # First, limit to sensible range for flatmap curvature
+    curv_im = (curv - vmin) / float(vmax - vmin)
+    if not legacy_mode:
+        if use_threshold_curvature:
+            # Assumes symmetrical curvature_lims
+            curv_im = (np.nan_to_num(curv_im) > 0.5).astype(float)
+            curv_im[np.isnan(curv)] = np.nan
+        # Get defaults for brightness, contrast
+        if brightness is None:
+            brightness = float(config.get('curvature', 'brightness'))
+        if contrast is None:
+            contrast = float(config.get('curvature', 'contrast'))
+        # Scale and shift curvature image
+        curv_im = (curv_im - 0.5) * contrast + brightness
+    return curv_im
+
+_colormap_luts = dict()
+
+def _get_colormap_lut(cmap):
+    """uint8 RGBA lookup table for a colormap, as used by matplotlib to render
+    images: N colors, followed by the colors for under, over and bad values.
+
+    `cmap` can be a matplotlib Colormap or the name of a matplotlib or pycortex
+    colormap. Tables are computed once per colormap name.
+    """
+    key = cmap if isinstance(cmap, str) else id(cmap)
+    if key in _colormap_luts:
+        return _colormap_luts[key]
+
+    colormap = cmap
+    if isinstance(cmap, str):
+        try:
+            from matplotlib import colormaps
+            colormap = colormaps[cmap]
+        except ImportError:
+            from matplotlib import cm
+            try:
+                colormap = cm.get_cmap(cmap)
+            except ValueError:
+                colormap = None
+        except KeyError:
+            colormap = None
+
+    if colormap is not None:
+        colors = colormap(np.arange(colormap.N))
+        extra = [colormap.get_under(), colormap.get_over(), colormap.get_bad()]
+        lut = np.vstack([colors, extra])
+    else:
+        from PIL import Image
+        cmapfile = os.path.join(config.get('webgl', 'colormaps'), cmap + ".png")
+        if not os.path.exists(cmapfile):
+            raise ValueError('Unkown color map %s' % cmap)
+        colors = np.array(Image.open(cmapfile).convert("RGBA"), dtype=float).reshape(-1, 4) / 255.
+        lut = np.vstack([colors, colors[0], colors[-1], [0, 0, 0, 0]])
+
+    # matplotlib truncates the colormap to bytes
+    lut = (lut * 255).astype(np.uint8)
+    if isinstance(cmap, str):
+        _colormap_luts[key] = lut
+    return lut
+
+def _apply_colormap(data, cmap, vmin=None, vmax=None):
+    """Map a float image to uint8 RGBA colors like matplotlib's imshow"""
+    lut = _get_colormap_lut(cmap)
+    N = len(lut) - 3
+    if vmin is None:
+        vmin = np.nanmin(data)
+    if vmax is None:
+        vmax = np.nanmax(data)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        if vmin == vmax:
+            xa = np.zeros_like(data, dtype=float)
+        else:
+            xa = (data - vmin) / float(vmax - vmin)
+        xa = xa * N
+        xa[xa == N] = N - 1
+        idx = np.clip(xa, -1, N).astype(int)
+    idx[xa < 0] = N
+    idx[xa >= N] = N + 1
+    idx[np.isnan(xa)] = N + 2
+    return lut[idx]
+
+def _alpha_composite(dst, src):
+    """Composite the RGBA image `src` over `dst` in place. Both are float
+    arrays with straight (not premultiplied) alpha on [0, 1]."""
+    sa, da = src[..., 3:], dst[..., 3:]
+    alpha = sa + da * (1 - sa)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        color = (src[..., :3] * sa + dst[..., :3] * da * (1 - sa)) / alpha
+    dst[..., :3] = np.where(alpha > 0, color, dst[..., :3])
+    dst[..., 3:] = alpha
+    return dst
+
+def _get_master_height(height):
+    """Configured height of the master flatmap caches from which the caches
+    for `height` are derived, or None if they are built from scratch"""
+    if not config.has_option('basic', 'flatmap_master_height'):
+        return None
+    master = config.get('basic', 'flatmap_master_height').strip()
+    if master.lower() in ('', 'none') or int(master) <= height:
+        return None
+    return int(master)
+
+def _get_flatmask_shape(subject, height):
+    """Shape of the flatmask of the given height, as made by `_make_flatmask`"""
+    _, _, fmin, fmax = _get_flat_boundary(subject)
+    size = fmax - fmin
+    return int(height / size[1] * size[0]), height
+
+def _make_pooling(master_mask, shape, master_pixmap=None):
+    """Downsample the flatmap cache of a higher resolution (master) mask.
+
+    Each pixel of the master grid is assigned to the nearest pixel of the
+    lower resolution grid of the given `shape`, which spans the same extents.
+    A low resolution pixel is in the mask if any of its master pixels is, like
+    the edge pixels of the polygons drawn by `_make_flatmask`.
+
+    Parameters
+    ----------
+    master_mask : (W, H) bool array
+        Mask of the master flatmap
+    shape : (w, h) tuple
+        Shape of the lower resolution mask
+    master_pixmap : sparse matrix, optional
+        Master pixel map. If given, the master pixels without any entry (such
+        as pixels outside of the volume) are left out of the average.
+
+    Returns
+    -------
+    mask : (w, h) bool array
+        Lower resolution mask
+    pooling : sparse (mask.sum(), master_mask.sum()) matrix
+        Averages the rows of the master pixel map into the rows of the lower
+        resolution one
+    """
+    from scipy import sparse
+    width, height = shape
+    # nearest low resolution row and column of every master row and column
+    col = np.rint(np.arange(master_mask.shape[0]) * (width - 1) / (master_mask.shape[0] - 1.)).astype(int)
+    row = np.rint(np.arange(master_mask.shape[1]) * (height - 1) / (master_mask.shape[1] - 1.)).astype(int)
+
+    i, j = np.nonzero(master_mask)
+    pixel = col[i] * height + row[j]
+    mask = np.bincount(pixel, minlength=width * height).reshape(shape) > 0
+
+    index = np.full(shape, -1, dtype=np.int64)
+    index[mask] = np.arange(mask.sum())
+    target = index.ravel()[pixel]
+    weight = np.ones(len(pixel))
+    if master_pixmap is not None:
+        weight[np.diff(master_pixmap.indptr) == 0] = 0
+    valid = (target >= 0) & (weight > 0)
+    counts = np.bincount(target[valid], minlength=mask.sum())
+    weight = weight[valid] / counts[target[valid]]
+    pooling = sparse.csr_matrix((weight, (target[valid], np.nonzero(valid)[0])),
+                                shape=(mask.sum(), len(pixel)))
+    return mask, pooling
+
 def _make_flatmask(subject, height=1024):
-    from PIL import Image, ImageDraw
+    _, _, fmin, fmax = _get_flat_boundary(subject)
+    extents = np.hstack([fmin, fmax])[[0,3,1,4]]
+    return _draw_flatmask(subject, height, _get_flatmask_shape(subject, height)), extents
+
+def _get_flat_boundary(subject):
+    """Positions of the boundary vertices of the left and right hemispheres
+    of the flat surface, and the minimum and maximum of all its vertices"""
+    from .. import cache, polyutils
+    key = ('flatboundary', subject)
+    boundary = cache.memory.get(key)
+    if boundary is None:
+        pts, polys = db.get_surf(subject, "flat", merge=True, nudge=True)
+        left, right = polyutils.trace_poly(polyutils.boundary_edges(polys))
+        boundary = cache.memory.put(key, (pts[left], pts[right], pts.min(0), pts.max(0)))
+    return boundary
 
-    from .. import polyutils
-    pts, polys = db.get_surf(subject, "flat", merge=True, nudge=True)
-    left, right = polyutils.trace_poly(polyutils.boundary_edges(polys))
+def _draw_flatmask(subject, height, shape, origin=(0, 0)):
+    """Mask of the window of the flatmap grid of the given `height` which
+    starts at pixel `origin` and has the given `shape`, both as (x, y)."""
+    from PIL import Image, ImageDraw
+    left, right, fmin, fmax = _get_flat_boundary(subject)
 
-    aspect = (height / (pts.max(0) - pts.min(0))[1])
-    lpts = (pts[left] - pts.min(0)) * aspect
-    rpts = (pts[right] - pts.min(0)) * aspect
+    # polygons are clipped differently along the edges of the image, so
+    # windows are drawn with a margin to match the full mask
+    full = tuple(origin) == (0, 0) and tuple(shape) == _get_flatmask_shape(subject, height)
+    margin = 0 if full else 2
+    aspect = (height / (fmax - fmin)[1])
+    offset = np.array([origin[0] - margin, origin[1] - margin, 0])
+    lpts = (left - fmin) * aspect - offset
+    rpts = (right - fmin) * aspect - offset
 
-    im = Image.new('L', (int(aspect * (pts.max(0) - pts.min(0))[0]), height))
+    im = Image.new('L', (int(shape[0]) + 2*margin, int(shape[1]) + 2*margin))
     draw = ImageDraw.Draw(im)
     draw.polygon(lpts[:,:2].ravel().tolist(), fill=255)
     draw.polygon(rpts[:,:2].ravel().tolist(), fill=255)
-    extents = np.hstack([pts.min(0), pts.max(0)])[[0,3,1,4]]
+    mask = np.array(im).T > 0
+    return mask[margin:mask.shape[0]-margin, margin:mask.shape[1]-margin]
+
+def _make_flatbary(subject, height=1024, chunksize=65536):
+    """Locate the pixels of the flatmask in the triangles of the flat surface,
+    see `get_flatbary`."""
+    mask, extents = get_flatmask(subject, height=height)
+    return _locate_pixels(subject, height, mask, chunksize=chunksize)
+
+def _locate_pixels(subject, height, mask, origin=(0, 0), chunksize=65536):
+    """Triangles and barycentric coordinates of the pixels of `mask`, a window
+    of the flatmap grid of the given `height` starting at pixel `origin`.
+
+    Triangles are rasterized directly: the pixels within the bounding box of
+    each triangle are tested with their barycentric coordinates. Triangles
+    are processed in chunks of `chunksize` to bound memory use.
+    """
+    flat, polys = db.get_surf(subject, "flat", merge=True, nudge=True)
+    width = _get_flatmask_shape(subject, height)[0]
+    _, _, fmin, fmax = _get_flat_boundary(subject)
+    # vertex positions in units of pixels of the flatmap grid (see _make_pixel_cache)
+    scale = (np.array([width, height]) - 1) / (fmax - fmin)[:2]
+    pts = (flat[:, :2] - fmin[:2]) * scale
+    # and relative to the window
+    wpts = pts - np.asarray(origin)
+
+    # only the triangles near the window are rasterized, with a margin so that
+    # the nearest vertices of pixels outside of the mesh are included
+    keep = np.arange(len(polys))
+    if mask.shape != (width, height):
+        from .. import cache
+        key = ('flattriangles', subject)
+        bounds = cache.memory.get(key)
+        if bounds is None:
+            corners = flat[polys, :2]
+            bounds = cache.memory.put(key, (corners.min(1), corners.max(1)))
+        low = (bounds[0] - fmin[:2]) * scale - origin
+        high = (bounds[1] - fmin[:2]) * scale - origin
+        margin = (high - low).max() + 2
+        keep = np.nonzero(np.all((high >= -margin) & (low <= np.array(mask.shape) - 1 + margin), axis=1))[0]
+    polys = polys[keep]
+
+    index = np.full(mask.shape, -1, dtype=np.int64)
+    index[mask] = np.arange(mask.sum())
+    triangles = np.full(mask.sum(), -1, dtype=np.int32)
+    weights = np.zeros((mask.sum(), 3))
+    for start in range(0, len(polys), chunksize):
+        corners = wpts[polys[start:start+chunksize]]
+        low = np.maximum(np.ceil(corners.min(1)), 0).astype(int)
+        high = np.minimum(np.floor(corners.max(1)), np.array(mask.shape) - 1).astype(int)
+        nx, ny = np.maximum(high - low + 1, 0).T
+        counts = nx * ny
+
+        # every pixel in the bounding box of every triangle
+        tri = np.repeat(np.arange(len(corners)), counts)
+        k = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        i, j = low[tri, 0] + k // ny[tri], low[tri, 1] + k % ny[tri]
 
-    return np.array(im).T > 0, extents
+        a = corners[tri, 0]
+        v0, v1 = corners[tri, 1] - a, corners[tri, 2] - a
+        v2 = np.column_stack([i, j]) - a
+        with np.errstate(invalid='ignore', divide='ignore'):
+            denom = v0[:, 0] * v1[:, 1] - v1[:, 0] * v0[:, 1]
+            l1 = (v2[:, 0] * v1[:, 1] - v1[:, 0] * v2[:, 1]) / denom
+            l2 = (v0[:, 0] * v2[:, 1] - v2[:, 0] * v0[:, 1]) / denom
+            ll = np.column_stack([1 - l1 - l2, l1, l2])
+            inside = np.all(ll >= -1e-9, axis=1) & (denom != 0)
+        pix = index[i[inside], j[inside]]
+        inmask = pix >= 0
+        triangles[pix[inmask]] = start + tri[inside][inmask]
+        weights[pix[inmask]] = ll[inside][inmask]
+
+    # pixels of the mask just outside of the mesh (along its borders and cuts)
+    # take the value of the nearest vertex
+    missing = np.nonzero(triangles < 0)[0]
+    if len(missing) > 0:
+        from scipy.spatial import cKDTree
+        valid = np.unique(polys)
+        _, nearest = cKDTree(wpts[valid]).query(np.column_stack(np.nonzero(mask))[missing])
+        # one triangle for each vertex, and the corner of the vertex in it
+        vert_triangle = np.zeros((len(flat), 2), dtype=np.int64)
+        for corner in range(3):
+            vert_triangle[polys[:, corner]] = np.column_stack([np.arange(len(polys)),
+                                                               np.full(len(polys), corner)])
+        tri, corner = vert_triangle[valid[nearest]].T
+        triangles[missing] = tri
+        weights[missing] = 0
+        weights[missing, corner] = 1
+
+    return keep[triangles].astype(np.int32), weights
 
 def _make_vertex_cache(subject, height=1024):
+    mask, extents = get_flatmask(subject, height=height)
+    assert mask.shape == _get_flatmask_shape(subject, height)
+    return _nearest_vertices(subject, height, mask)
+
+def _nearest_vertices(subject, height, mask, origin=(0, 0)):
+    """Sparse (pixels x vertices) matrix selecting the nearest vertex of each
+    pixel of `mask`, a window of the flatmap grid starting at pixel `origin`"""
     from scipy import sparse
     from scipy.spatial import cKDTree
     flat, polys = db.get_surf(subject, "flat", merge=True, nudge=True)
     valid = np.unique(polys)
-    fmax, fmin = flat.max(0), flat.min(0)
-    size = fmax - fmin
-    aspect = size[0] / size[1]
-    width = int(aspect * height)
-    grid = np.mgrid[fmin[0]:fmax[0]:width*1j, fmin[1]:fmax[1]:height*1j].reshape(2,-1)
-
-    mask, extents = get_flatmask(subject, height=height)
-    assert mask.shape[0] == width and mask.shape[1] == height
+    _, _, fmin, fmax = _get_flat_boundary(subject)
+    width = _get_flatmask_shape(subject, height)[0]
+    xs = np.linspace(fmin[0], fmax[0], width)[origin[0]:origin[0] + mask.shape[0]]
+    ys = np.linspace(fmin[1], fmax[1], height)[origin[1]:origin[1] + mask.shape[1]]
+    grid = np.array(np.meshgrid(xs, ys, indexing='ij')).reshape(2, -1)
 
     kdt = cKDTree(flat[valid,:2])
     dist, vert = kdt.query(grid.T[mask.ravel()])
     dataij = (np.ones((len(vert),)), np.array([np.arange(len(vert)), valid[vert]]))
     return sparse.csr_matrix(dataij, shape=(mask.sum(), len(flat)))
 
-def _make_pixel_cache(subject, xfmname, height=1024, thick=32, depth=0.5, sampler='nearest'):
+def _make_pixel_cache(subject, xfmname, height=1024, thick=32, depth=0.5, sampler='nearest',
+                      chunksize=65536, procs=None, recache=False):
+    """Build the sparse (pixels x voxels) matrix mapping volume data to flatmap pixels.
+
+    The triangle and barycentric coordinates of each pixel come from
+    `get_flatbary`, which is shared by all transforms and samplers, so this
+    only transforms and samples the surface positions of the pixels.
+
+    Pixels are processed in chunks of `chunksize`. For each chunk, the samples
+    of all `thick` depth layers are collected as COO triplets and summed into a
+    CSR matrix in one pass, so memory use is bounded by the chunk size rather
+    than by the size of the full matrix. Chunks are processed in parallel with
+    `procs` processes (see `cortex.mp.get_procs`).
+    """
     from scipy import sparse
-    from scipy.spatial import Delaunay
+    from .. import mp
     flat, polys = db.get_surf(subject, "flat", merge=True, nudge=True)
-    valid = np.unique(polys)
-    fmax, fmin = flat.max(0), flat.min(0)
-    size = fmax - fmin
-    aspect = size[0] / size[1]
-    width = int(aspect * height)
-    grid = np.mgrid[fmin[0]:fmax[0]:width*1j, fmin[1]:fmax[1]:height*1j].reshape(2,-1)
+    triangles, weights = get_flatbary(subject, height=height, recache=recache)
+    sample = _get_pixel_sampler(subject, xfmname, thick=thick, depth=depth, sampler=sampler)
 
-    mask, extents = get_flatmask(subject, height=height)
-    assert mask.shape[0] == width and mask.shape[1] == height
+    def _pixel_chunk(start):
+        return sample(polys[triangles[start:start+chunksize]], weights[start:start+chunksize])
 
-    # Get barycentric coordinates
-    dl = Delaunay(flat[valid,:2])
-    simps = dl.find_simplex(grid.T[mask.ravel()])
-    missing = simps == -1
-    tfms = dl.transform[simps]
-    l1, l2 = (tfms[:,:2].transpose(1,2,0) * (grid.T[mask.ravel()] - tfms[:,2]).T).sum(1)
-    l3 = 1 - l1 - l2
+    chunks = mp.map(_pixel_chunk, range(0, len(triangles), chunksize), procs=procs, batchsize=1)
+    if len(chunks) == 0:
+        return sparse.csr_matrix((0, sample.nvox))
+    return sparse.vstack(chunks, format='csr')
 
-    ll = np.vstack([l1, l2, l3])
-    ll[:,missing] = 0
+def _get_pixel_sampler(subject, xfmname, thick=32, depth=0.5, sampler='nearest'):
+    """Function sampling the volume at the surface positions of pixels.
 
+    The returned function takes the (n, 3) vertex indices of the triangle of
+    each pixel and the (n, 3) barycentric coordinates of the pixel in it, and
+    returns the sparse (n x voxels) matrix averaging the samples of the `thick`
+    depth layers of each pixel.
+    """
+    from scipy import sparse
     from ..mapper import samplers
     xfm = db.get_xfm(subject, xfmname, xfmtype='coord')
     sampclass = getattr(samplers, sampler)
+    nvox = np.prod(xfm.shape)
 
-    # Transform fiducial vertex locations to pixel locations using barycentric xfm
     try:
-        pia, polys = db.get_surf(subject, "pia", merge=True, nudge=False)
-        wm, polys = db.get_surf(subject, "wm", merge=True, nudge=False)
-        piacoords = xfm((pia[valid][dl.simplices][simps] * ll[np.newaxis].T).sum(1))
-        wmcoords = xfm((wm[valid][dl.simplices][simps] * ll[np.newaxis].T).sum(1))
-
-        valid_p = np.array([np.all((0 <= piacoords), axis=1),
-                            piacoords[:,0] < xfm.shape[2],
-                            piacoords[:,1] < xfm.shape[1],
-                            piacoords[:,2] < xfm.shape[0]])
-        valid_p = np.all(valid_p, axis=0)
-
-        valid_w = np.array([np.all((0 <= wmcoords), axis=1),
-                            wmcoords[:,0] < xfm.shape[2],
-                            wmcoords[:,1] < xfm.shape[1],
-                            wmcoords[:,2] < xfm.shape[0]])
-        valid_w = np.all(valid_w, axis=0)
-
-        valid = np.logical_and(valid_p, valid_w)
-        vidx = np.nonzero(valid)[0]
-        mapper = sparse.csr_matrix((mask.sum(), np.prod(xfm.shape)))
+        pia, _ = db.get_surf(subject, "pia", merge=True, nudge=False)
+        wm, _ = db.get_surf(subject, "wm", merge=True, nudge=False)
+        surfs = [pia, wm]
         if thick == 1:
-            i, j, data = sampclass(piacoords[valid]*depth + wmcoords[valid]*(1-depth), xfm.shape)
-            mapper = mapper + sparse.csr_matrix((data / float(thick), (vidx[i], j)),
-                                                shape=mapper.shape)
-            return mapper
+            depths = [depth]
+        else:
+            depths = np.linspace(0, 1, thick+2)[1:-1]
+    except IOError:
+        fid, _ = db.get_surf(subject, "fiducial", merge=True)
+        surfs = [fid]
+        depths, thick = [1.], 1
 
-        for t in np.linspace(0, 1, thick+2)[1:-1]:
-            i, j, data = sampclass(piacoords[valid]*t + wmcoords[valid]*(1-t), xfm.shape)
-            mapper = mapper + sparse.csr_matrix((data / float(thick), (vidx[i], j)),
-                                                shape=mapper.shape)
-        return mapper
+    shape = np.array(xfm.shape[::-1])
 
-    except IOError:
-        fid, polys = db.get_surf(subject, "fiducial", merge=True)
-        fidcoords = xfm((fid[valid][dl.simplices][simps] * ll[np.newaxis].T).sum(1))
+    def sample(tris, ll):
+        # Transform surface vertex locations to pixel locations
+        coords = [xfm(np.einsum('nij,ni->nj', surf[tris], ll)) for surf in surfs]
+        inside = np.all([((c >= 0) & (c < shape)).all(1) for c in coords], axis=0)
+        vidx = np.nonzero(inside)[0]
+        coords = [c[inside] for c in coords]
 
-        valid = reduce(np.logical_and,
-                       [reduce(np.logical_and, (0 <= fidcoords).T),
-                        fidcoords[:, 0] < xfm.shape[2],
-                        fidcoords[:, 1] < xfm.shape[1],
-                        fidcoords[:, 2] < xfm.shape[0]])
+        rows, cols, samples = [], [], []
+        for t in depths:
+            if len(coords) == 2:
+                layer = coords[0]*t + coords[1]*(1-t)
+            else:
+                layer = coords[0]
+            i, j, data = sampclass(layer, xfm.shape)
+            rows.append(vidx[i])
+            cols.append(j)
+            samples.append(data / float(thick))
 
-        vidx = np.nonzero(valid)[0]
+        ij = np.hstack(rows), np.hstack(cols)
+        # duplicate entries are summed when converting to CSR
+        return sparse.csr_matrix((np.hstack(samples), ij), shape=(len(tris), nvox))
 
-        i, j, data = sampclass(fidcoords[valid], xfm.shape)
-        csrshape = mask.sum(), np.prod(xfm.shape)
-        return sparse.csr_matrix((data, (vidx[i], j)), shape=csrshape)
+    sample.nvox = nvox
+    return sample
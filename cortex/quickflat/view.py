@@ -6,7 +6,9 @@ import numpy as np
 
 from .. import utils
 from .. import dataset
-from .utils import make_flatmap_image
+from ..database import db
+from ..options import config
+from .utils import make_flatmap_image, get_flatmask, _convert_svg_kwargs, _parse_defaults
 from . import composite
 
 
@@ -251,7 +253,7 @@ def make_figure(braindata, recache=False, pixelwise=True, thick=32, sampler='nea
     return fig
 
 def make_png(fname, braindata, recache=False, pixelwise=True, sampler='nearest', height=1024,
-             bgcolor=None, dpi=100, **kwargs):
+             bgcolor=None, dpi=100, fast=False, **kwargs):
     """Create a PNG of the VertexData or VolumeData on a flatmap.
 
     Parameters
@@ -300,7 +302,18 @@ def make_png(fname, braindata, recache=False, pixelwise=True, sampler='nearest',
         Font size for the label, e.g. "16pt"
     labelcolor : tuple of float, optional
         (R, G, B, A) specification for the label color
+    fast : bool, optional
+        If True, composite the image with `make_rgba` instead of matplotlib.
+        Much faster, but only supports the options of `make_rgba`, and draws a
+        simpler colorbar. The colorbar is off by default in this mode.
     """
+    if fast:
+        from PIL import Image
+        image = make_rgba(braindata, recache=recache, pixelwise=pixelwise, sampler=sampler,
+                          height=height, bgcolor=bgcolor, **kwargs)
+        Image.fromarray(image).save(fname, format='png')
+        return
+
     from matplotlib import pyplot as plt
     fig = make_figure(braindata,
                       recache=recache,
@@ -318,6 +331,138 @@ def make_png(fname, braindata, recache=False, pixelwise=True, sampler='nearest',
     fig.clf()
     plt.close(fig)
 
+def make_rgba(braindata, height=1024, recache=False, pixelwise=True, thick=32,
+              sampler='nearest', depth=0.5, with_rois=True, with_sulci=False,
+              with_labels=True, with_colorbar=False, with_curvature=False,
+              overlay_file=None, linewidth=None, linecolor=None, roifill=None,
+              shadow=None, labelsize=None, labelcolor=None, curvature_brightness=None,
+              curvature_contrast=None, curvature_threshold=None,
+              colorbar_ticks=None, colorbar_location='center', roi_list=None,
+              bgcolor=None, nanmean=False):
+    """Render a Volume or Vertex on a flatmap as an RGBA image, without matplotlib.
+
+    This composites the same layers as `make_figure` (curvature, data, sulci
+    and rois) directly in numpy, which is much faster when rendering many
+    images. The flatmap pixels match those of `make_png` up to rounding. The
+    colorbar is simplified: it shows the colormap and the tick values only.
+    See `make_figure` for the description of the parameters.
+
+    Returns
+    -------
+    image : array
+        (height, width, 4) uint8 RGBA image
+    """
+    from .utils import _apply_colormap
+
+    dataview = dataset.normalize(braindata)
+    if not isinstance(dataview, dataset.Dataview):
+        raise TypeError('Please provide a Dataview (e.g. an instance of cortex.Volume, cortex.Vertex, etc), not a Dataset')
+
+    im, extents = make_flatmap_image(dataview, recache=recache, pixelwise=pixelwise, sampler=sampler,
+                                     height=height, thick=thick, depth=depth, nanmean=nanmean)
+    if im.dtype == np.uint8:
+        data_rgba = im
+    else:
+        data_rgba = _apply_colormap(im, dataview.cmap, dataview.vmin, dataview.vmax)
+
+    background, overlays = _make_rgba_layers(
+        dataview.subject, height, recache=recache, bgcolor=bgcolor, with_rois=with_rois,
+        with_sulci=with_sulci, with_labels=with_labels, with_curvature=with_curvature,
+        overlay_file=overlay_file, linewidth=linewidth, linecolor=linecolor, roifill=roifill,
+        shadow=shadow, labelsize=labelsize, labelcolor=labelcolor,
+        curvature_brightness=curvature_brightness, curvature_contrast=curvature_contrast,
+        curvature_threshold=curvature_threshold, roi_list=roi_list)
+    image = _composite_rgba(data_rgba, background, overlays)
+    if with_colorbar:
+        _draw_colorbar(image, dataview, _check_colorbar_location(colorbar_location), colorbar_ticks)
+    return image
+
+def _make_rgba_layers(subject, height, recache=False, bgcolor=None, with_rois=True,
+                      with_sulci=False, with_labels=True, with_curvature=False,
+                      overlay_file=None, linewidth=None, linecolor=None, roifill=None,
+                      shadow=None, labelsize=None, labelcolor=None, curvature_brightness=None,
+                      curvature_contrast=None, curvature_threshold=None, roi_list=None):
+    """Layers of `make_rgba` that do not depend on the data: the background
+    (with the curvature) below the data, and the overlays above it. All are
+    float RGBA images on [0, 1]."""
+    from .utils import _apply_colormap, _alpha_composite, get_curvature_image
+
+    mask, extents = get_flatmask(subject, height=height, recache=recache)
+    # transparent white background, like matplotlib's transparent figures
+    background = np.zeros(mask.shape[::-1] + (4,), dtype=np.float32)
+    background[..., :3] = 1
+    if bgcolor is not None:
+        from matplotlib.colors import to_rgba
+        background[:] = to_rgba(bgcolor)
+    if with_curvature:
+        curv = get_curvature_image(subject, height,
+                                   brightness=curvature_brightness,
+                                   contrast=curvature_contrast,
+                                   threshold=curvature_threshold, recache=recache)
+        _alpha_composite(background, _apply_colormap(curv, 'gray', 0, 1) / np.float32(255))
+
+    svg_layers = []
+    if with_sulci:
+        svg_layers.append(('sulci', dict(roi_list=None)))
+    if with_rois:
+        svg_layers.append(('rois', dict(roi_list=roi_list, roifill=roifill)))
+    overlays = []
+    for layer, extra in svg_layers:
+        svgobject = db.get_overlay(subject, overlay_file=overlay_file)
+        layer_kws = _parse_defaults(layer + '_paths')
+        layer_kws.update(_convert_svg_kwargs(dict(
+            linewidth=linewidth, linecolor=linecolor, shadow=shadow, labelsize=labelsize,
+            labelcolor=labelcolor, roifill=extra.get('roifill'))))
+        texture = svgobject.get_texture(layer, height, labels=with_labels,
+                                        shape_list=extra['roi_list'], **layer_kws)
+        overlays.append(np.asarray(texture[:, :, :4], dtype=np.float32))
+    return background, overlays
+
+def _composite_rgba(data_rgba, background, overlays):
+    """Composite the uint8 RGBA data image between the layers returned by
+    `_make_rgba_layers`, returning a uint8 RGBA image"""
+    from .utils import _alpha_composite
+    image = background.copy()
+    _alpha_composite(image, data_rgba / np.float32(255))
+    for overlay in overlays:
+        _alpha_composite(image, overlay)
+    return np.round(image * 255).astype(np.uint8)
+
+def _draw_colorbar(image, dataview, location, ticks=None):
+    """Draws a simple colorbar into the uint8 RGBA `image`, at `location`
+    (left, bottom, width, height) given as fractions of the image size"""
+    from PIL import Image, ImageDraw
+    from .utils import _get_colormap_lut
+
+    h, w = image.shape[:2]
+    left, bottom, width, height = location
+    x0, x1 = int(left * w), int((left + width) * w)
+    y0, y1 = int((1 - bottom - height) * h), int((1 - bottom) * h)
+    if isinstance(dataview, dataset.view2D.Dataview2D):
+        cmapfile = os.path.join(config.get('webgl', 'colormaps'), dataview.cmap + '.png')
+        bar = Image.open(cmapfile).convert('RGBA').resize((x1 - x0, y1 - y0), Image.BILINEAR)
+        image[y0:y1, x0:x1] = np.array(bar)
+        labels = [(x0, y1, dataview.vmin), (x1, y1, dataview.vmax),
+                  (x0, y1, dataview.vmin2), (x0, y0, dataview.vmax2)]
+    else:
+        lut = _get_colormap_lut(dataview.cmap)[:-3]
+        idx = np.linspace(0, len(lut) - 1, x1 - x0).astype(int)
+        image[y0:y1, x0:x1] = lut[idx][np.newaxis]
+        vmin, vmax = dataview.vmin, dataview.vmax
+        if ticks is None:
+            ticks = np.linspace(vmin, vmax, 5)
+        labels = [(x0 + (t - vmin) / float(vmax - vmin) * (x1 - x0 - 1), y1, t) for t in ticks]
+
+    canvas = Image.fromarray(image)
+    draw = ImageDraw.Draw(canvas)
+    draw.rectangle([x0, y0, x1 - 1, y1 - 1], outline=(0, 0, 0, 255))
+    for x, y, value in labels:
+        text = "%g" % np.round(value, 2)
+        tw = draw.textlength(text) if hasattr(draw, 'textlength') else 6 * len(text)
+        draw.text((x - tw / 2., y + 2), text, fill=(0, 0, 0, 255))
+    image[:] = np.array(canvas)
+    return image
+
 def make_svg(fname, braindata, with_labels=False, with_curvature=True, layers=['rois'],
              height=1024, overlay_file=None, with_dropout=False, **kwargs):
     """Save an svg file of the desired flatmap.
@@ -410,91 +555,238 @@ def make_svg(fname, braindata, with_labels=False, with_curvature=True, layers=['
     roipack.get_svg(fname, layers=layers, labels=with_labels, with_ims=image_data)
 
 
-def make_gif(output_destination, volumes, frame_duration=1, **figure_kwargs):
+def make_gif(output_destination, volumes, frame_duration=1, format='gif', fast=False,
+             procs=None, **figure_kwargs):
     """Make an animated gif from several pycortex volumes
 
+    Frames are rendered in memory, and each frame is passed to the encoder as
+    soon as it and the frames before it are ready. With `fast`, frames are
+    rendered in parallel.
+
     Parameters
     ----------
     output_destination : str or stream-like
         The destination for the created gif. If a str, saves to a file. If stream-like (file handle
         or io.BytesIO), writes to the stream
     volumes : dict of pycortex Volumes
-    duration : float
+    frame_duration : float
         The duration of each frame in seconds
+    format : {'gif', 'png'}
+        Format of the animation, 'png' creates an animated PNG
+    fast : bool
+        If True, render the frames with `make_rgba` instead of matplotlib, see
+        `make_png`. The title is drawn above the flatmap.
+    procs : int, optional
+        Number of processes rendering frames. With `fast`, defaults to the
+        configured number (see `cortex.mp`). Otherwise frames are drawn with
+        pyplot, which is not safe in forked processes with interactive
+        backends, so they are rendered serially unless `procs` is given.
     **figure_kwargs
-        Passed to `cortex.quickflat.make_figure`
+        Passed to `cortex.quickflat.make_figure`, or to `make_rgba` if fast
 
     Returns
     -------
     If output_destination is a file path, return the path. If stream-like, return the stream data.
     """
     import imageio
-    from matplotlib import pyplot as plt
-
-    tmpdir = tempfile.TemporaryDirectory()
+    from .. import mp
 
-    images = []
-    for i, name in enumerate(volumes):
-        fig = plt.figure(figsize=(12, 6), dpi=100)
-        _ = make_figure(volumes[name], fig=fig, **figure_kwargs)
-        _ = fig.suptitle(name)
-        path = os.path.join(tmpdir.name, str(i) + '.png')
-        fig.savefig(path)
-        images.append(imageio.imread(path))
-        _ = plt.close(fig)
-
-    tmpdir.cleanup()
-
-    imageio.mimsave(output_destination, images, format='gif', duration=frame_duration)
+    names = list(volumes)
+    if fast:
+        figure_kwargs.setdefault('bgcolor', 'white')
+        render = lambda name: _title_rgba(make_rgba(volumes[name], **figure_kwargs), name)
+    else:
+        if procs is None:
+            procs = 1
+        # every process reuses a single figure
+        figures = dict()
+
+        def render(name):
+            from matplotlib import pyplot as plt
+            fig = figures.get(os.getpid())
+            if fig is None:
+                fig = figures[os.getpid()] = plt.figure(figsize=(12, 6), dpi=100)
+            fig.clf()
+            make_figure(volumes[name], fig=fig, **figure_kwargs)
+            fig.suptitle(name)
+            fig.canvas.draw()
+            return np.array(fig.canvas.buffer_rgba())
+
+    writer = imageio.get_writer(output_destination, format=format, mode='I',
+                                duration=frame_duration)
+    try:
+        for image in mp.imap(render, names, procs=procs, batchsize=1):
+            writer.append_data(image)
+    finally:
+        writer.close()
+        if not fast:
+            from matplotlib import pyplot as plt
+            for fig in figures.values():
+                plt.close(fig)
 
     if hasattr(output_destination, 'seek'):
         output_destination.seek(0)
 
+def _title_rgba(image, title):
+    """Adds a white band with `title` above the uint8 RGBA `image`"""
+    from PIL import Image, ImageDraw
+    band = 24
+    canvas = Image.new('RGBA', (image.shape[1], image.shape[0] + band), (255, 255, 255, 255))
+    canvas.paste(Image.fromarray(image), (0, band))
+    draw = ImageDraw.Draw(canvas)
+    width = draw.textlength(title) if hasattr(draw, 'textlength') else 6 * len(title)
+    draw.text(((image.shape[1] - width) / 2., 6), title, fill=(0, 0, 0, 255))
+    return np.array(canvas)
+
 
 def show(*args, **kwargs):
     """Wrapper for make_figure()"""
     return make_figure(*args, **kwargs)
 
-def make_movie(name, data, subject, xfmname, recache=False, height=1024,
-               sampler='nearest', dpi=100, tr=2, interp='linear', fps=30,
-               vcodec='libtheora', bitrate="8000k", vmin=None, vmax=None, **kwargs):
-    """Create a movie of an 4D data set"""
-    raise NotImplementedError
-    import sys
-    import shlex
-    import shutil
-    import tempfile
-    import subprocess as sp
-    import multiprocessing as mp
-
-    from scipy.interpolate import interp1d
-
-    # Make the flatmaps
-    ims, extents = make_flatmap_image(data, subject, xfmname, recache=recache, height=height, sampler=sampler)
-    if vmin is None:
-        vmin = np.nanmin(ims)
-    if vmax is None:
-        vmax = np.nanmax(ims)
+def make_movie(name, data, subject=None, xfmname=None, recache=False, height=1024,
+               sampler='nearest', tr=2, interp='linear', fps=30, vcodec='libtheora',
+               bitrate="8000k", vmin=None, vmax=None, cmap=None, bgcolor='black',
+               blocksize=16, nanmean=False, **kwargs):
+    """Create a movie of a 4D data set on the flatmap.
 
-    # Create the matplotlib figure
-    fig = make_figure(ims[0], subject, vmin=vmin, vmax=vmax, **kwargs)
-    fig.set_size_inches(np.array([ims.shape[2], ims.shape[1]]) / float(dpi))
-    img = fig.axes[0].images[0]
+    Frames are streamed straight into ffmpeg: the flatmap images are projected
+    `blocksize` volumes at a time, interpolated in time, colormapped and
+    composited with `make_rgba`, and written to the encoder while the next
+    frame is rendered. No intermediate files are written, and memory use does
+    not depend on the length of the run.
 
-    # Set up interpolation
-    times = np.arange(0, len(ims)*tr, tr)
-    interp = interp1d(times, ims, kind=interp, axis=0, copy=False)
-    frames = np.linspace(0, times[-1], (len(times)-1)*tr*fps+1)
+    Parameters
+    ----------
+    name : str
+        Filename of the movie. The container is chosen by ffmpeg from the
+        extension, e.g. ".ogv" for the default theora codec.
+    data : Volume, Vertex or array
+        4D Volume or 2D Vertex movie, or a (t, z, y, x) array of volumes in
+        the space of `subject` and `xfmname`
+    subject, xfmname : str, optional
+        Subject and transform of `data`, if it is an array
+    recache : bool
+        Whether or not to recache intermediate files
+    height : int
+        Height of the movie, in pixels
+    sampler : str
+        Name of sampling function used to sample underlying volume data
+    tr : float
+        Time between two volumes, in seconds
+    interp : {'linear', 'nearest'}
+        Interpolation between volumes
+    fps : float
+        Frames per second of the movie
+    vcodec : str
+        Video codec, passed to ffmpeg
+    bitrate : str
+        Video bitrate, passed to ffmpeg
+    vmin, vmax, cmap : optional
+        Color scale, default to those of `data`
+    bgcolor : matplotlib colorspec
+        Color of the background. Videos have no transparency.
+    blocksize : int
+        Number of volumes projected onto the flatmap at once
+    nanmean : bool
+        If True, NaNs in the data will be ignored when averaging across layers
+    **kwargs
+        Options of the curvature and overlay layers of `make_rgba`, e.g.
+        with_rois, with_curvature, with_labels
+
+    Notes
+    -----
+    The ffmpeg executable is set by the `ffmpeg` option in the
+    [dependency_paths] section of the config.
+    """
+    from .utils import _iter_flatmap_images, _apply_colormap
 
-    try:
-        path = tempfile.mkdtemp()
-        impath = os.path.join(path, "im{:09d}.png")
-        for frame, frame_time in enumerate(frames):
-            img.set_data(interp(frame_time))
-            fig.savefig(impath.format(frame), transparent=True, dpi=dpi)
-        # avconv might not be relevant function for all operating systems.
-        # Introduce operating system check here?
-        cmd = "avconv -i {path} -vcodec {vcodec} -r {fps} -b {br} {name}".format(path=impath, vcodec=vcodec, fps=fps, br=bitrate, name=name)
-        sp.call(shlex.split(cmd))
-    finally:
-        shutil.rmtree(path)
+    if isinstance(data, dataset.Dataview):
+        dataview = data
+    else:
+        dataview = dataset.Volume(data, subject, xfmname, cmap=cmap, vmin=vmin, vmax=vmax)
+    vmin = dataview.vmin if vmin is None else vmin
+    vmax = dataview.vmax if vmax is None else vmax
+    cmap = dataview.cmap if cmap is None else cmap
+
+    background, overlays = _make_rgba_layers(dataview.subject, height, recache=recache,
+                                             bgcolor=bgcolor, **kwargs)
+    blocks = (images for images, _ in _iter_flatmap_images(
+        dataview, height=height, recache=recache, nanmean=nanmean, blocksize=blocksize,
+        sampler=sampler))
+    frames = (_composite_rgba(_apply_colormap(image, cmap, vmin, vmax), background, overlays)
+              for image in _interpolate_frames(blocks, tr * fps, kind=interp))
+
+    ffmpeg = config.get('dependency_paths', 'ffmpeg') \
+        if config.has_option('dependency_paths', 'ffmpeg') else 'ffmpeg'
+    imheight, imwidth = background.shape[:2]
+    cmd = [ffmpeg, '-y', '-loglevel', 'error',
+           '-f', 'rawvideo', '-pix_fmt', 'rgba', '-s', '%dx%d' % (imwidth, imheight),
+           '-r', str(fps), '-i', '-', '-an', '-vcodec', vcodec, '-b:v', bitrate,
+           # most codecs require even dimensions
+           '-vf', 'pad=ceil(iw/2)*2:ceil(ih/2)*2', '-pix_fmt', 'yuv420p', name]
+    _encode_frames(cmd, frames)
+
+def _interpolate_frames(blocks, rate, kind='linear'):
+    """Yields the frames of a movie with `rate` frames per image, interpolated
+    in time from the consecutive blocks of images in `blocks`. Only the
+    current block and the last image of the previous one are kept."""
+    if kind not in ('linear', 'nearest'):
+        raise ValueError("Unknown interpolation %r, must be 'linear' or 'nearest'" % kind)
+    frame, first, previous = 0, 0, None
+    for block in blocks:
+        last = first + len(block) - 1
+        while True:
+            # rounding avoids losing the last frame to floating point errors
+            position = round(frame / float(rate), 9)
+            if position > last:
+                break
+            if kind == 'nearest':
+                index, weight = int(np.floor(position + 0.5)), 0
+            else:
+                index = int(np.floor(position))
+                weight = position - index
+            if index > last or (weight > 0 and index == last):
+                break  # the next image is in the next block
+            image = previous if index < first else block[index - first]
+            if weight > 0:
+                image = (1 - weight) * image + weight * block[index + 1 - first]
+            yield image
+            frame += 1
+        previous, first = block[-1], last + 1
+
+def _encode_frames(cmd, frames):
+    """Writes the uint8 `frames` to the stdin of the encoder command `cmd`.
+    Each frame is written by a separate thread while the next one is
+    rendered."""
+    import collections
+    import subprocess as sp
+    from concurrent.futures import ThreadPoolExecutor
+
+    with tempfile.TemporaryFile() as errors:
+        proc = sp.Popen(cmd, stdin=sp.PIPE, stderr=errors)
+        try:
+            with ThreadPoolExecutor(max_workers=1) as writer:
+                pending = collections.deque()
+                for frame in frames:
+                    pending.append(writer.submit(proc.stdin.write, np.ascontiguousarray(frame).data))
+                    # at most two rendered frames wait for the encoder
+                    while len(pending) > 2:
+                        pending.popleft().result()
+                for write in pending:
+                    write.result()
+        except BrokenPipeError:
+            pass  # the encoder exited early, its error is raised below
+        except BaseException:
+            proc.kill()
+            raise
+        finally:
+            try:
+                proc.stdin.close()
+            except BrokenPipeError:
+                pass
+            proc.wait()
+
+        if proc.returncode != 0:
+            errors.seek(0)
+            raise RuntimeError("Encoding with %s failed:\n%s" % (
+                cmd[0], errors.read().decode(errors='replace')))
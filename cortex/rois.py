@@ -95,7 +95,8 @@ class ROIpack(object):
         svg = etree.parse(svgroipack.svgfile, parser=parser)
 
         # Find boundary vertices for each ROI
-        lsurf, rsurf = [Surface(*pp) for pp in db.get_surf(self.subject, "fiducial")]
+        cachedir = db.get_cache(self.subject)
+        lsurf, rsurf = [Surface(*pp, cachedir=cachedir) for pp in db.get_surf(self.subject, "fiducial")]
         flsurf, frsurf = [Surface(*pp) for pp in db.get_surf(self.subject, "flat")]
         valids = [set(np.unique(flsurf.polys)), set(np.unique(frsurf.polys))]
 
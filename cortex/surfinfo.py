@@ -32,7 +32,7 @@ def curvature(outfile, subject, smooth=20):
     """
     curvs = []
     for pts, polys in db.get_surf(subject, "fiducial"):
-        surf = polyutils.Surface(pts, polys)
+        surf = polyutils.Surface(pts, polys, cachedir=db.get_cache(subject))
         curv = surf.smooth(surf.mean_curvature(), smooth)
         curvs.append(curv)
     np.savez(outfile, left=curvs[0], right=curvs[1])
@@ -67,7 +67,7 @@ def distortion(outfile, subject, dist_type='areal', smooth=20):
     for hem in ["lh", "rh"]:
         fidvert, fidtri = db.get_surf(subject, "fiducial", hem)
         flatvert, flattri = db.get_surf(subject, "flat", hem)
-        surf = polyutils.Surface(fidvert, fidtri)
+        surf = polyutils.Surface(fidvert, fidtri, cachedir=db.get_cache(subject))
 
         dist = getattr(polyutils.Distortion(flatvert, fidvert, flattri), dist_type)
         smdist = surf.smooth(dist, smooth)
@@ -121,7 +121,7 @@ def tissots_indicatrix(outfile, sub, radius=10, spacing=50):
     for hem in ["lh", "rh"]:
         fidpts, fidpolys = db.get_surf(sub, "fiducial", hem)
         #G = make_surface_graph(fidtri)
-        surf = polyutils.Surface(fidpts, fidpolys)
+        surf = polyutils.Surface(fidpts, fidpolys, cachedir=db.get_cache(sub))
         nvert = fidpts.shape[0]
         tissot_array = np.zeros((nvert,))
 
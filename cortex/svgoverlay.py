@@ -3,6 +3,8 @@ import os
 import re
 import copy
 import shlex
+import glob
+import hashlib
 import tempfile
 import itertools
 import numpy as np
@@ -16,6 +18,7 @@ from distutils.version import LooseVersion
 from lxml import etree
 from lxml.builder import E
 
+from . import cache
 from .options import config
 from .testing_utils import INKSCAPE_VERSION
 
@@ -43,10 +46,14 @@ class SVGOverlay(object):
     overlays_available : list or tuple
         list of layers of svg file to extract. If None, extracts all overlay layers 
         (i.e. all layers that do not contain images)
+    cachedir : string
+        directory where rendered layers are cached, see `get_texture`. If None,
+        rendered layers are only cached in memory.
     """
-    def __init__(self, svgfile, coords=None, overlays_available=None):
+    def __init__(self, svgfile, coords=None, overlays_available=None, cachedir=None):
         self.svgfile = svgfile
         self.overlays_available = overlays_available
+        self.cachedir = cachedir
         self.reload()
         if coords is not None:
             self.set_coords(coords)
@@ -72,8 +79,8 @@ class SVGOverlay(object):
         """Unclear what this does. James??"""
         # Normalize coordinates 0-1
         if np.any(coords.max(0) > 1) or np.any(coords.min(0) < 0):
-            coords -= coords.min(0)
-            coords /= coords.max(0)
+            coords = coords - coords.min(0)
+            coords = coords / coords.max(0)
         # Renormalize coordinates to shape of svg
         self.coords = coords * self.svgshape
         # Update of scipy (0.16+) means that cKDTree hangs / takes absurdly long to compute with new default
@@ -188,7 +195,7 @@ class SVGOverlay(object):
         print('Saved SVG to: %s'%filename)
 
     def get_texture(self, layer_name, height, name=None, background=None, labels=True,
-        shape_list=None, **kwargs):
+        shape_list=None, renderer=None, **kwargs):
         """Renders a specific layer of this svgobject as a png
 
         Parameters
@@ -207,6 +214,10 @@ class SVGOverlay(object):
             list of string names for path/shape elements in this layer to be rendered
             (any elements not on this list will be set to invisible, if this list is
             provided)
+        renderer : {'inkscape', 'agg', 'auto'}, optional
+            Program rendering the svg: inkscape, or matplotlib's Agg renderer
+            which needs no external dependency. Defaults to the `svg_renderer`
+            option in the [basic] section of the config.
         kwargs : keyword arguments
             keywords to specify display properties of svg path objects, e.g. {'stroke':'white',
             'stroke-width':2} etc. See inkscape help for names for properties. This function
@@ -222,17 +233,16 @@ class SVGOverlay(object):
         -----
         missing bits=32 keyword input argument, did not seeme necessary to specify
         png bits.
+
+        Rendered images are cached by a hash of the svg to render, the height
+        and the renderer, which covers the overlay file, layer, shapes, styles
+        and labels. They are kept in memory and, if this object has a `cachedir`,
+        as png files in that directory, so rendering the same layer again does
+        not run the renderer. The returned image is shared with the cache and
+        read-only. Only the most recently used png files are kept, as set by the
+        `overlay_cache` option in the [basic] section of the config;
+        `Database.clear_cache` removes all of them.
         """
-        # Give a more informative error in case we don't have inkscape
-        # installed
-        if INKSCAPE_VERSION is None:
-            raise RuntimeError(
-                "Inkscape doesn't seem to be installed on this system."
-                "SVGOverlay.get_texture requires inkscape."
-                "Please make sure that inkscape is installed and that is "
-                "accessible from the terminal.")
-
-        import matplotlib.pyplot as plt
         # Set the size of the texture
         if background is not None:
             img = E.image(
@@ -272,42 +282,141 @@ class SVGOverlay(object):
                 layer.visible = False
                 layer.labels.visible = False
 
-        pngfile = name
-        if name is None:
-            png = tempfile.NamedTemporaryFile(suffix=".png")
-            pngfile = png.name
-
-        inkscape_cmd = config.get('dependency_paths', 'inkscape')
-        if LooseVersion(INKSCAPE_VERSION) < LooseVersion('1.0'):
-            cmd = "{inkscape_cmd} -z -h {height} -e {outfile} /dev/stdin"
+        renderer = _get_renderer(renderer)
+        svgbytes = etree.tostring(self.svg)
+        try:
+            if name is not None:
+                self._render(svgbytes, height, renderer, name)
+                return
+
+            key = ("overlay", _texture_digest(svgbytes, height, renderer))
+            im = cache.memory.get(key)
+            if im is None:
+                render = lambda pngfile: self._render(svgbytes, height, renderer, pngfile)
+                if self.cachedir is None:
+                    with tempfile.NamedTemporaryFile(suffix=".png") as png:
+                        im = render(png.name)
+                else:
+                    cachefile = os.path.join(self.cachedir, "overlay_%s.png" % key[1])
+                    im = _cached_texture(cachefile, render)
+                im = cache.memory.put(key, im)
+            return im
+        finally:
+            if background is not None:
+                self.svg.getroot().remove(img)
+
+    def _render(self, svgbytes, height, renderer, pngfile):
+        """Renders the svg `svgbytes` of this overlay at `height` into `pngfile`
+        and returns the image"""
+        if renderer == "agg":
+            from PIL import Image
+            im = _render_agg(self.svg, height)
+            Image.fromarray(np.round(im * 255).astype(np.uint8)).save(pngfile, format="png")
+            inkscape_cmd, stdout, stderr = None, "", ""
         else:
-            cmd = "{inkscape_cmd} -h {height} --export-filename {outfile} " \
-                  "/dev/stdin"
-        cmd = cmd.format(inkscape_cmd=inkscape_cmd, height=height, outfile=pngfile)
-        proc = sp.Popen(shlex.split(cmd), stdin=sp.PIPE, stdout=sp.PIPE, stderr=sp.PIPE)
-        stdout, stderr = proc.communicate(etree.tostring(self.svg))
-        
-        # print stderr, except the warning "Format autodetect failed."
-        if hasattr(stderr, 'decode'):
-            stderr = stderr.decode()
-        for line in stderr.split('\n'):
-            if line != '' and 'Format autodetect failed.' not in line:
-                print(line)
-
-        if background is not None:
-            self.svg.getroot().remove(img)
+            inkscape_cmd, stdout, stderr = _render_inkscape(svgbytes, height, pngfile)
 
-        if name is None:
-            png.seek(0)
+        try:
+            return _read_texture(pngfile)
+        except SyntaxError as e:
+            raise RuntimeError(f"Error reading image from {pngfile}: {e}"
+                               f" (inkscape version: {INKSCAPE_VERSION})"
+                               f" (inkscape command: {inkscape_cmd})"
+                               f" (stdout: {stdout})"
+                               f" (stderr: {stderr})")
+
+def _get_renderer(renderer=None):
+    """Renderer of the svg textures, 'inkscape' or 'agg'. Defaults to the
+    `svg_renderer` option in the [basic] section of the config, where 'auto'
+    selects inkscape if it is installed and agg otherwise."""
+    if renderer is None:
+        renderer = config.get("basic", "svg_renderer") \
+            if config.has_option("basic", "svg_renderer") else "auto"
+    if renderer == "auto":
+        renderer = "agg" if INKSCAPE_VERSION is None else "inkscape"
+    if renderer not in ("inkscape", "agg"):
+        raise ValueError("Unknown svg renderer %r, must be 'inkscape', 'agg' or 'auto'" % renderer)
+    return renderer
+
+def _render_inkscape(svgbytes, height, pngfile):
+    """Renders the svg `svgbytes` at `height` into `pngfile` with inkscape.
+    Returns the inkscape command, its output and its errors."""
+    # Give a more informative error in case we don't have inkscape
+    # installed
+    if INKSCAPE_VERSION is None:
+        raise RuntimeError(
+            "Inkscape doesn't seem to be installed on this system."
+            "SVGOverlay.get_texture requires inkscape."
+            "Please make sure that inkscape is installed and that is "
+            "accessible from the terminal.")
+
+    inkscape_cmd = config.get('dependency_paths', 'inkscape')
+    if LooseVersion(INKSCAPE_VERSION) < LooseVersion('1.0'):
+        cmd = "{inkscape_cmd} -z -h {height} -e {outfile} /dev/stdin"
+    else:
+        cmd = "{inkscape_cmd} -h {height} --export-filename {outfile} " \
+              "/dev/stdin"
+    cmd = cmd.format(inkscape_cmd=inkscape_cmd, height=height, outfile=pngfile)
+    proc = sp.Popen(shlex.split(cmd), stdin=sp.PIPE, stdout=sp.PIPE, stderr=sp.PIPE)
+    stdout, stderr = proc.communicate(svgbytes)
+
+    # print stderr, except the warning "Format autodetect failed."
+    if hasattr(stderr, 'decode'):
+        stderr = stderr.decode()
+    for line in stderr.split('\n'):
+        if line != '' and 'Format autodetect failed.' not in line:
+            print(line)
+    return inkscape_cmd, stdout, stderr
+
+def _texture_digest(svgbytes, height, renderer):
+    """Hash identifying a rendering of the svg `svgbytes` at `height`"""
+    digest = hashlib.sha1(svgbytes)
+    digest.update(b"height=%d;renderer=%s" % (height, renderer.encode()))
+    return digest.hexdigest()
+
+def _cached_texture(cachefile, render):
+    """Texture stored in `cachefile`, which is first rendered into it with
+    `render(pngfile)` if it does not exist. Older textures in the same
+    directory are then evicted, see `_evict_textures`."""
+    with cache.building(cachefile) as stale:
+        if not stale:
             try:
-                im = plt.imread(png)
-            except SyntaxError as e:
-                raise RuntimeError(f"Error reading image from {pngfile}: {e}"
-                                   f" (inkscape version: {INKSCAPE_VERSION})"
-                                   f" (inkscape command: {inkscape_cmd})"
-                                   f" (stdout: {stdout})"
-                                   f" (stderr: {stderr})")
-            return im
+                # marks the texture as recently used
+                os.utime(cachefile)
+                return _read_texture(cachefile)
+            except FileNotFoundError:
+                # evicted by another process in the meantime
+                pass
+        with cache.atomic(cachefile) as pngfile:
+            im = render(pngfile)
+    _evict_textures(os.path.dirname(cachefile))
+    return im
+
+def _evict_textures(cachedir):
+    """Removes the least recently used textures of `cachedir` beyond the number
+    set by the `overlay_cache` option in the [basic] section of the config"""
+    limit = config.get("basic", "overlay_cache") \
+        if config.has_option("basic", "overlay_cache") else ""
+    if limit.strip() == "":
+        return
+    textures = []
+    for fname in glob.glob(os.path.join(glob.escape(cachedir), "overlay_*.png")):
+        try:
+            textures.append((os.stat(fname).st_mtime_ns, fname))
+        except FileNotFoundError:
+            pass
+    for _, fname in sorted(textures)[:max(0, len(textures) - int(limit))]:
+        try:
+            os.unlink(fname)
+        except FileNotFoundError:
+            pass
+
+def _read_texture(png):
+    """Reads a rendered png as a read-only float RGBA image"""
+    import matplotlib.pyplot as plt
+    im = plt.imread(png)
+    im.flags.writeable = False
+    return im
 
 class Overlay(object):
     """Class to represent a single layer of an SVG file
@@ -944,3 +1053,257 @@ def gen_path(path):
         except StopIteration:
             run = False
     return Path(verts, codes=codes)
+
+###################################################################################
+# Rasterization without inkscape
+###################################################################################
+_PATH_NARGS = dict(m=2, l=2, h=1, v=1, c=6, s=4, q=4, t=2, a=7)
+
+def _svg_path(pathdef):
+    """Converts the `d` attribute of an svg path to a matplotlib Path. Elliptical
+    arcs are approximated by straight lines."""
+    tokens = list(_tokenize_path(pathdef))
+    verts, codes = [], []
+    cmd, prev = None, None
+    pen, start = np.zeros(2), np.zeros(2)
+    cubic = quad = None  # last control points, for the smooth curves
+    i = 0
+    while i < len(tokens):
+        if tokens[i] in COMMANDS:
+            cmd = tokens[i]
+            i += 1
+            if cmd in "Zz":
+                verts.append(start)
+                codes.append(Path.CLOSEPOLY)
+                pen, prev = start.copy(), cmd
+            continue
+        if cmd is None or cmd in "Zz":
+            raise ValueError("Bad path format: %s" % pathdef)
+
+        kind = cmd.lower()
+        args = np.array([float(t) for t in tokens[i:i+_PATH_NARGS[kind]]])
+        i += _PATH_NARGS[kind]
+        offset = pen if cmd.islower() else np.zeros(2)
+        if kind == "h":
+            pts = [np.array([args[0] + offset[0], pen[1]])]
+        elif kind == "v":
+            pts = [np.array([pen[0], args[0] + offset[1]])]
+        elif kind == "a":
+            pts = [args[5:7] + offset]
+        else:
+            pts = list(args.reshape(-1, 2) + offset)
+
+        if kind == "s":
+            reflected = 2 * pen - cubic if prev in ("c", "s") else pen
+            pts.insert(0, reflected)
+        elif kind == "t":
+            reflected = 2 * pen - quad if prev in ("q", "t") else pen
+            pts.insert(0, reflected)
+
+        if kind == "m":
+            codes.append(Path.MOVETO)
+            start = pts[0]
+            # further coordinate pairs are implicit lineto commands
+            cmd = "l" if cmd == "m" else "L"
+        elif kind in "cs":
+            codes.extend([Path.CURVE4] * 3)
+            cubic = pts[1]
+        elif kind in "qt":
+            codes.extend([Path.CURVE3] * 2)
+            quad = pts[0]
+        else:
+            codes.append(Path.LINETO)
+        verts.extend(pts)
+        pen, prev = pts[-1].copy(), kind
+
+    return Path(np.array(verts, dtype=float).reshape(-1, 2), codes=codes)
+
+def _parse_style(element):
+    """Style of an svg element as a dictionary, from its style and
+    presentation attributes"""
+    style = dict()
+    for key in ["fill", "fill-opacity", "stroke", "stroke-width", "stroke-opacity",
+                "opacity", "display", "filter", "font-size", "font-family"]:
+        if element.get(key) is not None:
+            style[key] = element.get(key)
+    for item in element.get("style", "").split(";"):
+        if ":" in item:
+            key, value = item.split(":", 1)
+            style[key.strip()] = value.strip()
+    return style
+
+def _svg_length(value, default=0.):
+    """Length in user units of an svg length such as '2', '3px' or '14pt'"""
+    if value is None or value in ("", "None", "none"):
+        return default
+    number = float(FLOAT_RE.findall(value)[0])
+    # user units are css pixels, at 96 per inch
+    units = dict(pt=96/72., pc=16., mm=96/25.4, cm=96/2.54, px=1.)
+    unit = value.strip()[-2:]
+    return number * units.get(unit, 1.)
+
+def _svg_color(color, opacity):
+    """RGBA color of an svg paint, or None if it is not painted"""
+    from matplotlib.colors import to_rgba
+    if color is None or color in ("none", "None", ""):
+        return None
+    if color.startswith("url("):
+        # gradients and patterns are not supported
+        return None
+    return to_rgba(color, alpha=float(opacity))
+
+def _render_agg(svg, height):
+    """Rasterizes the visible content of the svg tree `svg` at `height` with
+    matplotlib's Agg renderer, without inkscape.
+
+    This supports what the overlay files use: paths with stroke and fill
+    styles, text, embedded png images, translated layers, clip paths and the
+    drop shadow filter. The result is a float RGBA image like the ones read
+    from the pngs rendered by inkscape.
+    """
+    import base64
+    import io
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+    from matplotlib.patches import PathPatch
+
+    root = svg.getroot()
+    svgwidth, svgheight = float(root.get("width")), float(root.get("height"))
+    scale = height / svgheight
+    width = int(svgwidth * scale)
+
+    # at 72 dpi, one point is one pixel
+    fig = Figure(figsize=(width / 72., height / 72.), dpi=72)
+    fig.patch.set_alpha(0)
+    ax = fig.add_axes([0, 0, 1, 1])
+    ax.set_axis_off()
+    ax.set_xlim(0, svgwidth)
+    ax.set_ylim(svgheight, 0)
+
+    clips = dict()
+    for clip in root.iter("{%s}clipPath" % svgns):
+        paths = [_svg_path(p.get("d")) for p in clip.iter("{%s}path" % svgns)]
+        if len(paths) > 0:
+            clips[clip.get("id")] = Path.make_compound_path(*paths)
+    blur = None
+    for filt in root.iter("{%s}filter" % svgns):
+        for gauss in filt.iter("{%s}feGaussianBlur" % svgns):
+            if filt.get("id") == "dropshadow":
+                blur = float(gauss.get("stdDeviation", 2))
+
+    shadowed = []
+    def draw(element, offset, clip, opacity):
+        style = _parse_style(element)
+        if style.get("display") == "none":
+            return
+        opacity = opacity * float(style.get("opacity", 1))
+        tag = etree.QName(element).localname
+
+        if tag in ("defs", "clipPath", "filter", "metadata", "namedview"):
+            return
+        elif tag in ("g", "svg"):
+            match = re.match(r"translate\(\s*([-\d.eE+]+)[\s,]*([-\d.eE+]*)\s*\)",
+                             element.get("transform", ""))
+            if match is not None:
+                offset = offset + [float(match.group(1)), float(match.group(2) or 0)]
+            match = re.match(r"url\(#(.*)\)", element.get("clip-path", ""))
+            if match is not None and match.group(1) in clips:
+                clip = clips[match.group(1)].transformed(_translation(offset))
+            for child in element:
+                draw(child, offset, clip, opacity)
+            return
+
+        if tag == "path":
+            path = _svg_path(element.get("d")).transformed(_translation(offset))
+            fill = _svg_color(style.get("fill", "black"), opacity * float(style.get("fill-opacity", 1)))
+            stroke = _svg_color(style.get("stroke"), opacity * float(style.get("stroke-opacity", 1)))
+            if fill is None and stroke is None:
+                return
+            linewidth = _svg_length(style.get("stroke-width"), 1.)
+            artist = PathPatch(path, facecolor=fill or "none", edgecolor=stroke or "none",
+                               linewidth=linewidth * scale if stroke is not None else 0,
+                               capstyle=dict(round="round", square="projecting").get(
+                                   style.get("stroke-linecap"), "butt"),
+                               joinstyle=dict(round="round", bevel="bevel").get(
+                                   style.get("stroke-linejoin"), "miter"))
+            dashes = style.get("stroke-dasharray")
+            if dashes not in (None, "none", "None") and stroke is not None and linewidth > 0:
+                # matplotlib scales dash lengths by the line width
+                dashes = [_svg_length(d) / linewidth for d in re.split(r"[\s,]+", dashes.strip()) if d]
+                offset_ = _svg_length(style.get("stroke-dashoffset")) / linewidth
+                artist.set_linestyle((offset_, dashes))
+            ax.add_patch(artist)
+        elif tag == "text":
+            text = "".join(element.itertext()).strip()
+            color = _svg_color(style.get("fill", "black"), opacity * float(style.get("fill-opacity", 1)))
+            if text == "" or color is None:
+                return
+            position = element
+            if element.get("x") is None:
+                position = next(element.iter("{%s}tspan" % svgns), element)
+            x = float(position.get("x", 0)) + offset[0]
+            y = float(position.get("y", 0)) + offset[1]
+            families = [f.strip().strip("'\"") for f in style.get("font-family", "sans-serif").split(",")]
+            families = [f for f in families if _has_font(f)] or ["sans-serif"]
+            artist = ax.text(x, y, text, color=color, family=families,
+                             fontsize=_svg_length(style.get("font-size"), 16.) * scale,
+                             fontweight=style.get("font-weight") or "normal",
+                             fontstyle=style.get("font-style") or "normal",
+                             ha=dict(middle="center", end="right").get(style.get("text-anchor"), "left"),
+                             va="baseline")
+        elif tag == "image":
+            href = element.get("{http://www.w3.org/1999/xlink}href", element.get("href", ""))
+            if not href.startswith("data:image/png;base64,"):
+                return
+            from PIL import Image
+            image = np.array(Image.open(io.BytesIO(base64.b64decode(href.split(",", 1)[1]))).convert("RGBA"))
+            x = float(element.get("x", 0)) + offset[0]
+            y = float(element.get("y", 0)) + offset[1]
+            w, h = float(element.get("width")), float(element.get("height"))
+            artist = ax.imshow(image, extent=[x, x + w, y + h, y], alpha=opacity,
+                               interpolation="bilinear", aspect="auto")
+            ax.set_xlim(0, svgwidth)
+            ax.set_ylim(svgheight, 0)
+        else:
+            return
+
+        if clip is not None:
+            artist.set_clip_path(clip, ax.transData)
+        if blur is not None and style.get("filter") == "url(#dropshadow)":
+            shadowed.append(artist)
+
+    draw(root, np.zeros(2), None, 1.)
+
+    canvas = FigureCanvasAgg(fig)
+    canvas.draw()
+    image = np.array(canvas.buffer_rgba(), dtype=np.float32) / 255.
+    if len(shadowed) > 0:
+        # the drop shadow is a blurred copy of the alpha, drawn in black below
+        # the shapes. One shadow is computed for the whole layer.
+        from scipy.ndimage import gaussian_filter
+        for artist in ax.patches + ax.texts + ax.images:
+            artist.set_visible(artist in shadowed)
+        canvas.draw()
+        alpha = np.array(canvas.buffer_rgba(), dtype=np.float32)[..., 3] / 255.
+        shadow = gaussian_filter(alpha, blur * scale)
+        src = image[..., 3]
+        total = src + shadow * (1 - src)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            image[..., :3] = np.where(total[..., None] > 0, image[..., :3] * (src / total)[..., None], 0)
+        image[..., 3] = total
+    return image
+
+def _translation(offset):
+    from matplotlib.transforms import Affine2D
+    return Affine2D().translate(*offset)
+
+def _has_font(family):
+    """Whether matplotlib can find a font for `family`, without warnings"""
+    from matplotlib import font_manager
+    if family in ("serif", "sans-serif", "cursive", "fantasy", "monospace"):
+        return True
+    try:
+        font_manager.findfont(font_manager.FontProperties(family=family), fallback_to_default=False)
+        return True
+    except ValueError:
+        return False
@@ -0,0 +1,141 @@
+import os
+
+import numpy as np
+import pytest
+from scipy import sparse
+
+import cortex
+from cortex import cache
+
+
+def test_cache_formats(tmp_path):
+    matrix = sparse.random(50, 80, density=0.1, format='csr')
+    tmpdir = str(tmp_path)
+    path = os.path.join(tmpdir, "pixmap")
+
+    fname = cache.save(path, fmt="npz", **cache.sparse_arrays(matrix))
+    assert fname == path + ".npz" and cache.find(path) == fname
+
+    fname = cache.save(path, fmt="mmap", **cache.sparse_arrays(matrix))
+    assert fname == path + ".mmap" and cache.find(path) == fname
+    assert not os.path.exists(path + ".npz")
+
+    loaded = cache.load_sparse(path)
+    assert isinstance(cache.load(path)["data"], np.memmap)
+    assert abs(loaded - matrix).max() == 0
+
+
+def test_mapper_mmap_cache(tmp_path):
+    mapper = cortex.get_mapper("S1", "fullhead", "nearest")
+    tmpdir = str(tmp_path)
+    path = cortex.mapper._savecache(os.path.join(tmpdir, "mapper"), mapper.masks[0],
+                                    mapper.masks[1], mapper.shape)
+    path = cache.save(path, fmt="mmap", **cache.load(path))
+    loaded = cortex.mapper.Mapper.from_cache(path, "S1", "fullhead")
+    vol = cortex.Volume.random("S1", "fullhead")
+    assert np.allclose(loaded(vol).data, mapper(vol).data)
+
+
+def test_memory_cache():
+    memory = cache.MemoryCache(maxbytes=2000)
+    memory.put(("a", "S1", 1), np.zeros(100))
+    memory.put(("b", "S1", 1), np.zeros(100))
+    assert memory.get(("a", "S1", 1)) is not None
+    memory.put(("c", "S1", 1), np.zeros(100))
+    # "b" was least recently used
+    assert ("b", "S1", 1) not in memory and ("a", "S1", 1) in memory
+    assert memory.get(("b", "S1", 1)) is None
+    assert memory.stats["hits"] == 1 and memory.stats["misses"] == 1
+    assert memory.nbytes == 1600
+
+    memory.invalidate("a")
+    assert len(memory) == 1
+    memory.invalidate()
+    assert len(memory) == 0 and memory.nbytes == 0
+
+
+def test_flatcache_memory():
+    pixmap = cortex.quickflat.utils.get_flatcache("S1", "fullhead", height=128, thick=2)
+    hits = cache.memory.hits
+    again = cortex.quickflat.utils.get_flatcache("S1", "fullhead", height=128, thick=2)
+    assert again is pixmap and cache.memory.hits == hits + 1
+
+    mapper = cortex.get_mapper("S1", "fullhead", "nearest")
+    assert cortex.get_mapper("S1", "fullhead", "nearest") is mapper
+    assert cortex.get_mapper("S1", "fullhead", "nearest", recache=True) is not mapper
+
+
+def test_surface_memory():
+    pts, polys = cortex.db.get_surf("S1", "flat", merge=True, nudge=True)
+    # equivalent calls share the same read-only arrays
+    again, _ = cortex.db.get_surf("S1", "flat", "both", True, nudge=True)
+    assert np.shares_memory(pts, again)
+    assert not pts.flags.writeable and not polys.flags.writeable
+    with pytest.raises(ValueError):
+        pts[0] = 0
+
+    copied, _ = cortex.db.get_surf("S1", "flat", merge=True, nudge=True, copy=True)
+    assert copied.flags.writeable and not np.shares_memory(pts, copied)
+    copied[0] = 0
+    assert not np.allclose(cortex.db.get_surf("S1", "flat", merge=True, nudge=True)[0][0], 0)
+
+
+def test_concurrent_build(tmp_path):
+    import multiprocessing as mp
+    tmpdir = str(tmp_path)
+    path = os.path.join(tmpdir, "array")
+    log = os.path.join(tmpdir, "builds")
+
+    def build():
+        with cache.building(path) as stale:
+            if stale:
+                with open(log, "a") as fp:
+                    fp.write("built\n")
+                cache.save(path, fmt="npz", array=np.arange(1000000))
+        return cache.load(path)["array"]
+
+    procs = [mp.get_context("fork").Process(target=build) for _ in range(4)]
+    for proc in procs:
+        proc.start()
+    for proc in procs:
+        proc.join()
+    assert all(proc.exitcode == 0 for proc in procs)
+    with open(log) as fp:
+        assert len(fp.readlines()) == 1
+    assert np.array_equal(build(), np.arange(1000000))
+    # no temporary or lock file is left behind
+    assert sorted(os.listdir(tmpdir)) == ["array.npz", "builds"]
+
+
+def test_manifest(tmp_path):
+    tmpdir = str(tmp_path)
+    xfmfile = os.path.join(tmpdir, "matrices.xfm")
+    with open(xfmfile, "w") as fp:
+        fp.write("[1, 0, 0]")
+    manifest = cache.Manifest(tmpdir)
+
+    path = manifest.path_for("mapper", [xfmfile])
+    # looking up a path does not write the manifest, building the cache does
+    assert not os.path.exists(manifest.path)
+    with cache.building(path) as stale:
+        assert stale
+        cache.save(path, fmt="npz", data=np.zeros(10))
+    np.save(path + ".npy", np.zeros(10))
+    assert os.path.exists(manifest.path)
+    # rewriting the same contents keeps the cache
+    with open(xfmfile, "w") as fp:
+        fp.write("[1, 0, 0]")
+    assert manifest.path_for("mapper", [xfmfile]) == path
+    assert cache.find(path) is not None
+
+    # new contents give a new cache, and the previous one is removed once built
+    with open(xfmfile, "w") as fp:
+        fp.write("[2, 0, 0, 0]")
+    newpath = manifest.path_for("mapper", [xfmfile])
+    assert newpath != path
+    assert cache.find(path) is not None
+    with cache.building(newpath) as stale:
+        assert stale
+        cache.save(newpath, fmt="npz", data=np.ones(10))
+    assert cache.find(path) is None
+    assert not os.path.exists(path + ".npy")
@@ -70,6 +70,19 @@ def test_rgb():
     assert data.raw.vertices.shape == (1, nverts, 4)
     data.raw.to_json()
 
+def test_mix_colors():
+    from cortex.dataset import viewRGB
+    channels = [np.random.rand(4, 5, 6) for _ in range(3)]
+    colors = [viewRGB.Colors.RoseRed, viewRGB.Colors.LimeGreen, viewRGB.Colors.SkyBlue]
+    rgba = viewRGB.mix_colors(channels, colors, value_max=0.6, saturation_max=0.8,
+                              out=np.zeros((4, 5, 6, 4), dtype=np.uint8), blocksize=7)
+    for idx in [(0, 0, 0), (1, 2, 3), (3, 4, 5)]:
+        color = sum(c[idx] * np.array(col) for c, col in zip(channels, colors)) / 3.0
+        hue, saturation, value = viewRGB.RGB2HSV(color)
+        expected = viewRGB.HSV2RGB([hue, min(saturation / 0.8, 1), min(value / 0.6, 1)])
+        assert tuple(rgba[idx][:3]) == expected
+    assert (rgba[..., 3] == 0).all()
+
 def test_2D():
     d1 = cortex.Volume.random(subj, xfmname)
     d2 = cortex.Volume.random(subj, xfmname).masked['thick']
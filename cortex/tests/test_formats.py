@@ -20,3 +20,27 @@ def test_write_read_gii():
         assert_array_equal(wm, wm2)
         assert_array_equal(polys, polys2)
 
+
+def test_binary_surface():
+    from cortex import formats
+    pts, polys = cortex.db.get_surf("S1", "wm", "lh", copy=True)
+    # nibabel only writes int32 polygons
+    polys = polys.astype(np.int32)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        globname = os.path.join(tmpdir, "wm_lh")
+        write_gii(globname + ".gii", pts, polys)
+        assert formats.convert_bsf(globname) == globname + ".bsf"
+        # already up to date
+        assert formats.convert_bsf(globname) is None
+
+        pts2, polys2 = formats.read(globname)
+        assert not pts2.flags.writeable
+        assert pts2.dtype == pts.dtype and polys2.dtype == polys.dtype
+        assert_array_equal(pts, pts2)
+        assert_array_equal(polys, polys2)
+
+        # the binary surface is ignored once the original file is newer
+        write_gii(globname + ".gii", pts + 1, polys)
+        mtime = os.stat(globname + ".bsf").st_mtime
+        os.utime(globname + ".gii", (mtime + 1, mtime + 1))
+        assert_array_equal(formats.read(globname)[0], pts + 1)
@@ -0,0 +1,55 @@
+import os
+import tempfile
+
+import numpy as np
+
+import cortex
+
+subj, xfmname = "S1", "fullhead"
+
+
+def test_map_chunked():
+    mapper = cortex.get_mapper(subj, xfmname, "nearest")
+    vol = np.random.randn(10, *mapper.shape)
+    expected = mapper(cortex.Volume(vol, subj, xfmname)).data
+
+    # plain arrays and Volume objects
+    assert np.allclose(mapper.map_chunked(vol, chunksize=3), expected)
+    assert np.allclose(mapper.map_chunked(cortex.Volume(vol, subj, xfmname), chunksize=4), expected)
+
+    # iterables of chunks of unknown total length need a preallocated output
+    out = np.zeros_like(expected)
+    mapper.map_chunked(iter(np.array_split(vol, 3)), out=out)
+    assert np.allclose(out, expected)
+
+    starts = [start for start, _ in mapper.iter_chunks(vol, chunksize=4)]
+    assert starts == [0, 4, 8]
+
+
+def test_map_chunked_nifti():
+    import nibabel
+    mapper = cortex.get_mapper(subj, xfmname, "nearest")
+    vol = np.random.randn(5, *mapper.shape)
+    expected = mapper(cortex.Volume(vol, subj, xfmname)).data
+    with tempfile.TemporaryDirectory() as tmpdir:
+        fname = os.path.join(tmpdir, "run.nii")
+        nibabel.Nifti1Image(vol.T, np.eye(4)).to_filename(fname)
+        assert np.allclose(mapper.map_chunked(fname, chunksize=2), expected)
+
+
+def test_distance_samplers():
+    from cortex.mapper import samplers
+    shape = (10, 12, 14)
+    coords = np.random.rand(200, 3) * np.array([14, 12, 10])
+    coords[3] = np.nan
+    for sampler in [samplers.lanczos, samplers.gaussian]:
+        i, j, data = sampler(coords, shape, blocksize=64)
+        assert 3 not in i
+        sums = np.bincount(i, weights=data, minlength=len(coords))
+        assert np.allclose(sums[np.arange(len(coords)) != 3], 1)
+
+    # lanczos is interpolating: integer coordinates sample a single voxel
+    grid = np.array([[1, 2, 3], [4, 5, 6]], dtype=float)
+    i, j, data = samplers.lanczos(grid, shape)
+    assert np.allclose(data[data > 1e-12], 1)
+    assert set(j[data > 1e-12]) == set(np.ravel_multi_index(grid.T[::-1].astype(int), shape))
@@ -0,0 +1,33 @@
+import numpy as np
+
+from cortex import mp
+
+
+def test_map_matches_serial():
+    offset = np.random.randn(5)
+    func = lambda x: (x, offset * x)
+    items = list(range(37))
+    serial = mp.map(func, items, procs=1)
+    parallel = mp.map(func, iter(items), procs=3, batchsize=4)
+    assert [i for i, _ in parallel] == items
+    for (_, a), (_, b) in zip(serial, parallel):
+        assert np.allclose(a, b)
+
+
+def test_map_array():
+    func = lambda x: np.full((2, 3), x, dtype=np.uint8)
+    serial = mp.map_array(func, range(20), (2, 3), dtype=np.uint8, procs=1)
+    parallel = mp.map_array(func, range(20), (2, 3), dtype=np.uint8, procs=4)
+    assert parallel.shape == (20, 2, 3)
+    assert parallel.dtype == np.uint8
+    assert np.array_equal(serial, parallel)
+    assert np.array_equal(parallel[:, 0, 0], np.arange(20))
+
+
+def test_imap():
+    func = lambda x: x ** 2
+    results = mp.imap(func, range(25), procs=3, batchsize=2)
+    assert next(results) == 0
+    # other parallel calls can run while the results are consumed
+    assert mp.map(func, range(5), procs=2) == [0, 1, 4, 9, 16]
+    assert list(results) == [x ** 2 for x in range(1, 25)]
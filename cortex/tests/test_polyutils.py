@@ -16,3 +16,63 @@ def test_surfpatch():
     subwm, subpia, subpolys = surf.extract_chunk(auxpts=pia)
     subsurf = polyutils.Surface(subwm, subpolys)
     _ = [patch for patch in subsurf.patches(n=0.5)]
+
+def test_operator_cache():
+    import tempfile
+    from cortex import db
+    pts, polys = db.get_surf("S1", "fiducial", "lh")
+    subpts, subpolys = polyutils.Surface(pts, polys).extract_chunk(nfaces=2000, seed=1000)
+    reference = polyutils.Surface(subpts, subpolys)
+    with tempfile.TemporaryDirectory() as cachedir:
+        surf = polyutils.Surface(subpts, subpolys, cachedir=cachedir)
+        dist = surf.geodesic_distance([0])
+        assert np.allclose(dist, reference.geodesic_distance([0]))
+
+        # a new surface for the same mesh loads the operator and reuses the factorizations
+        surf2 = polyutils.Surface(subpts, subpolys, cachedir=cachedir)
+        assert surf2.mesh_hash == surf.mesh_hash
+        for a, b in zip(surf.laplace_operator, surf2.laplace_operator):
+            assert np.allclose(np.asarray(a.todense()) if hasattr(a, "todense") else a,
+                               np.asarray(b.todense()) if hasattr(b, "todense") else b)
+        assert surf2._get_heat_solver(1.0)[1] is surf._get_heat_solver(1.0)[1]
+        assert np.allclose(surf2.geodesic_distance([0]), dist)
+        assert np.allclose(surf2.smooth(dist, 2.0), reference.smooth(dist, 2.0))
+
+def test_geodesic_distances():
+    from cortex import db
+    pts, polys = db.get_surf("S1", "fiducial", "lh")
+    subpts, subpolys = polyutils.Surface(pts, polys).extract_chunk(nfaces=2000, seed=1000)
+    surf = polyutils.Surface(subpts, subpolys)
+    seeds = [0, 10, 100, 500]
+    expected = np.vstack([surf.geodesic_distance([v]) for v in seeds])
+    assert np.allclose(surf.geodesic_distances(seeds, chunksize=3), expected)
+
+    sparse_dists = surf.geodesic_distances(seeds, max_dist=4.0)
+    assert sparse_dists.shape == expected.shape
+    assert sparse_dists.nnz == (expected <= 4.0).sum()
+    assert np.allclose(sparse_dists.toarray()[expected <= 4.0], expected[expected <= 4.0])
+
+def test_graph_patches():
+    from scipy.sparse.csgraph import dijkstra
+    from cortex import db
+    pts, polys = db.get_surf("S1", "fiducial", "lh")
+    subpts, subpolys = polyutils.Surface(pts, polys).extract_chunk(nfaces=2000, seed=1000)
+    surf = polyutils.Surface(subpts, subpolys)
+    seeds = np.arange(0, len(subpts), 50)
+
+    expected = dijkstra(surf.edge_graph, directed=False, indices=seeds, limit=3.0)
+    dists = surf.get_graph_patches(3.0, seeds, chunksize=4, procs=2)
+    assert np.array_equal(dists.toarray() > 0, np.isfinite(expected) & (expected > 0))
+
+    patches = surf.get_geodesic_patches(3.0, seeds=seeds, output='sparse', method='graph')
+    assert patches['vertex_masks'].shape == (len(seeds), len(subpts))
+    assert np.array_equal(patches['vertex_masks'].toarray(), np.isfinite(expected))
+
+    refined = surf.get_geodesic_patches(3.0, seeds=seeds, method='graph', refine=True)
+    assert refined['vertex_masks'][np.arange(len(seeds)), seeds].all()
+
+def test_point_triangle_distance():
+    tri = np.array([[0, 0, 0], [1, 0, 0], [0, 1, 0]], dtype=float)
+    pts = np.array([[.25, .25, 2], [-1, 0, 0], [1, 1, 0], [.5, -1, -1]])
+    expected = [2, 1, np.sqrt(.5), np.sqrt(2)]
+    assert np.allclose(polyutils.point_triangle_distance(pts, *tri), expected)
@@ -40,3 +40,191 @@ def test_make_flatmap_image_nanmean(type_, nanmean):
         vol, nanmean=nanmean)
     # assert that the nanmean only returns NaNs and 1s
     assert np.nanmin(img) == 1
+
+
+def test_pixel_cache_chunks():
+    from cortex.quickflat.utils import _make_pixel_cache
+    whole = _make_pixel_cache("S1", "fullhead", height=128, thick=4,
+                              chunksize=10**7, procs=1)
+    chunked = _make_pixel_cache("S1", "fullhead", height=128, thick=4,
+                                chunksize=500, procs=2)
+    assert whole.shape == chunked.shape
+    assert abs(whole - chunked).max() < 1e-12
+    rowsums = np.asarray(whole.sum(1)).ravel()
+    assert np.allclose(rowsums[rowsums > 0], 1)
+
+
+def test_flatbary():
+    from cortex.quickflat.utils import get_flatbary, get_flatmask
+    triangles, weights = get_flatbary("S1", height=128, recache=True)
+    mask, _ = get_flatmask("S1", height=128)
+    assert len(triangles) == mask.sum()
+    assert np.all(triangles >= 0)
+    assert np.allclose(weights.sum(1), 1)
+    assert np.all(weights > -1e-6)
+
+    # pixels inside the mesh are interpolated back to their own position
+    flat, polys = cortex.db.get_surf("S1", "flat", merge=True, nudge=True)
+    fmin, fmax = flat.min(0)[:2], flat.max(0)[:2]
+    grid = np.column_stack(np.nonzero(mask)) * (fmax - fmin) / (np.array(mask.shape) - 1) + fmin
+    position = np.einsum('nij,ni->nj', flat[polys[triangles], :2], weights)
+    inside = np.all(weights > 1e-6, axis=1)
+    assert inside.mean() > 0.9
+    assert np.allclose(position[inside], grid[inside], atol=1e-3)
+
+
+def test_flatcache_master():
+    from cortex.options import config
+    from cortex.quickflat.utils import get_flatcache, get_flatmask
+    mask, extents = get_flatmask("S1", height=64)
+    config.set("basic", "flatmap_master_height", "128")
+    try:
+        derived, derived_extents = get_flatmask("S1", height=64, recache=True)
+        pixmap = get_flatcache("S1", "fullhead", height=64, thick=2, recache=True)
+        image, _ = cortex.quickflat.make_flatmap_image(cortex.Volume.random("S1", "fullhead"),
+                                                       height=64, thick=2)
+    finally:
+        config.set("basic", "flatmap_master_height", "")
+    assert derived.shape == mask.shape
+    assert np.allclose(derived_extents, extents)
+    assert (derived != mask).mean() < 0.05
+    assert pixmap.shape[0] == derived.sum()
+    rowsums = np.asarray(pixmap.sum(1)).ravel()
+    assert np.allclose(rowsums[rowsums > 0], 1)
+    assert image.shape == derived.T.shape
+
+
+def test_flatmap_tiles():
+    from cortex.quickflat import tiles
+    vol = cortex.Volume.random("S1", "fullhead")
+    info = tiles.get_tile_info("S1", 2, tilesize=64)
+    level = info["levels"][1]
+    image = np.vstack([np.hstack([tiles.make_tile_image(vol, 1, x, y, tilesize=64, thick=2)
+                                  for x in range(level["columns"])])
+                       for y in range(level["rows"])])
+    full, _ = cortex.quickflat.make_flatmap_image(vol, height=128, thick=2)
+    assert full.shape == (level["height"], level["width"])
+    # tiles along the edges are padded
+    assert np.isnan(image[full.shape[0]:]).all() and np.isnan(image[:, full.shape[1]:]).all()
+    np.testing.assert_array_equal(image[:full.shape[0], :full.shape[1]], full)
+
+    with pytest.raises(ValueError):
+        tiles.make_tile_image(vol, 1, level["columns"], 0, tilesize=64)
+    png = tiles.make_tile(vol, 1, 0, 0, tilesize=64, thick=2)
+    assert png.startswith(b"\x89PNG")
+
+
+@pytest.mark.parametrize("nanmean", [True, False])
+def test_make_flatmap_images(nanmean):
+    data = np.random.randn(5, 31, 100, 100)
+    data[:, 10] = np.nan
+    movie = cortex.Volume(data, "S1", "fullhead")
+    images, extents = cortex.quickflat.make_flatmap_images(
+        movie, height=128, nanmean=nanmean, blocksize=2)
+    assert images.shape[0] == 5
+    for i in [0, 4]:
+        vol = cortex.Volume(data[i], "S1", "fullhead")
+        img, _ = cortex.quickflat.make_flatmap_image(vol, height=128, nanmean=nanmean)
+        assert np.allclose(images[i], img, equal_nan=True)
+
+
+@pytest.mark.parametrize("with_curvature", [True, False])
+def test_make_png_fast(with_curvature):
+    from PIL import Image
+    vol = cortex.Volume.random("S1", "fullhead", cmap="hot", vmin=-1, vmax=2)
+    kwargs = dict(height=256, with_rois=False, with_colorbar=False,
+                  with_curvature=with_curvature)
+    with tempfile.NamedTemporaryFile(suffix=".png") as fig, \
+            tempfile.NamedTemporaryFile(suffix=".png") as fast:
+        cortex.quickflat.make_png(fig.name, vol, **kwargs)
+        cortex.quickflat.make_png(fast.name, vol, fast=True, **kwargs)
+        expected = np.array(Image.open(fig.name)).astype(int)
+        image = np.array(Image.open(fast.name)).astype(int)
+    assert image.shape == expected.shape
+    # matplotlib may resample the image one pixel off, colors must match
+    diff = np.full(image.shape[:2], 255)
+    for shift in [(0, 0), (0, 1), (0, -1), (1, 0), (-1, 0)]:
+        shifted = np.roll(image, shift, axis=(0, 1))
+        diff = np.minimum(diff, np.abs(expected - shifted).max(-1))
+    assert diff.max() <= 1
+
+    rgba = cortex.quickflat.make_rgba(vol, height=256, with_rois=False,
+                                     with_colorbar=True)
+    assert rgba.dtype == np.uint8
+    assert rgba.shape == image.shape[:2] + (4,)
+
+
+@pytest.mark.parametrize("kind", ["linear", "nearest"])
+def test_movie_interpolation(kind):
+    from scipy.interpolate import interp1d
+    from cortex.quickflat.view import _interpolate_frames
+    images = np.random.randn(7, 3, 4)
+    expected = interp1d(np.arange(7), images, axis=0, kind=kind)(np.arange(16) / 2.5)
+    for blocksize in [1, 3, 10]:
+        blocks = (images[i:i+blocksize] for i in range(0, len(images), blocksize))
+        frames = np.array(list(_interpolate_frames(blocks, 2.5, kind=kind)))
+        assert np.allclose(frames, expected)
+
+
+def test_movie_encoding():
+    import sys
+    from cortex.quickflat.view import _encode_frames
+    frames = (np.full((10, 20, 4), i, dtype=np.uint8) for i in range(50))
+    with tempfile.NamedTemporaryFile() as raw:
+        copy = "import shutil, sys; shutil.copyfileobj(sys.stdin.buffer, open(sys.argv[1], 'wb'))"
+        _encode_frames([sys.executable, "-c", copy, raw.name], frames)
+        movie = np.fromfile(raw.name, dtype=np.uint8).reshape(50, 10, 20, 4)
+    assert np.all(movie == np.arange(50)[:, None, None, None])
+
+    fail = "import sys; sys.stdin.buffer.read(100); sys.exit('encoder error')"
+    frames = (np.zeros((100, 100, 4), dtype=np.uint8) for i in range(50))
+    with pytest.raises(RuntimeError, match="encoder error"):
+        _encode_frames([sys.executable, "-c", fail], frames)
+
+
+@pytest.mark.parametrize("fast", [True, False])
+def test_make_gif(fast):
+    import io
+    import imageio
+    volumes = dict(("frame%d" % i, cortex.Volume.random("S1", "fullhead")) for i in range(3))
+    stream = io.BytesIO()
+    cortex.quickflat.make_gif(stream, volumes, fast=fast, procs=2, with_rois=False,
+                              height=128)
+    frames = list(imageio.v3.imiter(stream.getvalue()))
+    assert len(frames) == 3
+    assert frames[0].shape[:2] == frames[-1].shape[:2]
+
+
+@pytest.mark.skipif(no_inkscape, reason='Inkscape required')
+def test_overlay_texture_cache():
+    import glob
+    import os
+    cachedir = cortex.db.get_cache("S1")
+    svg = cortex.db.get_overlay("S1")
+    texture = svg.get_texture("rois", 128, labels=False)
+    assert svg.get_texture("rois", 128, labels=False) is texture
+    assert not texture.flags.writeable
+    cached = glob.glob(os.path.join(cachedir, "overlay_*.png"))
+    assert len(cached) > 0
+
+    cortex.cache.memory.invalidate("overlay")
+    svg = cortex.db.get_overlay("S1")
+    assert np.array_equal(svg.get_texture("rois", 128, labels=False), texture)
+    assert sorted(glob.glob(os.path.join(cachedir, "overlay_*.png"))) == sorted(cached)
+
+
+def test_curvature_image_cache():
+    from cortex.quickflat.utils import get_curvature_image, _make_curvature_image
+    expected = _make_curvature_image("S1", 128, threshold=True)
+    curv = get_curvature_image("S1", 128, threshold=True, recache=True)
+    assert np.allclose(curv, expected, equal_nan=True)
+    assert not curv.flags.writeable
+    # equivalent parameters share the cache
+    assert get_curvature_image("S1", 128, threshold=True, curvature_lims=(-0.5, 0.5)) is curv
+
+    cortex.cache.memory.invalidate("curvature")
+    loaded = get_curvature_image("S1", 128, threshold=True)
+    assert loaded is not curv
+    assert np.allclose(loaded, expected, equal_nan=True)
+    other = get_curvature_image("S1", 128, threshold=False)
+    assert not np.allclose(other, expected, equal_nan=True)
@@ -0,0 +1,177 @@
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import pytest
+from lxml import etree
+
+import cortex
+from cortex import svgoverlay
+from cortex.testing_utils import has_installed
+
+no_inkscape = not has_installed('inkscape')
+
+SHAPES = dict(
+    square="m 300,300 l 200,0 0,200 -200,0 z",
+    curve="m 1200,300 c 50,-80 150,-80 200,0 l 0,150 h -200 z",
+)
+# open paths, drawn as lines
+SULCI = dict(
+    arc="m 700,700 c 100,-150 300,-150 400,0",
+    zigzag="M 1500,600 L 1600,700 1700,600 1800,700",
+)
+CUSTOM = dict(
+    triangle="m 900,200 l 150,250 -300,0 z",
+)
+CUSTOM_STYLE = {"fill": "#00ff00", "fill-opacity": "0.8", "stroke": "#ffff00",
+                "stroke-width": "4"}
+
+# Agg textures of the layers of the overlay fixture, a regression snapshot of the
+# Agg renderer rather than a reference rendering; run this module to regenerate it
+SNAPSHOT_TEXTURES = os.path.join(os.path.dirname(__file__), "data", "agg_textures.npz")
+SNAPSHOT_HEIGHT = 256
+
+
+def _make_overlay(tmpdir):
+    """Overlay of S1 with the shapes in SHAPES, SULCI and CUSTOM in the rois,
+    sulci and custom layers, stored in `tmpdir`"""
+    svgfile = os.path.join(tmpdir, "overlays.svg")
+    shutil.copy(cortex.db.get_paths("S1")["overlays"], svgfile)
+    svg = etree.parse(svgfile, parser=svgoverlay.parser)
+    custom = svgoverlay._make_layer(svg.getroot(), "custom")
+    svgoverlay._make_layer(custom, "shapes")
+    svgoverlay._make_layer(custom, "labels")
+    for layer, paths in [("rois", SHAPES), ("sulci", SULCI), ("custom", CUSTOM)]:
+        shapes = svgoverlay._find_layer(svgoverlay._find_layer(svg, layer), "shapes")
+        for name, path in paths.items():
+            shape = svgoverlay._make_layer(shapes, name)
+            etree.SubElement(shape, "{%s}path" % svgoverlay.svgns).set("d", path)
+    with open(svgfile, "wb") as fp:
+        fp.write(etree.tostring(svg))
+    pts, polys = cortex.db.get_surf("S1", "flat", merge=True, nudge=True)
+    return svgoverlay.get_overlay("S1", svgfile, pts, polys)
+
+
+@pytest.fixture
+def overlay(tmp_path):
+    return _make_overlay(str(tmp_path))
+
+
+def _layer_style(layer):
+    if layer == "custom":
+        return dict(CUSTOM_STYLE)
+    return cortex.quickflat.utils._parse_defaults(layer + "_paths")
+
+
+def _render_layers(overlay, renderer):
+    return dict((layer, overlay.get_texture(layer, SNAPSHOT_HEIGHT, labels=False,
+                                            renderer=renderer, **_layer_style(layer)))
+                for layer in ["rois", "sulci", "custom"])
+
+
+def test_svg_path():
+    for pathdef in SHAPES.values():
+        element = etree.Element("path", d=pathdef)
+        expected = svgoverlay.gen_path(element)
+        path = svgoverlay._svg_path(pathdef)
+        assert np.array_equal(path.codes, expected.codes)
+        drawn = path.codes != path.CLOSEPOLY
+        assert np.allclose(path.vertices[drawn], expected.vertices[drawn])
+
+    # smooth curves reflect the last control point
+    path = svgoverlay._svg_path("M0,0 C0,10 10,10 10,0 S20,-10 20,0 Q25,5 30,0 T40,0")
+    assert np.allclose(path.vertices[4], [10, -10])
+    assert np.allclose(path.vertices[9], [35, -5])
+    path = svgoverlay._svg_path("M 10 10 H 20 V 30 h -5 v -5 Z")
+    assert np.allclose(path.vertices[:5], [[10, 10], [20, 10], [20, 30], [15, 30], [15, 25]])
+
+
+def test_agg_texture(overlay):
+    style = dict(fill="#ff0000", stroke="#0000ff")
+    style["fill-opacity"] = "1"
+    height = 256
+    texture = overlay.get_texture("rois", height, labels=False, renderer="agg", **style)
+    width, svgheight = overlay.svgshape
+    scale = height / svgheight
+    assert texture.shape == (height, int(width * scale), 4)
+    # inside, on the border and outside of the square
+    assert np.allclose(texture[int(400 * scale), int(400 * scale)], [1, 0, 0, 1])
+    assert texture[int(300 * scale), int(400 * scale), 2] > 0.5
+    assert texture[int(600 * scale), int(400 * scale), 3] == 0
+
+    only_curve = overlay.get_texture("rois", height, labels=False, renderer="agg",
+                                     shape_list=["curve"], **style)
+    assert only_curve[int(400 * scale), int(400 * scale), 3] == 0
+    assert np.allclose(only_curve[int(350 * scale), int(1300 * scale)], [1, 0, 0, 1])
+
+    labeled = overlay.get_texture("rois", height, labels=True, renderer="agg", **style)
+    assert not np.array_equal(labeled, texture)
+
+
+def test_texture_disk_cache(overlay, tmp_path):
+    from cortex.options import config
+    overlay.cachedir = str(tmp_path / "cache")
+    os.makedirs(overlay.cachedir)
+    limit = config.get("basic", "overlay_cache")
+    config.set("basic", "overlay_cache", "2")
+    try:
+        textures = [overlay.get_texture("rois", height, labels=False, renderer="agg")
+                    for height in (32, 48, 64)]
+    finally:
+        config.set("basic", "overlay_cache", limit)
+    # the least recently used texture is evicted, nothing else is left behind
+    cached = os.listdir(overlay.cachedir)
+    assert len(cached) == 2
+    assert all(fname.startswith("overlay_") and fname.endswith(".png") for fname in cached)
+
+    cortex.cache.memory.invalidate("overlay")
+    texture = overlay.get_texture("rois", 64, labels=False, renderer="agg")
+    assert np.array_equal(texture, textures[-1])
+    assert sorted(os.listdir(overlay.cachedir)) == sorted(cached)
+
+
+def test_agg_texture_snapshot(overlay):
+    """Catches changes in the Agg renderer; agreement with inkscape is only
+    checked by test_agg_inkscape_layers"""
+    snapshot = np.load(SNAPSHOT_TEXTURES)
+    for layer, texture in _render_layers(overlay, "agg").items():
+        expected = snapshot[layer] / 255.
+        assert texture.shape == expected.shape
+        assert expected[..., 3].max() > 0, "empty snapshot for %s" % layer
+        # allow for differences in antialiasing across matplotlib versions
+        diff = np.abs(texture - expected)
+        assert diff.mean() < 0.01
+        assert (diff.max(-1) > 0.25).mean() < 0.01
+
+
+@pytest.mark.skipif(no_inkscape, reason='Inkscape required')
+def test_agg_inkscape_layers(overlay):
+    agg = _render_layers(overlay, "agg")
+    for layer, texture in _render_layers(overlay, "inkscape").items():
+        width = min(texture.shape[1], agg[layer].shape[1])
+        assert np.abs(texture[:, :width, 3] - agg[layer][:, :width, 3]).mean() < 0.05
+
+
+@pytest.mark.skipif(no_inkscape, reason='Inkscape required')
+def test_agg_inkscape_parity(overlay):
+    from scipy.ndimage import binary_dilation
+    style = cortex.quickflat.utils._parse_defaults("rois_paths")
+    style.update({"fill": "#ff0000", "fill-opacity": "0.5"})
+    agg = overlay.get_texture("rois", 512, labels=False, renderer="agg", **style)
+    inkscape = overlay.get_texture("rois", 512, labels=False, renderer="inkscape", **style)
+    width = min(agg.shape[1], inkscape.shape[1])
+    agg, inkscape = agg[:, :width] > 0.5, inkscape[:, :width] > 0.5
+    # all opaque pixels match up to a pixel
+    for a, b in [(agg, inkscape), (inkscape, agg)]:
+        near = binary_dilation(b, iterations=1)
+        assert (a & ~near).sum() <= 0.01 * a.sum()
+
+
+if __name__ == "__main__":
+    # regenerates the snapshot after an intended change of the Agg renderer
+    with tempfile.TemporaryDirectory() as tmpdir:
+        textures = _render_layers(_make_overlay(tmpdir), "agg")
+    os.makedirs(os.path.dirname(SNAPSHOT_TEXTURES), exist_ok=True)
+    np.savez_compressed(SNAPSHOT_TEXTURES, **dict(
+        (layer, np.round(texture * 255).astype(np.uint8)) for layer, texture in textures.items()))
@@ -10,3 +10,15 @@ def test_download_subject():
     assert "fsaverage" not in cortex.db.subjects
     cortex.utils.download_subject(subject_id='fsaverage')
     assert "fsaverage" in cortex.db.subjects
+
+def test_vox_dist_max_dist():
+    import numpy as np
+    dist, idx = cortex.utils.get_vox_dist("S1", "fullhead")
+    pdist, pidx = cortex.utils.get_vox_dist("S1", "fullhead", max_dist=4)
+    near = dist < 4
+    assert np.array_equal(pdist < 4, near)
+    assert np.array_equal(pidx[near], idx[near])
+    assert np.isinf(pdist[~near]).all()
+
+    ribbon = cortex.get_cortical_mask("S1", "fullhead", "cortical", exact=True)
+    assert ribbon.shape == dist.shape and ribbon.any()
@@ -134,7 +134,7 @@ def get_ctmmap(subject, **kwargs):
     rnew = rmap.query(right[0])[1]
     return lnew, rnew
 
-def get_cortical_mask(subject, xfmname, type='nearest'):
+def get_cortical_mask(subject, xfmname, type='nearest', exact=False):
     """Gets the cortical mask for a particular transform
 
     Parameters
@@ -152,6 +152,13 @@ def get_cortical_mask(subject, xfmname, type='nearest'):
           - 'nearest' includes only the voxels overlapping the fiducial surface.
           - 'line_nearest' includes all voxels that have any part within the cortical 
             ribbon.
+    exact : bool, optional
+        Only used for type 'cortical'. If False (default), voxels closer to the
+        nearest fiducial vertex than the cortical thickness at that vertex are
+        included. If True, the point-to-triangle distances from each voxel to
+        both the pial and white matter surfaces are computed, and voxels are
+        included if the sum of these distances is at most the local cortical
+        thickness, i.e. if they lie between the two surfaces.
 
     Returns
     -------
@@ -168,22 +175,43 @@ def get_cortical_mask(subject, xfmname, type='nearest'):
         wpts, polys = db.get_surf(subject, "wm", merge=True, nudge=False)
         thickness = np.sqrt(((ppts - wpts)**2).sum(1))
 
-        dist, idx = get_vox_dist(subject, xfmname)
-        cortex = np.zeros(dist.shape, dtype=bool)
-        verts = np.unique(idx)
-        for i, vert in enumerate(verts):
-            mask = idx == vert
-            cortex[mask] = dist[mask] <= thickness[vert]
-            if i % 100 == 0:
-                print("%0.3f%%"%(i/float(len(verts)) * 100))
-        return cortex
+        if exact:
+            return _get_ribbon_mask(subject, xfmname, ppts, wpts, polys, thickness)
+
+        dist, idx = get_vox_dist(subject, xfmname, max_dist=thickness.max())
+        # voxels beyond max_dist have idx == len(thickness) and infinite dist
+        thickness = np.append(thickness, 0)
+        return dist <= thickness[idx]
     elif type in ('thick', 'thin'):
-        dist, idx = get_vox_dist(subject, xfmname)
-        return dist < dict(thick=8, thin=2)[type]
+        max_dist = dict(thick=8, thin=2)[type]
+        dist, idx = get_vox_dist(subject, xfmname, max_dist=max_dist)
+        return dist < max_dist
     else:
         return get_mapper(subject, xfmname, type=type).mask
 
 
+def _get_near_voxels(xfm, pts, max_dist):
+    """Boolean (x, y, z) mask of voxels that may be within `max_dist` mm of any
+    of `pts`: voxels containing a point, dilated by the number of voxels that
+    `max_dist` may span."""
+    from scipy import ndimage
+
+    x, y, z = xfm.shape[::-1]
+    near = np.zeros((x, y, z), dtype=bool)
+    if not np.isfinite(max_dist):
+        near[:] = True
+        return near
+
+    vox = np.round(xfm(pts)).astype(int)
+    vox = np.clip(vox, 0, np.array([x, y, z]) - 1)
+    near[vox[:, 0], vox[:, 1], vox[:, 2]] = True
+
+    voxsize = np.sqrt((np.linalg.inv(xfm.xfm)[:3, :3]**2).sum(0)).min()
+    iterations = int(np.ceil(max_dist / voxsize)) + 1
+    return ndimage.binary_dilation(near, structure=np.ones((3, 3, 3), dtype=bool),
+                                   iterations=iterations)
+
+
 def get_vox_dist(subject, xfmname, surface="fiducial", max_dist=np.inf):
     """Get the distance (in mm) from each functional voxel to the closest
     point on the surface.
@@ -203,26 +231,72 @@ def get_vox_dist(subject, xfmname, surface="fiducial", max_dist=np.inf):
     dist : ndarray (z, y, x)
         Array with the same shape as the reference image of `xfmname` containing
         the distance (in mm) of each voxel to the closest point on the surface.
+        Voxels further than `max_dist` are set to inf.
 
     argdist : ndarray (z, y, x)
         Array with the same shape as the reference image of `xfmname` containing
-        for each voxel the index of the closest point on the surface.
+        for each voxel the index of the closest point on the surface. Voxels
+        further than `max_dist` are set to the number of surface points.
     """
     from scipy.spatial import cKDTree
 
     fiducial, polys = db.get_surf(subject, surface, merge=True)
     xfm = db.get_xfm(subject, xfmname)
     z, y, x = xfm.shape
-    idx = np.mgrid[:x, :y, :z].reshape(3, -1).T
+
+    # only query the voxels that can be close enough to the surface
+    near = _get_near_voxels(xfm, fiducial, max_dist)
+    idx = np.array(np.nonzero(near)).T
     mm = xfm.inv(idx)
 
+    dist = np.full((x, y, z), np.inf)
+    argdist = np.full((x, y, z), len(fiducial), dtype=int)
     tree = cKDTree(fiducial)
-    dist, argdist = tree.query(mm, distance_upper_bound=max_dist)
-    dist.shape = (x, y, z)
-    argdist.shape = (x, y, z)
+    dist[near], argdist[near] = tree.query(mm, distance_upper_bound=max_dist)
     return dist.T, argdist.T
 
 
+def _get_ribbon_mask(subject, xfmname, ppts, wpts, polys, thickness, chunksize=100000):
+    """Mask of the voxels between the pial and white matter surfaces, using
+    point-to-triangle distances to both surfaces."""
+    from scipy import sparse
+    from scipy.spatial import cKDTree
+    from .polyutils import point_triangle_distance
+
+    xfm = db.get_xfm(subject, xfmname)
+    z, y, x = xfm.shape
+    near = _get_near_voxels(xfm, np.vstack([ppts, wpts]), thickness.max())
+    mm = xfm.inv(np.array(np.nonzero(near)).T)
+
+    # triangles incident to each vertex, padded by repeating the first one
+    npt, npoly = len(ppts), len(polys)
+    connected = sparse.csr_matrix((np.ones(3*npoly), (polys.T.ravel(), np.tile(np.arange(npoly), 3))),
+                                  shape=(npt, npoly))
+    degree = np.diff(connected.indptr)
+    faces = np.zeros((npt, max(degree.max(), 1)), dtype=int)
+    slot = np.arange(len(connected.indices)) - np.repeat(connected.indptr[:-1], degree)
+    faces[:] = connected.indices[np.minimum(connected.indptr[:-1], len(connected.indices) - 1)][:, np.newaxis]
+    faces[np.repeat(np.arange(npt), degree), slot] = connected.indices
+
+    def surface_distance(pts, tree, pmm):
+        _, vert = tree.query(pmm)
+        tris = pts[polys[faces[vert]]]
+        return point_triangle_distance(pmm[:, np.newaxis], tris[..., 0, :], tris[..., 1, :], tris[..., 2, :]).min(1), vert
+
+    ptree, wtree = cKDTree(ppts), cKDTree(wpts)
+    inside = np.zeros(len(mm), dtype=bool)
+    for start in range(0, len(mm), chunksize):
+        pmm = mm[start:start+chunksize]
+        pdist, pvert = surface_distance(ppts, ptree, pmm)
+        wdist, wvert = surface_distance(wpts, wtree, pmm)
+        local = (thickness[pvert] + thickness[wvert]) / 2
+        inside[start:start+chunksize] = pdist + wdist <= local
+
+    mask = np.zeros((x, y, z), dtype=bool)
+    mask[near] = inside
+    return mask.T
+
+
 def get_hemi_masks(subject, xfmname, type='nearest'):
     '''Returns a binary mask of the left and right hemisphere
     surface voxels for the given subject.
@@ -881,7 +955,7 @@ def get_shared_voxels(subject, xfmname, hemi="both", merge=True, use_astar=True)
         vert_to_vox_map = dict(zip(*(sparse_find(mask)[:2])))  # From verts to vox
 
         pts_fid, polys_fid = db.get_surf(subject, 'fiducial', hem)  # Get the fiducial surface
-        surf = Surface(pts_fid, polys_fid) #Get the fiducial surface
+        surf = Surface(pts_fid, polys_fid, cachedir=db.get_cache(subject)) #Get the fiducial surface
         graph = surf.graph
 
         _set_edge_distance_graph_attribute(graph, pts_fid, polys_fid)
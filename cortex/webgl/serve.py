@@ -17,6 +17,7 @@ import datetime
 import mimetypes
 import functools
 import threading
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import tornado.web
@@ -237,6 +238,48 @@ class StaticFileHandler(tornado.web.RequestHandler):
             return static_url_prefix + path
 
 
+class TileHandler(tornado.web.RequestHandler):
+    """Serves flatmap tiles rendered by `cortex.quickflat.tiles`, as
+    <name>/<level>/<x>/<y>.png, and the description of their pyramid as
+    <name>/info.json, for the dataviews given by name in `views`.
+
+    Tiles are rendered one at a time in a worker thread, so that the server
+    keeps responding while they are built."""
+    executor = ThreadPoolExecutor(max_workers=1)
+
+    def initialize(self, views, levels=6, tilesize=256, kwargs=None):
+        self.views = views
+        self.levels = levels
+        self.tilesize = tilesize
+        self.kwargs = kwargs or dict()
+
+    async def get(self, path):
+        from ..quickflat import tiles
+        name, _, tile = path.strip("/").partition("/")
+        if name not in self.views:
+            raise HTTPError(404)
+        view = self.views[name]
+
+        if tile == "info.json":
+            info = tiles.get_tile_info(view.subject, self.levels, self.tilesize)
+            self.set_header("Content-Type", "application/json")
+            self.write(json.dumps(info))
+            return
+
+        match = re.match(r"^(\d+)/(\d+)/(\d+)\.png$", tile)
+        if match is None or int(match.group(1)) >= self.levels:
+            raise HTTPError(404)
+        level, x, y = [int(i) for i in match.groups()]
+        render = functools.partial(tiles.make_tile, view, level, x, y,
+                                   tilesize=self.tilesize, **self.kwargs)
+        try:
+            png = await tornado.ioloop.IOLoop.current().run_in_executor(self.executor, render)
+        except ValueError:
+            # outside of the flatmap
+            raise HTTPError(404)
+        self.set_header("Content-Type", "image/png")
+        self.write(png)
+
 class ClientSocket(websocket.WebSocketHandler):
     def initialize(self, parent):
         self.parent = parent
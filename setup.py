@@ -135,6 +135,9 @@ setup(name=DISTNAME,
                 'defaults.cfg',
                 'bbr.sch'
             ],
+            'cortex.tests': [
+                'data/*.npz'
+            ],
             'cortex.webgl': [
                 '*.html',
                 'favicon.ico',